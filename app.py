@@ -1,12 +1,24 @@
+import threading
+import config
 from engine.ui_layout import ui_layout
-from database import db_handler
+from database import db_handler, storage
+from utils import metrics
+from core import fingerprinter
 
 if __name__ == "__main__":
-    # initialize connection
-    db_handler.prepare_db_handler()
-    
-    # setup database
-    db_handler.setup_database()
+    if storage.uses_mysql():
+        # initialize connection
+        db_handler.prepare_db_handler()
+
+        # reuse the existing database, only pending schema migrations are applied
+        db_handler.use_database()
+
+    if config.METRICS_ENABLED:
+        # prometheus scrape endpoint on its own port
+        metrics.start_metrics_server(config.METRICS_PORT)
+
+    # load the signal processing modules while the ui starts, not on the first identification
+    threading.Thread(target=fingerprinter.warm_up, daemon=True).start()
 
     # launch gui
     ui_layout.launch()
@@ -0,0 +1,53 @@
+import numpy as np
+import config
+
+# every song is built from 250ms notes, so peaks land in a realistic density
+NOTE_SECONDS = 0.25
+
+def generate_song(seed, seconds, kind="mixture"):
+    # deterministic synthetic track: the same seed always gives the same samples
+    rng = np.random.default_rng(seed)
+    sr = config.SAMPLE_RATE
+    num_samples = int(seconds * sr)
+    note_len = int(NOTE_SECONDS * sr)
+
+    t = np.arange(note_len) / sr
+    envelope = np.hanning(note_len)
+    signal = 0.01 * rng.standard_normal(num_samples)
+
+    for start in range(0, num_samples - note_len, note_len):
+        note_kind = kind if kind != "mixture" else rng.choice(["tones", "chords", "noise"])
+
+        if note_kind == "tones":
+            # a single tone with a couple of harmonics
+            base = rng.uniform(100, 2000)
+            for harmonic, gain in ((1, 1.0), (2, 0.5), (3, 0.25)):
+                signal[start:start + note_len] += gain * envelope * np.sin(2 * np.pi * base * harmonic * t)
+        elif note_kind == "chords":
+            # three unrelated tones at once
+            for _ in range(3):
+                freq = rng.uniform(100, 5000)
+                signal[start:start + note_len] += rng.uniform(0.3, 1.0) * envelope * np.sin(2 * np.pi * freq * t)
+        else:
+            # band of noise plus one tone on top
+            freq = rng.uniform(100, 5000)
+            signal[start:start + note_len] += envelope * (0.3 * rng.standard_normal(note_len) + np.sin(2 * np.pi * freq * t))
+
+    return signal / np.max(np.abs(signal))
+
+def generate_corpus(count, seconds, seed=0, kind="mixture"):
+    # returns [(name, signal)], song i uses seed + i
+    return [(f"Synthetic {i:05d}", generate_song(seed + i, seconds, kind)) for i in range(count)]
+
+def make_clip(signal, start_seconds, seconds, snr_db, rng):
+    # cut a clip and add white noise at the given signal to noise ratio
+    sr = config.SAMPLE_RATE
+    clip = signal[int(start_seconds * sr):int((start_seconds + seconds) * sr)]
+
+    if snr_db is None:
+        return clip.copy()
+
+    noise = rng.standard_normal(len(clip))
+    noise *= np.sqrt(np.mean(clip ** 2) / np.mean(noise ** 2) / 10 ** (snr_db / 10))
+
+    return clip + noise
@@ -0,0 +1,130 @@
+import json
+import time
+import argparse
+import numpy as np
+import config
+from core import fingerprinter
+from database import db_handler
+from benchmarks.corpus import generate_corpus, make_clip
+from benchmarks.run import summarize
+
+# scratch schema, dropped again unless --keep is passed
+BENCH_SCHEMA = "pytone_layout_bench"
+LAYOUTS = ("rowid", "compact")
+
+def build_tables(corpus):
+    # the same postings in one table per layout
+    rows = []
+    for song_id, (_, signal) in enumerate(corpus, start=1):
+        hash_array, offset_array = fingerprinter.fingerprint_signal(signal)
+        rows.extend(zip(hash_array.tolist(), [song_id] * len(hash_array), offset_array.tolist()))
+
+    with db_handler.get_cursor() as (connection, cursor):
+        cursor.execute(f"DROP DATABASE IF EXISTS {BENCH_SCHEMA}")
+        cursor.execute(f"CREATE DATABASE {BENCH_SCHEMA}")
+        cursor.execute(f"CREATE TABLE {BENCH_SCHEMA}.Song (id INT PRIMARY KEY)")
+        cursor.executemany(f"INSERT INTO {BENCH_SCHEMA}.Song (id) VALUES (%s)", [(i,) for i in range(1, len(corpus) + 1)])
+
+        for layout in LAYOUTS:
+            db_handler.create_hash_table(cursor, table_name(layout), config.HASH_FORMAT, song_table=f"{BENCH_SCHEMA}.Song", layout=layout)
+        connection.commit()
+
+    load_seconds = {}
+    for layout in LAYOUTS:
+        start = time.perf_counter()
+        db_handler.add_hashes_batch(rows, table_name(layout))
+        load_seconds[layout] = time.perf_counter() - start
+
+    return len(rows), load_seconds
+
+def table_name(layout):
+    return f"{BENCH_SCHEMA}.Hash_{layout}"
+
+def table_sizes(layout):
+    with db_handler.get_cursor() as (connection, cursor):
+        # refresh the statistics information_schema reports
+        cursor.execute(f"ANALYZE TABLE {table_name(layout)}")
+        cursor.fetchall()
+
+        cursor.execute(
+            "SELECT DATA_LENGTH, INDEX_LENGTH FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s",
+            (BENCH_SCHEMA, f"Hash_{layout}")
+        )
+        data_length, index_length = cursor.fetchone()
+
+    return {"data_bytes": data_length, "index_bytes": index_length, "total_bytes": data_length + index_length}
+
+def bench_lookups(layout, queries, repeats):
+    latencies = []
+    results = []
+
+    for _ in range(repeats):
+        for hash_array in queries:
+            start = time.perf_counter()
+            grouped = db_handler.get_matches_for_hashes(hash_array.tolist(), table_name=table_name(layout))
+            latencies.append(time.perf_counter() - start)
+            results.append(grouped)
+
+    return summarize(latencies), results[:len(queries)]
+
+def same_hits(a, b):
+    # offsets are float32 seconds in one layout and exact frame times in the other
+    if a.keys() != b.keys():
+        return False
+
+    for hash_value, hits in a.items():
+        left = sorted((song_id, round(offset, 3)) for song_id, offset in hits)
+        right = sorted((song_id, round(offset, 3)) for song_id, offset in b[hash_value])
+        if left != right:
+            return False
+
+    return True
+
+def run(args):
+    corpus = generate_corpus(args.songs, args.seconds, seed=args.seed)
+    postings, load_seconds = build_tables(corpus)
+
+    rng = np.random.default_rng(args.seed)
+    queries = []
+    for _ in range(args.queries):
+        _, signal = corpus[int(rng.integers(len(corpus)))]
+        start_seconds = float(rng.uniform(0, max(args.seconds - args.clip_seconds, 0)))
+        queries.append(fingerprinter.fingerprint_signal(make_clip(signal, start_seconds, args.clip_seconds, 10, rng))[0])
+
+    results = {"postings": postings, "layouts": {}}
+    hits = {}
+    for layout in LAYOUTS:
+        latency, hits[layout] = bench_lookups(layout, queries, args.repeats)
+        sizes = table_sizes(layout)
+
+        results["layouts"][layout] = {
+            "load_seconds": load_seconds[layout],
+            **sizes,
+            "bytes_per_posting": sizes["total_bytes"] / max(postings, 1),
+            "lookup": latency,
+        }
+
+    results["same_hits"] = all(same_hits(a, b) for a, b in zip(hits["rowid"], hits["compact"]))
+    results["params"] = {"songs": args.songs, "seconds": args.seconds, "queries": args.queries, "hash_format": config.HASH_FORMAT}
+
+    if not args.keep:
+        with db_handler.get_cursor() as (connection, cursor):
+            cursor.execute(f"DROP DATABASE IF EXISTS {BENCH_SCHEMA}")
+
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the rowid and compact Hash table layouts on the same postings.")
+    parser.add_argument("--songs", type=int, default=50)
+    parser.add_argument("--seconds", type=float, default=120)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--clip-seconds", type=float, default=5)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true", help=f"keep the {BENCH_SCHEMA} schema for inspection")
+    args = parser.parse_args()
+
+    # initialize connection, the benchmark only touches its own schema
+    db_handler.prepare_db_handler()
+
+    print(json.dumps(run(args), indent=2))
@@ -0,0 +1,138 @@
+import io
+import json
+import time
+import argparse
+import threading
+import numpy as np
+import requests
+import scipy.io.wavfile
+import config
+from core import fingerprinter
+from database import storage
+from benchmarks.corpus import generate_corpus, make_clip
+from benchmarks.run import summarize
+
+def build_index(corpus):
+    # fingerprint the corpus into the in-process backend served by the api
+    backend = storage.get_backend()
+
+    for name, signal in corpus:
+        hash_array, offset_array = fingerprinter.fingerprint_signal(signal)
+        song_id = backend.add_song(name, "Benchmark", int(len(signal) / config.SAMPLE_RATE), "", "")
+        backend.add_hashes_batch([(h, song_id, o) for h, o in zip(hash_array.tolist(), offset_array.tolist())])
+
+def make_uploads(corpus, count, clip_seconds, snr, seed):
+    # wav files as a client would upload them, with the expected title
+    rng = np.random.default_rng(seed)
+    uploads = []
+
+    for _ in range(count):
+        name, signal = corpus[int(rng.integers(len(corpus)))]
+        song_seconds = len(signal) / config.SAMPLE_RATE
+        clip = make_clip(signal, float(rng.uniform(0, max(song_seconds - clip_seconds, 0))), clip_seconds, snr, rng)
+
+        pcm = (clip / max(np.max(np.abs(clip)), 1e-9) * 32767).astype(np.int16)
+        buffer = io.BytesIO()
+        scipy.io.wavfile.write(buffer, config.SAMPLE_RATE, pcm)
+        uploads.append((name, buffer.getvalue()))
+
+    return uploads
+
+def generate_load(url, uploads, concurrency, duration):
+    # closed loop: every client sends its next upload as soon as the previous one returns
+    latencies = []
+    outcomes = {"correct": 0, "wrong": 0, "errors": 0}
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + duration
+
+    def client(index):
+        session = requests.Session()
+        i = index
+
+        while time.perf_counter() < stop_at:
+            name, data = uploads[i % len(uploads)]
+            i += concurrency
+
+            start = time.perf_counter()
+            try:
+                response = session.post(url, files={"audio": ("clip.wav", data, "audio/wav")}, timeout=60)
+                match = response.json().get("match") if response.ok else None
+                outcome = "errors" if not response.ok else ("correct" if match and match["title"] == name else "wrong")
+            except requests.RequestException:
+                outcome = "errors"
+            elapsed = time.perf_counter() - start
+
+            with lock:
+                latencies.append(elapsed)
+                outcomes[outcome] += 1
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "requests": len(latencies),
+        "qps": len(latencies) / elapsed,
+        "latency": summarize(latencies),
+        **outcomes,
+    }
+
+def run(args):
+    corpus = generate_corpus(args.songs, args.seconds, seed=args.seed)
+    uploads = make_uploads(corpus, args.uploads, args.clip_seconds, args.snr, args.seed)
+
+    server = service = None
+    url = args.url
+
+    if url is None:
+        from engine.api import create_server
+
+        config.STORAGE_BACKEND = "memory"
+        build_index(corpus)
+
+        server, service = create_server("127.0.0.1", 0, args.workers, args.batch_window_ms / 1000)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}/identify"
+
+    try:
+        # a few requests first so connection setup is not measured
+        generate_load(url, uploads, 1, 0.5)
+        results = generate_load(url, uploads, args.concurrency, args.duration)
+    finally:
+        if server is not None:
+            server.shutdown()
+            service.shutdown()
+
+    if service is not None:
+        results["avg_batch_size"] = service.batcher.queries / max(service.batcher.batches, 1)
+
+    results["params"] = {
+        "concurrency": args.concurrency,
+        "workers": service.workers if service else None,
+        "batch_window_ms": args.batch_window_ms,
+        "clip_seconds": args.clip_seconds,
+        "songs": args.songs,
+    }
+
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Closed-loop load generator for the identification api.")
+    parser.add_argument("--url", default=None, help="running api to target, by default one is started in-process on the synthetic corpus")
+    parser.add_argument("--songs", type=int, default=20)
+    parser.add_argument("--seconds", type=float, default=60)
+    parser.add_argument("--uploads", type=int, default=50, help="distinct query clips")
+    parser.add_argument("--clip-seconds", type=float, default=5)
+    parser.add_argument("--snr", type=float, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--batch-window-ms", type=float, default=10)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args), indent=2))
@@ -0,0 +1,205 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import numpy as np
+import scipy.io.wavfile
+import config
+from core import fingerprinter
+from core.audio_loader import load_audio
+from database import storage
+from database.index_snapshot import fingerprint_params
+from benchmarks.corpus import generate_corpus, make_clip
+
+def summarize(samples):
+    # latency summary in milliseconds
+    ms = np.asarray(samples) * 1000
+    if len(ms) == 0:
+        return {"n": 0}
+
+    return {
+        "n": len(ms),
+        "mean_ms": float(np.mean(ms)),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+    }
+
+def write_wav(path, signal):
+    pcm = (signal / max(np.max(np.abs(signal)), 1e-9) * 32767).astype(np.int16)
+    scipy.io.wavfile.write(path, config.SAMPLE_RATE, pcm)
+
+def bench_stages(paths):
+    # time every fingerprinter stage separately, song by song
+    timings = {"load": [], "spectogram": [], "extract_peaks": [], "generate_hashes": []}
+    fingerprints = []
+    densities = []
+
+    for path in paths:
+        start = time.perf_counter()
+        signal = load_audio(path)
+        timings["load"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        S, f, t = fingerprinter.spectogram(signal)
+        timings["spectogram"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        peaks = fingerprinter.extract_peaks(S, f, t)
+        timings["extract_peaks"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        hash_array, offset_array = fingerprinter.generate_hashes(peaks)
+        timings["generate_hashes"].append(time.perf_counter() - start)
+
+        duration = len(signal) / config.SAMPLE_RATE
+        fingerprints.append((duration, len(peaks[0]), hash_array, offset_array))
+        densities.append(fingerprinter.peak_density(peaks, duration))
+
+    results = {stage: summarize(samples) for stage, samples in timings.items()}
+    results["peaks_per_song"] = float(np.mean([fp[1] for fp in fingerprints]))
+    results["hashes_per_song"] = float(np.mean([len(fp[2]) for fp in fingerprints]))
+    results["hashes_per_second"] = float(np.mean([len(fp[2]) / fp[0] for fp in fingerprints]))
+    results["peak_density"] = {
+        "peaks_per_second": float(np.mean([d["peaks_per_second"] for d in densities])),
+        "bands": {band: float(np.mean([d["bands"][band] for d in densities])) for band in densities[0]["bands"]},
+        "max_peaks_in_a_second": max(d["max_peaks_in_a_second"] for d in densities),
+    } if densities else None
+
+    return results, fingerprints
+
+def bench_ingest(names, fingerprints):
+    # songs and hashes through the active storage backend
+    backend = storage.get_backend()
+    song_ids = []
+    rows = 0
+
+    start = time.perf_counter()
+    for name, (duration, _, hash_array, offset_array) in zip(names, fingerprints):
+        song_id = backend.add_song(name, "Benchmark", int(duration), "", "")
+        batch_data = [(h, song_id, o) for h, o in zip(hash_array.tolist(), offset_array.tolist())]
+        backend.add_hashes_batch(batch_data)
+
+        song_ids.append(song_id)
+        rows += len(batch_data)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "songs": len(names),
+        "rows": rows,
+        "seconds": elapsed,
+        "songs_per_s": len(names) / elapsed,
+        "rows_per_s": rows / elapsed,
+    }, song_ids
+
+def bench_queries(corpus, clips_per_snr, clip_seconds, snrs, workdir, seed):
+    from engine import matcher
+
+    rng = np.random.default_rng(seed)
+    latencies = []
+    accuracy = {}
+
+    for snr in snrs:
+        correct = 0
+
+        for i in range(clips_per_snr):
+            index = int(rng.integers(len(corpus)))
+            name, signal = corpus[index]
+            song_seconds = len(signal) / config.SAMPLE_RATE
+            start_seconds = float(rng.uniform(0, max(song_seconds - clip_seconds, 0)))
+
+            clip = make_clip(signal, start_seconds, clip_seconds, snr, rng)
+            path = os.path.join(workdir, f"clip_{snr}_{i}.wav")
+            write_wav(path, clip)
+
+            start = time.perf_counter()
+            result = matcher.identify_song(path)
+            latencies.append(time.perf_counter() - start)
+
+            if result and result["title"] == name:
+                correct += 1
+
+            os.remove(path)
+
+        key = "clean" if snr is None else f"{snr:g}dB"
+        accuracy[key] = correct / clips_per_snr if clips_per_snr else None
+
+    return summarize(latencies), accuracy
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="pytone_bench_")
+
+    try:
+        corpus = generate_corpus(args.songs, args.seconds, seed=args.seed)
+
+        # the loader reads files, so the corpus goes through disk like real songs
+        paths = []
+        for i, (_, signal) in enumerate(corpus):
+            path = os.path.join(workdir, f"song_{i:05d}.wav")
+            write_wav(path, signal)
+            paths.append(path)
+
+        stages, fingerprints = bench_stages(paths)
+        ingest, _ = bench_ingest([name for name, _ in corpus], fingerprints)
+
+        snrs = [None if s == "clean" else float(s) for s in args.snr]
+        latency, accuracy = bench_queries(corpus, args.clips, args.clip_seconds, snrs, workdir, args.seed)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": {
+            "python": sys.version.split()[0],
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "params": dict(fingerprint_params(), storage_backend=config.STORAGE_BACKEND),
+        "corpus": {"songs": args.songs, "seconds": args.seconds, "seed": args.seed},
+        "stages": stages,
+        "ingest": ingest,
+        "query": {"clips_per_snr": args.clips, "clip_seconds": args.clip_seconds, "latency": latency},
+        "accuracy": accuracy,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reproducible fingerprinting, ingest and query benchmark.")
+    parser.add_argument("--songs", type=int, default=20, help="number of synthetic songs")
+    parser.add_argument("--seconds", type=float, default=60, help="length of each song")
+    parser.add_argument("--clips", type=int, default=10, help="query clips per snr level")
+    parser.add_argument("--clip-seconds", type=float, default=8, help="length of each query clip")
+    parser.add_argument("--snr", nargs="+", default=["clean", "20", "10", "5", "0"], help="snr levels in dB, or 'clean'")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--peak-mode", choices=["mean", "density"], default=config.PEAK_MODE)
+    parser.add_argument("--peaks-per-band", type=int, default=config.PEAKS_PER_BAND_SECOND, help="density mode cap per band and second")
+    parser.add_argument("--fft-padding", type=int, default=config.FFT_PADDING)
+    parser.add_argument("--backend", choices=["memory", "mysql"], default="memory")
+    parser.add_argument("--reset-database", action="store_true", help="required for --backend mysql, the pytone database is recreated")
+    parser.add_argument("--output", default="benchmark_results.json")
+    args = parser.parse_args()
+
+    config.STORAGE_BACKEND = args.backend
+    config.PEAK_MODE = args.peak_mode
+    config.PEAKS_PER_BAND_SECOND = args.peaks_per_band
+    config.FFT_PADDING = args.fft_padding
+
+    if args.backend == "mysql":
+        if not args.reset_database:
+            print("--backend mysql drops and recreates the pytone database, pass --reset-database to confirm.")
+            sys.exit(1)
+
+        from database import db_handler
+        db_handler.prepare_db_handler()
+        db_handler.reset_database()
+
+    results = run(args)
+
+    with open(args.output, "w") as out:
+        json.dump(results, out, indent=2)
+
+    print(json.dumps(results, indent=2))
@@ -1,5 +1,99 @@
+# fingerprint sample rate, e.g. 11025 decodes faster and only drops content above 5.5 kHz
 SAMPLE_RATE = 44100
-FFT_WINDOW_SIZE = 4096 
+# 4096 samples at 44.1 kHz, scaled so every rate keeps the same ~93ms frames and ~5.4Hz bins
+FFT_WINDOW_SIZE = 4096 * SAMPLE_RATE // 44100
 OVERLAP_RATIO = 0.5
+# nfft = FFT_WINDOW_SIZE * FFT_PADDING, 1 halves the spectrogram height and the
+# peak picking work at the cost of ~10.8Hz instead of ~5.4Hz frequency bins
+FFT_PADDING = 2
+# threads per spectrogram transform. requests and worker processes already run in parallel,
+# more threads per transform only oversubscribe the cores; -1 (every core) suits a single long job
+FFT_WORKERS = 1
 FAN_VALUE = 15
-MIN_AMPLITUDE = 10
\ No newline at end of file
+MIN_AMPLITUDE = 10
+
+# "librosa" decodes the whole file at once, "stream" decodes blocks through ffmpeg
+# (or soundfile + soxr) straight to float32 mono at SAMPLE_RATE
+AUDIO_DECODER = "librosa"
+
+# "mean" keeps every local maximum above the spectrogram mean, "density" only searches
+# PEAK_BANDS and keeps the PEAKS_PER_BAND_SECOND strongest peaks per band and second,
+# which makes hash counts per song predictable
+PEAK_MODE = "mean"
+# band edges in Hz, the last edge is the highest frequency searched
+PEAK_BANDS = (0, 300, 600, 1200, 2400, 5000)
+PEAKS_PER_BAND_SECOND = 10
+
+# fingerprint hash format: "sha1" (hex strings) or "packed" (64-bit integers)
+HASH_FORMAT = "sha1"
+
+# mysql Hash table layout for new tables: "rowid" (surrogate id, FLOAT offset in seconds and a
+# secondary hash_value index) or "compact" (clustered on (hash_value, song_id, offset_frame) with the
+# offset as a MEDIUMINT frame index, lookups are answered from the primary key alone)
+# python -m utils.migrate_hashes converts an existing table
+HASH_LAYOUT = "rowid"
+
+# where songs and fingerprints live: "mysql", "memory" (in-process index),
+# "snapshot" (memory-mapped index file exported from mysql) or "sharded" (see below)
+STORAGE_BACKEND = "mysql"
+INDEX_SNAPSHOT_PATH = "pytone.idx"
+
+# STORAGE_BACKEND = "sharded" splits fingerprints by hash prefix over SHARD_COUNT shards,
+# each a mysql schema ("mysql") or a local shard server process ("process")
+SHARD_COUNT = 4
+SHARD_MODE = "mysql"
+# process shards listen on SHARD_BASE_PORT + index and keep their snapshot in SHARD_DIR
+# clients connect to SHARD_HOST, the servers bind SHARD_BIND_HOST (set "0.0.0.0" to serve other machines)
+SHARD_HOST = "127.0.0.1"
+SHARD_BIND_HOST = "127.0.0.1"
+SHARD_BASE_PORT = 7600
+SHARD_DIR = "shards"
+
+# before storing a new song its fingerprint is matched against the index: an existing song
+# whose best offset lines up at least this fraction of the probed hashes is a duplicate
+# (unrelated songs stay below 0.001, re-encoded or trimmed copies usually land above 0.015)
+DUPLICATE_MIN_SCORE = 0.01
+# hashes probed per song, spread evenly over its length
+DUPLICATE_PROBE_HASHES = 5000
+# "insert" stores them like any other song (no check), opt in to "skip" to drop duplicates
+# or "link" to store their metadata pointing at the original song (without hashes)
+DUPLICATE_ACTION = "insert"
+
+# training requests keep the decoded audio and fingerprints of each downloaded video in
+# FINGERPRINT_CACHE_DIR, keyed by video id and audio content hash, so repeated or concurrent
+# requests for the same video download it once; least recently used entries go first
+FINGERPRINT_CACHE_ENABLED = True
+FINGERPRINT_CACHE_DIR = "fingerprint_cache"
+FINGERPRINT_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# the library tab shows this many songs per page, its song counts are reused for LIBRARY_COUNT_TTL seconds
+LIBRARY_PAGE_SIZE = 50
+LIBRARY_COUNT_TTL = 30
+# the history tab keeps the most recent identifications only
+HISTORY_MAX_ITEMS = 100
+
+# streaming identification answers once the best song scores this many times the runner-up
+STREAM_CONFIDENCE_MARGIN = 2.0
+
+# the http identification api listens on localhost unless API_HOST or --host says otherwise
+API_HOST = "127.0.0.1"
+# larger uploads are refused with 413 before they are read into memory
+API_MAX_UPLOAD_BYTES = 32 * 1024 * 1024
+
+# cache hash lookups and song metadata in front of the storage backend
+CACHE_ENABLED = False
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+# optional shared tier, e.g. "redis://localhost:6379/0"
+CACHE_REDIS_URL = None
+CACHE_REDIS_TTL = 3600
+
+# per-stage timers and counters, exposed in prometheus text format on METRICS_PORT
+METRICS_ENABLED = False
+METRICS_PORT = 9100
+# localhost only by default, set "0.0.0.0" for a scraper on another machine
+METRICS_HOST = "127.0.0.1"
+# show the last request's stage timings in a debug panel of the ui
+METRICS_DEBUG_PANEL = False
+# capture a cProfile / tracemalloc report for every traced request (slow, for chasing outliers)
+METRICS_PROFILE = False
+METRICS_TRACEMALLOC = False
@@ -1,6 +1,14 @@
+import shutil
+import subprocess
 import librosa
 import numpy as np
+import soundfile
+import soxr
 import config
+from math import gcd
+
+# seconds of audio per decoded block in streaming mode
+DECODE_BLOCK_SECONDS = 10
 
 def stereo_to_mono(stereo):
     mono = np.mean(stereo, axis=0)
@@ -9,9 +17,126 @@ def stereo_to_mono(stereo):
     return mono
 
 def load_audio(path):
+    if config.AUDIO_DECODER == "stream":
+        return decode_audio(path)
+
     audio, _ = librosa.load(path, sr=config.SAMPLE_RATE, mono=False)
     
     if audio.ndim == 2:
         audio = stereo_to_mono(audio)
     
-    return audio
\ No newline at end of file
+    return audio
+
+def pcm_to_mono(data):
+    # in-memory samples (x channels) as produced by gradio, to float32 mono at their own rate
+    audio = np.asarray(data)
+
+    # integer pcm to float32 in [-1, 1]
+    if np.issubdtype(audio.dtype, np.integer):
+        audio = audio.astype(np.float32) / np.iinfo(audio.dtype).max
+    else:
+        audio = audio.astype(np.float32)
+
+    # samples x channels to mono
+    if audio.ndim == 2:
+        audio = np.mean(audio, axis=1, dtype=np.float32)
+
+    return audio
+
+def load_array(rate, data):
+    # in-memory (rate, ndarray) input as produced by gradio, one whole recording
+    # chunked input needs a ResampleStream instead, see StreamingIdentifier
+    audio = pcm_to_mono(data)
+
+    # polyphase resampling only when the rate differs
+    if rate != config.SAMPLE_RATE:
+        # scipy.signal is slow to import, only recordings at another rate need it
+        from scipy.signal import resample_poly
+
+        g = gcd(rate, config.SAMPLE_RATE)
+        audio = resample_poly(audio, config.SAMPLE_RATE // g, rate // g)
+
+    return audio
+
+def stream_audio(path, block_seconds=DECODE_BLOCK_SECONDS):
+    # yields float32 mono blocks at the fingerprint rate
+    # only one block of source audio is held at a time
+    if shutil.which("ffmpeg"):
+        yield from stream_ffmpeg(path, block_seconds)
+    else:
+        yield from stream_soundfile(path, block_seconds)
+
+def stream_ffmpeg(path, block_seconds):
+    # ffmpeg decodes, downmixes and resamples, we only read raw float32 samples
+    command = [
+        "ffmpeg", "-v", "error", "-nostdin", "-i", path,
+        "-f", "f32le", "-ac", "1", "-ar", str(config.SAMPLE_RATE), "-"
+    ]
+    block_bytes = int(config.SAMPLE_RATE * block_seconds) * 4
+
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        while True:
+            data = process.stdout.read(block_bytes)
+            if not data:
+                break
+            yield np.frombuffer(data, dtype=np.float32)
+
+        if process.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed to decode {path}: {process.stderr.read().decode(errors='replace').strip()}")
+    finally:
+        # the consumer may stop early
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        process.stderr.close()
+
+def stream_soundfile(path, block_seconds):
+    # fallback without ffmpeg: libsndfile decodes in blocks (like librosa.stream)
+    # and a streaming soxr resampler keeps its state across block edges
+    with soundfile.SoundFile(path) as audio_file:
+        resampler = None
+        if audio_file.samplerate != config.SAMPLE_RATE:
+            resampler = soxr.ResampleStream(audio_file.samplerate, config.SAMPLE_RATE, 1, dtype="float32")
+
+        blocksize = int(audio_file.samplerate * block_seconds)
+        for block in audio_file.blocks(blocksize=blocksize, dtype="float32", always_2d=True):
+            # channel by channel is much faster than a strided mean over axis 1
+            mono = block[:, 0].copy()
+            for channel in range(1, block.shape[1]):
+                mono += block[:, channel]
+            mono *= 1 / block.shape[1]
+
+            yield resampler.resample_chunk(mono) if resampler else mono
+
+        if resampler:
+            tail = resampler.resample_chunk(np.empty(0, dtype=np.float32), last=True)
+            if len(tail):
+                yield tail
+
+def decode_audio(path):
+    # whole track at the fingerprint rate for callers that need all of it at once,
+    # blocks are copied into one buffer as they are decoded: peak memory is the mono track
+    # plus one block, never a full-rate stereo copy or a list of blocks joined at the end.
+    # fingerprinting that can work block by block uses stream_audio instead
+    try:
+        expected = int(soundfile.info(path).duration * config.SAMPLE_RATE) + 1
+    except RuntimeError:
+        # formats libsndfile cannot read (ffmpeg decodes them), start with a minute
+        expected = 60 * config.SAMPLE_RATE
+
+    audio = np.empty(expected, dtype=np.float32)
+    filled = 0
+
+    for block in stream_audio(path):
+        if filled + len(block) > len(audio):
+            # the header undercounted, grow by half
+            grown = np.empty(max(filled + len(block), len(audio) * 3 // 2), dtype=np.float32)
+            grown[:filled] = audio[:filled]
+            audio = grown
+
+        audio[filled:filled + len(block)] = block
+        filled += len(block)
+
+    return audio[:filled]
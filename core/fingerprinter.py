@@ -1,36 +1,116 @@
+import math
 import numpy as np
 import hashlib
 import config
-from core.audio_loader import load_audio
-from scipy.signal import spectrogram as scipy_spectrogram
-from scipy.ndimage import maximum_filter
+from functools import lru_cache
+from numpy.lib.stride_tricks import sliding_window_view
+from core.audio_loader import load_audio, load_array, stream_audio
+from core.frames import frame_hop, frame_times, frame_offsets, offset_frames
+from utils import metrics
 
-def spectogram(signal):
-    # standard shazam settings
-    fs = config.SAMPLE_RATE
+# scipy.fft, scipy.signal and scipy.ndimage take about a second to import,
+# they are loaded on first use (or by warm_up) to keep startup fast
+
+# packed hash layout: three 20-bit fields, f1 | f2 | t_delta in centiseconds
+PACKED_FIELD_BITS = 20
+PACKED_FIELD_MASK = (1 << PACKED_FIELD_BITS) - 1
+
+# (frequency bins, frames) neighbourhood of the peak filter
+# (20, 20) is the standard Dejavu value for good collision resistance
+PEAK_FILTER_SIZE = (20, 20)
+# frames the filter reaches to either side of a frame
+PEAK_CONTEXT = PEAK_FILTER_SIZE[1] // 2
+
+@lru_cache(maxsize=8)
+def stft_plan(window_size, nfft, fs, top_freq):
+    # window, scaling and kept bins only depend on the settings, build them once
+    from scipy import fft as sp_fft
+    from scipy.signal import get_window
+
+    window = get_window('hann', window_size).astype(np.float32)
+
+    # same 'density' scaling scipy uses for mode='magnitude', folded into the window
+    window *= np.float32(np.sqrt(1.0 / (fs * (window * window).sum())))
+
+    freqs = sp_fft.rfftfreq(nfft, 1 / fs)
+    if top_freq is not None:
+        freqs = freqs[:np.searchsorted(freqs, top_freq, side='right')]
+
+    return window, freqs
+
+def current_plan():
+    # density mode never looks above the highest band, those bins are never kept
+    top_freq = config.PEAK_BANDS[-1] if config.PEAK_MODE == "density" else None
+    return stft_plan(config.FFT_WINDOW_SIZE, config.FFT_WINDOW_SIZE * config.FFT_PADDING, config.SAMPLE_RATE, top_freq)
+
+def signal_frames(signal):
+    # overlapping frames as a view, nothing is copied yet
     window_size = config.FFT_WINDOW_SIZE
-    
-    # create spectrogram
-    f, t, S = scipy_spectrogram(
-        x=signal,
-        fs=fs,
-        window='hann',
-        nperseg=window_size,
-        noverlap=int(window_size * config.OVERLAP_RATIO),
-        nfft=window_size * 2,
-        mode='magnitude'
-    )
-    
+    if len(signal) < window_size:
+        return np.empty((0, window_size), dtype=np.float32)
+
+    num_frames = 1 + (len(signal) - window_size) // frame_hop()
+    return sliding_window_view(signal, window_size)[::frame_hop()][:num_frames]
+
+def frames_to_spectogram(frames):
+    # float32 log-magnitude of (num_frames, window) frames, as (freq, time)
+    from scipy import fft as sp_fft
+
+    window, freqs = current_plan()
+
+    # one float32 copy, detrended and windowed in place like scipy's defaults
+    frames = frames.astype(np.float32)
+    frames -= frames.mean(axis=1, keepdims=True)
+    frames *= window
+
+    spectra = sp_fft.rfft(frames, n=config.FFT_WINDOW_SIZE * config.FFT_PADDING, axis=1, workers=config.FFT_WORKERS)
+
+    S = np.empty((len(freqs), len(frames)), dtype=np.float32)
+    np.abs(spectra[:, :len(freqs)].T, out=S)
+
     # use log-magnitude (decibels) for better handling of dynamic range
     # this matches the Shazam logic
-    S = np.log(S + 1e-10)
-    
-    return S, f, t
+    S += 1e-10
+    np.log(S, out=S)
+
+    return S, freqs
+
+def spectogram(signal):
+    S, f = frames_to_spectogram(signal_frames(signal))
+    return S, f, frame_times(0, S.shape[1])
+
+def spectogram_batch(signals):
+    # many clips in one multi-threaded transform, same result as spectogram per clip
+    frames = [signal_frames(signal) for signal in signals]
+    S, f = frames_to_spectogram(np.concatenate(frames) if frames else np.empty((0, config.FFT_WINDOW_SIZE)))
+
+    results = []
+    start = 0
+    for clip_frames in frames:
+        end = start + len(clip_frames)
+        results.append((S[:, start:end], f, frame_times(0, end - start)))
+        start = end
+
+    return results
+
+def mean_level(column_sums, num_values):
+    # exactly rounded mean from per-frame sums, so it does not depend on
+    # whether the frames were summed in one piece or block by block
+    return math.fsum(column_sums) / num_values
+
+def frame_sums(S):
+    # a column sum only depends on that frame's values
+    return S.sum(axis=0, dtype=np.float64)
 
 def extract_peaks(S, f, t):
+    # clips shorter than one frame have no peaks
+    if S.size == 0:
+        return np.empty(0), np.empty(0)
+
+    from scipy.ndimage import maximum_filter
+
     # these parameters determine the density of peaks
-    # (20, 20) is the standard Dejavu value for good collision resistance
-    struct_size = (20, 20) 
+    struct_size = PEAK_FILTER_SIZE
     
     # find local maxima in 2D (time and frequency)
     # this is much faster than iterating manually
@@ -38,54 +118,284 @@ def extract_peaks(S, f, t):
     
     # dynamic threshold: only keep peaks that are significant relative to the background
     # using 'mean' ensures we get peaks even in quiet songs
-    background = (S > np.mean(S))
+    background = (S > mean_level(frame_sums(S), S.size))
     
     # intersection of local maxima and background threshold
     peaks_mask = local_max & background
     
     # extract indices
     freq_idx, time_idx = np.where(peaks_mask)
+
+    if config.PEAK_MODE == "density":
+        keep = limit_density(S[freq_idx, time_idx], f[freq_idx], t[time_idx])
+        freq_idx, time_idx = freq_idx[keep], time_idx[keep]
     
-    # zip and sort by time (required for hashing loop)
-    peaks = list(zip(t[time_idx], f[freq_idx]))
-    peaks.sort(key=lambda x: x[0])
+    # sort by time (required for hashing), stable keeps frequency order within a frame
+    order = np.argsort(time_idx, kind='stable')
     
-    return peaks
+    return t[time_idx[order]], f[freq_idx[order]]
+
+def limit_density(values, freqs, times):
+    # keep the PEAKS_PER_BAND_SECOND strongest peaks of every band in every second
+    num_bands = len(config.PEAK_BANDS) - 1
+    bands = np.clip(np.searchsorted(config.PEAK_BANDS, freqs, side='right') - 1, 0, num_bands - 1)
+    groups = np.floor(times).astype(np.int64) * num_bands + bands
+
+    # strongest first within each group, ties keep extraction order
+    order = np.lexsort((-values, groups))
+    sorted_groups = groups[order]
+
+    # rank of every peak inside its group
+    starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+    rank = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
 
-def generate_hashes(peaks):
-    hashes = []
+    keep = np.zeros(len(values), dtype=bool)
+    keep[order[rank < config.PEAKS_PER_BAND_SECOND]] = True
+    return keep
+
+def peak_density(peaks, duration):
+    # peaks per second overall and per band, to weigh index size against recall
+    peak_times, peak_freqs = peaks
+    duration = max(duration, 1e-9)
+
+    edges = list(config.PEAK_BANDS) + [np.inf]
+    band_counts, _ = np.histogram(peak_freqs, bins=edges)
+    per_second = np.bincount(np.floor(peak_times).astype(np.int64)) if len(peak_times) else np.zeros(1)
+
+    return {
+        "peaks": len(peak_times),
+        "peaks_per_second": len(peak_times) / duration,
+        "bands": {
+            f"{lo:g}-{hi:g}Hz": count / duration
+            for lo, hi, count in zip(edges[:-1], edges[1:], band_counts.tolist())
+        },
+        "max_peaks_in_a_second": int(per_second.max()),
+    }
+
+def pack_hash(f1, f2, t_delta):
+    # f1 and f2 are whole hz, t_delta is quantized to 10ms steps
+    # works on scalars and numpy arrays alike
+    dt = np.rint(np.asarray(t_delta) * 100).astype(np.int64)
+
+    # fits in 60 bits, so it is safe for both signed and unsigned BIGINT
+    return (
+        ((np.asarray(f1, dtype=np.int64) & PACKED_FIELD_MASK) << (2 * PACKED_FIELD_BITS))
+        | ((np.asarray(f2, dtype=np.int64) & PACKED_FIELD_MASK) << PACKED_FIELD_BITS)
+        | (dt & PACKED_FIELD_MASK)
+    )
+
+def generate_hashes(peaks, anchor_start=0, anchor_end=None):
+    peak_times, peak_freqs = peaks
     # fan_out determines how many pairs we make per peak
     # 15 is the standard value to get ~3000 hashes per song
     FAN_OUT = config.FAN_VALUE 
     
-    num_peaks = len(peaks)
-    
-    for i in range(num_peaks):
-        for j in range(1, FAN_OUT):
-            if (i + j) < num_peaks:
-                
-                t1, f1 = peaks[i]
-                t2, f2 = peaks[i + j]
-                
-                t_delta = t2 - t1
-                
-                # strict window between 0s and 10s (standard is often 0-4s)
-                if 0 <= t_delta <= 10.0: 
-                    
-                    # use binning for frequencies to improve match accuracy
-                    # round t_delta to 2 decimals to allow slight timing jitter
-                    h_str = f"{int(f1)}|{int(f2)}|{round(t_delta, 2)}"
-                    
-                    h_val = hashlib.sha1(h_str.encode('utf-8')).hexdigest()
-                    
-                    # add to list
-                    hashes.append((h_val, t1))
-                    
-    return hashes
+    num_peaks = len(peak_times)
+    
+    # optionally hash only a range of anchors, targets may lie past its end
+    if anchor_end is None:
+        anchor_end = num_peaks
+    
+    # pair every anchor i with the targets i+1 .. i+FAN_OUT-1 in one 2d grid
+    anchor_idx = np.arange(anchor_start, anchor_end)[:, None]
+    target_idx = anchor_idx + np.arange(1, FAN_OUT)[None, :]
+    
+    in_range = target_idx < num_peaks
+    target_idx = np.where(in_range, target_idx, 0)
+    
+    t_delta = peak_times[target_idx] - peak_times[anchor_idx]
+    
+    # strict window between 0s and 10s (standard is often 0-4s)
+    # boolean indexing keeps the anchor-major order of the original loop
+    valid = in_range & (t_delta >= 0) & (t_delta <= 10.0)
+    
+    anchors = np.broadcast_to(anchor_idx, valid.shape)[valid]
+    targets = target_idx[valid]
+    t_delta = t_delta[valid]
+    
+    # use binning for frequencies to improve match accuracy
+    f1 = peak_freqs[anchors].astype(np.int64)
+    f2 = peak_freqs[targets].astype(np.int64)
+    
+    if config.HASH_FORMAT == "packed":
+        # bit-pack the quantized values into one integer per pair
+        hash_array = pack_hash(f1, f2, t_delta)
+    else:
+        # round t_delta to 2 decimals to allow slight timing jitter
+        h_strs = zip(f1.tolist(), f2.tolist(), np.round(t_delta, 2).tolist())
+        hash_array = np.array(
+            [hashlib.sha1(f"{a}|{b}|{d}".encode('utf-8')).hexdigest() for a, b, d in h_strs],
+            dtype='<U40'
+        )
+    
+    offset_array = peak_times[anchors]
+    
+    return hash_array, offset_array
+
+def fingerprint_signal(signal):
+    with metrics.timer("spectrogram"):
+        S, f, t = spectogram(signal)
+    with metrics.timer("peaks"):
+        peaks = extract_peaks(S, f, t)
+    with metrics.timer("hashing"):
+        final_hashes = generate_hashes(peaks)
+
+    metrics.count("peaks_extracted", len(peaks[0]))
+    metrics.count("hashes_generated", len(final_hashes[0]))
+    return final_hashes
 
 def process_audio(path):
-    signal = load_audio(path)
-    S, f, t = spectogram(signal)
-    peaks = extract_peaks(S, f, t)
-    final_hashes = generate_hashes(peaks)
-    return final_hashes
\ No newline at end of file
+    if config.AUDIO_DECODER == "stream":
+        # decode and fingerprint block by block, decode memory stays flat for long files
+        # the blocks are joined for callers that need the whole fingerprint at once,
+        # bulk ingest consumes iter_audio_fingerprint itself and stores blocks as they come
+        with metrics.timer("fingerprint_blocks"):
+            return join_fingerprint(iter_audio_fingerprint(path))
+
+    with metrics.timer("load"):
+        signal = load_audio(path)
+    return fingerprint_signal(signal)
+
+def warm_up():
+    # imports, fft plans and the hann window are ready before the first request
+    fingerprint_signal(np.zeros(config.SAMPLE_RATE, dtype=np.float32))
+
+def process_array(rate, data):
+    # in-memory recording, no temp file and no librosa decode
+    with metrics.timer("load"):
+        signal = load_array(rate, data)
+    return fingerprint_signal(signal)
+
+def iter_frames(blocks):
+    # yields (S, f, t) for consecutive runs of complete frames of a block stream
+    window = config.FFT_WINDOW_SIZE
+    hop = frame_hop()
+
+    samples = None
+    next_frame = 0
+
+    for block in blocks:
+        samples = block if samples is None else np.concatenate([samples, block])
+        if len(samples) < window:
+            continue
+
+        # only transform complete frames, keep the remainder for the next block
+        num_frames = 1 + (len(samples) - window) // hop
+        used = window + (num_frames - 1) * hop
+
+        S, f, _ = spectogram(samples[:used])
+        yield S, f, frame_times(next_frame, num_frames)
+
+        next_frame += num_frames
+        samples = samples[num_frames * hop:]
+
+def block_peaks(S, f, t, threshold, start, end):
+    # peaks of columns start..end of S, sorted like extract_peaks
+    # S must hold PEAK_CONTEXT columns around them unless they are the signal edges
+    from scipy.ndimage import maximum_filter
+
+    lo = max(0, start - PEAK_CONTEXT)
+    block = S[:, lo:]
+
+    local_max = maximum_filter(block, size=PEAK_FILTER_SIZE) == block
+    mask = (local_max & (block > threshold))[:, start - lo:end - lo]
+
+    freq_idx, time_idx = np.where(mask)
+
+    if config.PEAK_MODE == "density":
+        values = block[freq_idx, time_idx + start - lo]
+        keep = limit_density(values, f[freq_idx], t[start + time_idx])
+        freq_idx, time_idx = freq_idx[keep], time_idx[keep]
+
+    order = np.argsort(time_idx, kind='stable')
+
+    return t[start + time_idx[order]], f[freq_idx[order]]
+
+def hold_open_second(t, done, end):
+    # the density cap ranks whole seconds, a block of final frames stops before the one still open
+    # t[end] is the first frame that is not final yet
+    if config.PEAK_MODE != "density" or end <= done:
+        return end
+
+    seconds = np.floor(t[done:end + 1])
+    return done + int(np.searchsorted(seconds, seconds[-1]))
+
+def iter_peaks(frames, threshold):
+    # yields (peak_times, peak_freqs) per block, together equal to extract_peaks
+    # only the frames still needed as filter context are kept
+    S = None
+
+    for block, f, block_times in frames:
+        if S is None:
+            S, t, done = block, block_times, 0
+        else:
+            S = np.concatenate([S, block], axis=1)
+            t = np.concatenate([t, block_times])
+
+        # a frame is final once the filter no longer reaches unseen frames
+        end = hold_open_second(t, done, S.shape[1] - PEAK_CONTEXT)
+
+        if end > done:
+            yield block_peaks(S, f, t, threshold, done, end)
+
+            keep = max(0, end - PEAK_CONTEXT)
+            S, t, done = S[:, keep:], t[keep:], end - keep
+
+    # the tail is bounded by the real end of the signal
+    if S is not None and S.shape[1] > done:
+        yield block_peaks(S, f, t, threshold, done, S.shape[1])
+
+def iter_hashes(peak_blocks):
+    # yields (hash_array, offset_array) per block, together equal to generate_hashes
+    # an anchor is final once all of its FAN_VALUE - 1 targets exist
+    peak_times = np.empty(0)
+    peak_freqs = np.empty(0)
+
+    for block_times, block_freqs in peak_blocks:
+        peak_times = np.concatenate([peak_times, block_times])
+        peak_freqs = np.concatenate([peak_freqs, block_freqs])
+
+        end = len(peak_times) - (config.FAN_VALUE - 1)
+        if end > 0:
+            yield generate_hashes((peak_times, peak_freqs), 0, end)
+            peak_times, peak_freqs = peak_times[end:], peak_freqs[end:]
+
+    if len(peak_times):
+        yield generate_hashes((peak_times, peak_freqs))
+
+def signal_level(blocks):
+    # first pass: the peak threshold is the mean of the whole spectrogram
+    sums = []
+    num_values = 0
+
+    for S, _, _ in iter_frames(blocks):
+        sums.append(frame_sums(S))
+        num_values += S.size
+
+    if not sums:
+        return None
+
+    return mean_level(np.concatenate(sums), num_values)
+
+def iter_fingerprint(make_blocks):
+    # block-wise fingerprint with bounded memory, same hashes as fingerprint_signal
+    # make_blocks() returns a fresh block iterator, the signal is read twice:
+    # once for the spectrogram mean, once for peaks and hashes
+    threshold = signal_level(make_blocks())
+    if threshold is None:
+        return
+
+    peaks = iter_peaks(iter_frames(make_blocks()), threshold)
+    for hash_array, offset_array in iter_hashes(peaks):
+        if len(hash_array):
+            yield hash_array, offset_array
+
+def iter_audio_fingerprint(path):
+    return iter_fingerprint(lambda: stream_audio(path))
+
+def join_fingerprint(blocks):
+    blocks = list(blocks)
+    if not blocks:
+        return generate_hashes((np.empty(0), np.empty(0)))
+
+    return np.concatenate([b[0] for b in blocks]), np.concatenate([b[1] for b in blocks])
@@ -0,0 +1,21 @@
+import numpy as np
+import config
+
+# stft frame index <-> seconds, shared by the fingerprinter and the database layer
+# (the compact hash layout stores frame indices), without importing the audio stack
+
+def frame_hop():
+    return config.FFT_WINDOW_SIZE - int(config.FFT_WINDOW_SIZE * config.OVERLAP_RATIO)
+
+def frame_times(first_frame, num_frames):
+    return frame_offsets(np.arange(first_frame, first_frame + num_frames))
+
+def frame_offsets(frames):
+    # seconds at the centre of each frame, the same arithmetic as scipy,
+    # so block times equal one-shot times bit for bit
+    return (config.FFT_WINDOW_SIZE / 2 + frames * frame_hop()) / float(config.SAMPLE_RATE)
+
+def offset_frames(offsets):
+    # inverse of frame_offsets, anchor times back to integer frame indices
+    offsets = np.asarray(offsets, dtype=np.float64)
+    return np.rint((offsets * config.SAMPLE_RATE - config.FFT_WINDOW_SIZE / 2) / frame_hop()).astype(np.int64)
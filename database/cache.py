@@ -0,0 +1,416 @@
+import json
+import threading
+from collections import OrderedDict, deque
+import numpy as np
+import config
+from database.storage import StorageBackend
+
+# rough python object overhead per cached entry, on top of the payload
+ENTRY_OVERHEAD = 100
+
+# invalidations remembered for lookups still in flight, older lookups skip filling the cache
+INVALIDATION_LOG_SIZE = 1000
+
+# a write touching more keys than this tells other processes to drop their whole local tier
+INVALIDATION_MAX_KEYS = 100000
+
+GENERATION_KEY = "pytone:generation"
+
+class LRUCache:
+    # thread-safe in-process cache, evicts least recently used entries by total size
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+
+    def put(self, key, value, nbytes):
+        nbytes += ENTRY_OVERHEAD
+
+        # never cache something that would evict everything else
+        if nbytes > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+
+            self.entries[key] = (value, nbytes)
+            self.size += nbytes
+
+            while self.size > self.max_bytes:
+                _, (_, evicted_bytes) = self.entries.popitem(last=False)
+                self.size -= evicted_bytes
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.size,
+        }
+
+def encode_hits(hits):
+    # int32 song ids followed by float32 offsets, empty means "no hits"
+    song_ids = np.array([h[0] for h in hits], dtype=np.int32)
+    offsets = np.array([h[1] for h in hits], dtype=np.float32)
+    return song_ids.tobytes() + offsets.tobytes()
+
+def decode_hits(data):
+    half = len(data) // 2
+    song_ids = np.frombuffer(data[:half], dtype=np.int32).tolist()
+    offsets = np.frombuffer(data[half:], dtype=np.float32).tolist()
+    return list(zip(song_ids, offsets))
+
+class CachedBackend(StorageBackend):
+    # tiered cache in front of another backend:
+    # in-process lru first, then an optional redis tier shared by worker processes
+    # writes only drop the keys they touched, here and in every other process
+
+    def __init__(self, backend, max_bytes=None, redis_client=None, ttl=None):
+        self.backend = backend
+        self.local = LRUCache(max_bytes or config.CACHE_MAX_BYTES)
+        self.redis = redis_client
+        self.ttl = ttl or config.CACHE_REDIS_TTL
+
+        self.redis_hits = 0
+        self.redis_misses = 0
+
+        # counts local invalidations, the log keeps (generation, keys) of the latest ones, none meaning all keys
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.invalidations = deque(maxlen=INVALIDATION_LOG_SIZE)
+
+        # last redis generation whose invalidations were applied to the local tier
+        self.redis_generation = self.read_redis_generation()
+
+    def hash_key(self, hash_value):
+        return f"pytone:h:{hash_value}"
+
+    def song_key(self, song_id):
+        return f"pytone:s:{song_id}"
+
+    def invalidation_key(self, generation):
+        return f"pytone:inv:{generation}"
+
+    def read_redis_generation(self):
+        if self.redis is None:
+            return None
+
+        return int(self.redis.get(GENERATION_KEY) or 0)
+
+    def drop_local(self, keys):
+        with self.lock:
+            self.generation += 1
+            self.invalidations.append((self.generation, keys))
+
+            if keys is None:
+                self.local.clear()
+            else:
+                for key in keys:
+                    self.local.delete(key)
+
+    def touched_since(self, generation):
+        # keys invalidated after generation, none when the log no longer reaches back that far
+        # callers hold self.lock
+        touched = set()
+
+        if generation == self.generation:
+            return touched
+
+        if not self.invalidations or self.invalidations[0][0] > generation + 1:
+            return None
+
+        for logged_generation, keys in self.invalidations:
+            if logged_generation <= generation:
+                continue
+            if keys is None:
+                return None
+            touched.update(keys)
+
+        return touched
+
+    def sync_invalidations(self):
+        # applies other processes' writes to the local tier, returns the redis generation it saw
+        if self.redis is None:
+            return None
+
+        generation = self.read_redis_generation()
+
+        with self.lock:
+            first = self.redis_generation + 1
+            self.redis_generation = max(self.redis_generation, generation)
+
+        if generation < first:
+            return generation
+
+        if generation - first >= INVALIDATION_LOG_SIZE:
+            self.drop_local(None)
+            return generation
+
+        entries = self.redis.mget([self.invalidation_key(g) for g in range(first, generation + 1)])
+
+        # an expired entry, or one whose writer has not stored it yet, could have touched anything
+        if any(entry is None or entry == b"*" for entry in entries):
+            self.drop_local(None)
+        else:
+            self.drop_local([key.decode() for entry in entries for key in entry.split(b"\n")])
+
+        return generation
+
+    def invalidate(self, keys):
+        self.drop_local(keys)
+
+        if self.redis is None:
+            return
+
+        # writers bump the generation before deleting, a concurrent fill in another process
+        # either sees the new generation and gives up or gets its stale entry deleted
+        generation = self.redis.incr(GENERATION_KEY)
+        entry = "\n".join(keys) if len(keys) <= INVALIDATION_MAX_KEYS else "*"
+
+        pipe = self.redis.pipeline()
+        pipe.set(self.invalidation_key(generation), entry, ex=self.ttl)
+        for i in range(0, len(keys), 10000):
+            pipe.delete(*keys[i:i + 10000])
+        pipe.execute()
+
+        # our own write needs no second pass once nothing else came in between
+        with self.lock:
+            if self.redis_generation == generation - 1:
+                self.redis_generation = generation
+
+    def fill_local(self, generation, entries):
+        # entries are (key, value, nbytes) read while the local generation was generation,
+        # keys invalidated since then may hold stale data and are left out
+        with self.lock:
+            touched = self.touched_since(generation)
+            if touched is None:
+                return
+
+            for key, value, nbytes in entries:
+                if key not in touched:
+                    self.local.put(key, value, nbytes)
+
+    def fill_redis(self, generation, entries):
+        # entries are (key, data) read while the redis generation was generation
+        if self.redis is None or not entries:
+            return
+
+        # redis is optional, only imported once a client is configured
+        from redis.exceptions import WatchError
+
+        with self.redis.pipeline() as pipe:
+            try:
+                # any write since the read makes the whole fill suspect, skip it
+                pipe.watch(GENERATION_KEY)
+                if int(pipe.get(GENERATION_KEY) or 0) != generation:
+                    return
+
+                pipe.multi()
+                for key, data in entries:
+                    pipe.set(key, data, ex=self.ttl)
+                pipe.execute()
+            except WatchError:
+                pass
+
+    def add_song(self, name, artist, duration, thumbnail_url, youtube_url, dedupe=True):
+        song_id = self.backend.add_song(name, artist, duration, thumbnail_url, youtube_url, dedupe)
+
+        if song_id is not None:
+            self.invalidate([self.song_key(song_id)])
+
+        return song_id
+
+    def link_song(self, song_id, original_id):
+        return self.backend.link_song(song_id, original_id)
+
+    def add_hashes_batch(self, val_list):
+        result = self.backend.add_hashes_batch(val_list)
+        self.invalidate_hashes(row[0] for row in val_list)
+        return result
+
+    def add_hashes_bulk(self, val_list):
+        result = self.backend.add_hashes_bulk(val_list)
+        self.invalidate_hashes(row[0] for row in val_list)
+        return result
+
+    def replace_song_hashes(self, song_id, val_list):
+        replaced = self.backend.replace_song_hashes(song_id, val_list)
+
+        # removed postings change cached hits as much as added ones
+        if replaced is not None:
+            self.invalidate_hashes(list(replaced) + [row[0] for row in val_list])
+
+        return replaced
+
+    def invalidate_hashes(self, hash_values):
+        # new postings change these hashes, including cached "no hits" entries
+        self.invalidate([self.hash_key(h) for h in dict.fromkeys(hash_values)])
+
+    def get_matches_for_hashes(self, hash_values):
+        redis_generation = self.sync_invalidations()
+        generation = self.generation
+
+        grouped = {}
+        missing = []
+
+        # tier 1: in-process lru
+        for hash_value in dict.fromkeys(hash_values):
+            hits = self.local.get(self.hash_key(hash_value))
+            if hits is None:
+                missing.append(hash_value)
+            elif hits:
+                grouped[hash_value] = hits
+
+        # tier 2: redis, one round trip for every local miss
+        if missing and self.redis is not None:
+            values = self.redis.mget([self.hash_key(h) for h in missing])
+            still_missing = []
+            local_entries = []
+
+            for hash_value, data in zip(missing, values):
+                if data is None:
+                    still_missing.append(hash_value)
+                    continue
+
+                hits = decode_hits(data)
+                local_entries.append((self.hash_key(hash_value), hits, len(data)))
+                if hits:
+                    grouped[hash_value] = hits
+
+            self.fill_local(generation, local_entries)
+
+            self.redis_hits += len(missing) - len(still_missing)
+            self.redis_misses += len(still_missing)
+            missing = still_missing
+
+        if not missing:
+            return grouped
+
+        # storage for the rest, then fill both tiers, including empty results
+        fetched = self.backend.get_matches_for_hashes(missing)
+
+        local_entries = []
+        redis_entries = []
+        for hash_value in missing:
+            hits = fetched.get(hash_value, [])
+            data = encode_hits(hits)
+
+            local_entries.append((self.hash_key(hash_value), hits, len(data)))
+            redis_entries.append((self.hash_key(hash_value), data))
+
+            if hits:
+                grouped[hash_value] = hits
+
+        self.fill_local(generation, local_entries)
+        self.fill_redis(redis_generation, redis_entries)
+
+        return grouped
+
+    def get_songs_by_ids(self, song_ids):
+        redis_generation = self.sync_invalidations()
+        generation = self.generation
+
+        songs = {}
+        missing = []
+
+        for song_id in song_ids:
+            song = self.local.get(self.song_key(song_id))
+            if song is None:
+                missing.append(song_id)
+            else:
+                songs[song_id] = song
+
+        if missing and self.redis is not None:
+            values = self.redis.mget([self.song_key(song_id) for song_id in missing])
+            still_missing = []
+            local_entries = []
+
+            for song_id, data in zip(missing, values):
+                if data is None:
+                    still_missing.append(song_id)
+                    continue
+
+                song = tuple(json.loads(data))
+                local_entries.append((self.song_key(song_id), song, len(data)))
+                songs[song_id] = song
+
+            self.fill_local(generation, local_entries)
+
+            self.redis_hits += len(missing) - len(still_missing)
+            self.redis_misses += len(still_missing)
+            missing = still_missing
+
+        if not missing:
+            return songs
+
+        fetched = self.backend.get_songs_by_ids(missing)
+
+        local_entries = []
+        redis_entries = []
+        for song_id, song in fetched.items():
+            data = json.dumps(list(song))
+            local_entries.append((self.song_key(song_id), tuple(song), len(data)))
+            redis_entries.append((self.song_key(song_id), data))
+
+            songs[song_id] = tuple(song)
+
+        self.fill_local(generation, local_entries)
+        self.fill_redis(redis_generation, redis_entries)
+
+        return songs
+
+    def get_song_by_id(self, song_id):
+        return self.get_songs_by_ids([song_id]).get(song_id)
+
+    def get_all_songs(self):
+        return self.backend.get_all_songs()
+
+    def get_songs_page(self, after_id=None, limit=50, search=None):
+        return self.backend.get_songs_page(after_id, limit, search)
+
+    def count_songs(self, search=None):
+        return self.backend.count_songs(search)
+
+    def stats(self):
+        return {
+            "local": self.local.stats(),
+            "redis": {"hits": self.redis_hits, "misses": self.redis_misses} if self.redis is not None else None,
+        }
+
+def create_cached_backend(backend):
+    redis_client = None
+
+    if config.CACHE_REDIS_URL:
+        import redis
+        redis_client = redis.Redis.from_url(config.CACHE_REDIS_URL)
+
+    return CachedBackend(backend, redis_client=redis_client)
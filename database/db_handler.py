@@ -1,14 +1,37 @@
 import os
+import csv
+import json
+import time
+import atexit
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
 import mysql.connector
+from mysql.connector import pooling
 from dotenv import load_dotenv
+import config
+from database.index_snapshot import LEGACY_PARAMS, fingerprint_params
+from core.frames import frame_offsets, offset_frames
+from database.storage import search_words
 
 # initialize global variables
-mydb = None
-mycursor = None
+pool = None
+pool_slots = None
+pool_timeout = None
+# connection arguments of the pool, set_config replaces them all, so they are passed again in full
+pool_config = None
+# private directory for the bulk loader's staging files, the only place LOAD DATA LOCAL may read from
+staging_dir = None
+bulk_load_lock = threading.Lock()
+# search words -> (song count, monotonic time), counting a large Song table scans an index
+song_counts = {}
+# (minimum token size, stopwords) of the server's full-text index, read once
+fulltext_settings = None
 
 def prepare_db_handler():
     # access global variables to update them
-    global mydb, mycursor
+    global pool, pool_slots, pool_timeout, pool_config, staging_dir
     
     # load environment variables from .env
     load_dotenv()
@@ -16,28 +39,92 @@ def prepare_db_handler():
     DB_HOST = os.getenv("DB_HOST")
     DB_USER = os.getenv("DB_USER")
     DB_PASSWORD = os.getenv("DB_PASSWORD")
-
-    # connect to mysql database
-    mydb = mysql.connector.connect(
-        host=DB_HOST,
-        user=DB_USER,
-        password=DB_PASSWORD
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+    DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+    # created with mode 0700, realpath because the connector compares resolved paths
+    staging_dir = os.path.realpath(tempfile.mkdtemp(prefix="pytone_staging_"))
+    atexit.register(shutil.rmtree, staging_dir, True)
+
+    pool_config = {
+        "host": DB_HOST,
+        "user": DB_USER,
+        "password": DB_PASSWORD,
+        # the bulk loader's LOAD DATA LOCAL INFILE may only read its own staging files,
+        # a server asking for any other local file is refused
+        "allow_local_infile": False,
+        "allow_local_infile_in_path": staging_dir,
+    }
+
+    # every call checks out its own connection, so concurrent requests never share a cursor
+    pool = pooling.MySQLConnectionPool(
+        pool_name="pytone",
+        pool_size=DB_POOL_SIZE,
+        # rolls back anything a caller left open before the connection is reused
+        pool_reset_session=True,
+        **pool_config
     )
 
-    # create a cursor object
-    mycursor = mydb.cursor()
+    # the pool raises right away when empty, so wait for a free slot instead
+    pool_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+    pool_timeout = DB_POOL_TIMEOUT
+
+@contextmanager
+def get_cursor(buffered=True):
+    # check out a connection and cursor for the duration of one call
+    if not pool_slots.acquire(timeout=pool_timeout):
+        raise pooling.PoolError("Timed out waiting for a database connection")
+
+    try:
+        connection = pool.get_connection()
+
+        try:
+            # health check, reconnects connections the server dropped
+            connection.ping(reconnect=True, attempts=3, delay=1)
+
+            # buffered cursors read the whole result, no unread result errors
+            cursor = connection.cursor(buffered=buffered)
+            try:
+                yield connection, cursor
+            finally:
+                cursor.close()
+        finally:
+            # returns the connection to the pool
+            connection.close()
+    finally:
+        pool_slots.release()
+
+def use_database():
+    # select the existing db, creating it on first start and bringing its schema up to date
+    # songs and hashes from earlier runs are kept
+    migrate_database()
+
+    # pooled connections pick it up the next time they are checked out,
+    # set_config replaces the whole config, so the staging path has to come along
+    pool_config["database"] = "pytone"
+    pool.set_config(**pool_config)
+
+def reset_database():
+    # destructive: drops every song and hash, e.g. for benchmark runs
+    with get_cursor() as (connection, cursor):
+        cursor.execute("DROP DATABASE IF EXISTS pytone")
+    song_counts.clear()
+
+    use_database()
+
+def table_columns(cursor, table_name):
+    cursor.execute(
+        "SELECT COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+        (table_name,)
+    )
+    return {row[0] for row in cursor.fetchall()}
 
-def setup_database():
-    # reset db if exists
-    mycursor.execute("DROP DATABASE IF EXISTS pytone")
-    # create new db
-    mycursor.execute("CREATE DATABASE pytone")
-    # select the db
-    mycursor.execute("USE pytone") 
+# every migration must be safe to run again on a schema that already has its changes:
+# databases from before SchemaVersion existed start at version 0 with some of them applied
 
-    # create song table
-    mycursor.execute("""
-        CREATE TABLE Song (
+def create_base_tables(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS Song (
             id INT AUTO_INCREMENT PRIMARY KEY,
             name VARCHAR(255),
             artist VARCHAR(255),
@@ -47,67 +134,475 @@ def setup_database():
         )
     """)
 
-    # create hash table with song as foreign key
-    mycursor.execute("""
-        CREATE TABLE Hash (
+    # hash table with song as foreign key
+    if not table_columns(cursor, "Hash"):
+        create_hash_table(cursor, "Hash", config.HASH_FORMAT)
+
+def add_song_fingerprint_columns(cursor):
+    existing = table_columns(cursor, "Song")
+
+    # json of the fingerprint parameters the song's hashes were computed with
+    if "fingerprint_params" not in existing:
+        cursor.execute("ALTER TABLE Song ADD COLUMN fingerprint_params TEXT")
+
+    # id of the song this one duplicates, its hashes are not stored
+    if "duplicate_of" not in existing:
+        cursor.execute("ALTER TABLE Song ADD COLUMN duplicate_of INT NULL")
+
+def add_song_search_index(cursor):
+    cursor.execute(
+        "SELECT COUNT(*) FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'Song' AND INDEX_NAME = 'song_search'"
+    )
+
+    # full-text index behind the library search by title and artist
+    if not cursor.fetchone()[0]:
+        cursor.execute("ALTER TABLE Song ADD FULLTEXT INDEX song_search (name, artist)")
+
+def add_compact_song_index(cursor):
+    # compact tables created before the song_id index existed
+    if offset_column(cursor, "Hash") != "offset_frame":
+        return
+
+    cursor.execute(
+        "SELECT COUNT(*) FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'Hash' AND INDEX_NAME = 'song_hashes'"
+    )
+    if not cursor.fetchone()[0]:
+        cursor.execute("ALTER TABLE Hash ADD KEY song_hashes (song_id)")
+
+# (version, description, migration), applied in order
+MIGRATIONS = [
+    (1, "Song and Hash tables", create_base_tables),
+    (2, "fingerprint parameters and duplicate links on Song", add_song_fingerprint_columns),
+    (3, "full-text search index on Song name and artist", add_song_search_index),
+    (4, "song_id index on the compact Hash layout", add_compact_song_index),
+]
+
+def migrate_database():
+    with get_cursor() as (connection, cursor):
+        cursor.execute("CREATE DATABASE IF NOT EXISTS pytone")
+        cursor.execute("USE pytone")
+
+        # one process migrates at a time, the others then find nothing left to do
+        cursor.execute("SELECT GET_LOCK('pytone_migrations', 300)")
+        cursor.fetchone()
+
+        try:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS SchemaVersion (
+                    version INT PRIMARY KEY,
+                    description VARCHAR(255),
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+
+            cursor.execute("SELECT COALESCE(MAX(version), 0) FROM SchemaVersion")
+            version = cursor.fetchone()[0]
+
+            for number, description, migration in MIGRATIONS:
+                if number <= version:
+                    continue
+
+                print(f"Applying schema migration {number}: {description}")
+                migration(cursor)
+
+                cursor.execute("INSERT INTO SchemaVersion (version, description) VALUES (%s, %s)", (number, description))
+                connection.commit()
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK('pytone_migrations')")
+            cursor.fetchone()
+
+def hash_column_type(hash_format):
+    # packed hashes fit in a single 64-bit integer
+    if hash_format == "packed":
+        return "BIGINT UNSIGNED"
+
+    return "VARCHAR(255)"
+
+def create_hash_table(cursor, table_name, hash_format, song_table="Song", layout=None):
+    layout = layout or config.HASH_LAYOUT
+    offset_columns.pop(table_name, None)
+
+    if layout == "compact":
+        # every lookup column is in the clustered key, so a hash seek reads no other rows
+        # the song_id index keeps per-song deletes (re-index) from scanning the table,
+        # no foreign key so bulk loads skip the per-row Song check
+        cursor.execute(f"""
+            CREATE TABLE {table_name} (
+                hash_value {hash_column_type(hash_format)} NOT NULL,
+                song_id INT NOT NULL,
+                offset_frame MEDIUMINT UNSIGNED NOT NULL,
+                PRIMARY KEY (hash_value, song_id, offset_frame),
+                KEY song_hashes (song_id)
+            )
+        """)
+        return
+
+    cursor.execute(f"""
+        CREATE TABLE {table_name} (
             id INT AUTO_INCREMENT PRIMARY KEY,
-            hash_value VARCHAR(255),
+            hash_value {hash_column_type(hash_format)},
             song_id INT,
             offset_time FLOAT,
-            FOREIGN KEY (song_id) REFERENCES Song(id),
+            FOREIGN KEY (song_id) REFERENCES {song_table}(id),
             INDEX (hash_value)
         )
     """)
 
-    # save changes
-    mydb.commit()
+# table name -> "offset_time" (rowid layout, seconds) or "offset_frame" (compact layout, frame index)
+offset_columns = {}
+
+def offset_column(cursor, table_name):
+    # read once per table, a database may still hold tables in the other layout
+    if table_name not in offset_columns:
+        schema, _, table = table_name.rpartition(".")
+        cursor.execute(
+            "SELECT COLUMN_NAME FROM information_schema.COLUMNS "
+            "WHERE TABLE_SCHEMA = COALESCE(NULLIF(%s, ''), DATABASE()) AND TABLE_NAME = %s "
+            "AND COLUMN_NAME IN ('offset_time', 'offset_frame')",
+            (schema, table)
+        )
+        result = cursor.fetchone()
+        offset_columns[table_name] = result[0] if result else "offset_time"
+
+    return offset_columns[table_name]
+
+def encode_rows(val_list, column):
+    # (hash_value, song_id, offset seconds) rows as stored in a table with this offset column
+    if column == "offset_time" or not val_list:
+        return val_list
+
+    frames = offset_frames([row[2] for row in val_list]).tolist()
+    rows = [(row[0], row[1], frame) for row, frame in zip(val_list, frames)]
+
+    # clustered inserts in key order touch each page once
+    rows.sort()
+    return rows
+
+def decode_rows(rows, column):
+    # stored rows back to (hash_value, song_id, offset seconds)
+    if column == "offset_time" or not rows:
+        return rows
+
+    return [(row[0], row[1], frame_offsets(row[2])) for row in rows]
+
+def insert_verb(column):
+    # a posting stored twice (e.g. a re-added song) is a no-op under the compact primary key
+    return "INSERT IGNORE" if column == "offset_frame" else "INSERT"
+
+def read_hash_format(cursor):
+    # the column type tells which format the stored hashes use
+    sql = """
+        SELECT DATA_TYPE FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'Hash' AND COLUMN_NAME = 'hash_value'
+    """
+    cursor.execute(sql)
+
+    result = cursor.fetchone()
+    if not result:
+        return None
+
+    return "packed" if result[0].lower() == "bigint" else "sha1"
+
+def get_hash_format():
+    try:
+        with get_cursor() as (connection, cursor):
+            return read_hash_format(cursor)
+    except mysql.connector.Error as err:
+        print(f"Error: failed to read hash format: {err}")
+        return None
+
+def get_hash_layout():
+    try:
+        with get_cursor() as (connection, cursor):
+            offset_columns.pop("Hash", None)
+            return "compact" if offset_column(cursor, "Hash") == "offset_frame" else "rowid"
+    except mysql.connector.Error as err:
+        print(f"Error: failed to read hash layout: {err}")
+        return None
+
+def migrate_hash_layout(layout):
+    # offsets convert between seconds and frame indices in sql, nothing is fingerprinted again
+    hop = frame_offsets(1) - frame_offsets(0)
+    half_window = frame_offsets(0)
+
+    try:
+        with get_cursor() as (connection, cursor):
+            source = offset_column(cursor, "Hash")
+
+            cursor.execute("DROP TABLE IF EXISTS Hash_migration")
+            create_hash_table(cursor, "Hash_migration", read_hash_format(cursor), layout=layout)
+            target = offset_column(cursor, "Hash_migration")
+
+            if source == target:
+                expression = source
+            elif target == "offset_frame":
+                expression = f"ROUND((offset_time - {half_window!r}) / {hop!r})"
+            else:
+                expression = f"{half_window!r} + offset_frame * {hop!r}"
+
+            cursor.execute(f"""
+                {insert_verb(target)} INTO Hash_migration (hash_value, song_id, {target})
+                SELECT hash_value, song_id, {expression} FROM Hash
+                ORDER BY hash_value, song_id
+            """)
+            connection.commit()
+
+            # swap tables atomically so lookups never see a half built index
+            cursor.execute("RENAME TABLE Hash TO Hash_old, Hash_migration TO Hash")
+            cursor.execute("DROP TABLE Hash_old")
+            connection.commit()
+            offset_columns.clear()
+
+            cursor.execute("SELECT COUNT(*) FROM Hash")
+            return cursor.fetchone()[0]
+    except mysql.connector.Error as err:
+        print(f"Error: hash layout migration failed: {err}")
+        return None
+
+def migrate_hash_format(rehash_song, hash_format):
+    # sha1 digests cannot be unpacked, so every song is fingerprinted again
+    # rehash_song(youtube_url) must return (hash_array, offset_array) in the target format
+    try:
+        with get_cursor() as (connection, cursor):
+            cursor.execute("DROP TABLE IF EXISTS Hash_migration")
+            create_hash_table(cursor, "Hash_migration", hash_format)
+
+            # linked duplicates have no hashes of their own
+            cursor.execute("SELECT id, youtube_url FROM Song WHERE duplicate_of IS NULL ORDER BY id")
+            songs = cursor.fetchall()
+
+        missing_source = [song_id for song_id, youtube_url in songs if not youtube_url]
+        songs = [(song_id, youtube_url) for song_id, youtube_url in songs if youtube_url]
+        if missing_source:
+            # bulk-ingested files keep no source url, run the bulk ingest again for those
+            print(f"{len(missing_source)} songs have no source url and are skipped: {missing_source}")
+
+        migrated = []
+        failed = []
+        for song_id, youtube_url in songs:
+            try:
+                hash_array, offset_array = rehash_song(youtube_url)
+            except Exception as err:
+                # a dead link or an undecodable download costs that song, not the whole migration
+                print(f"Error: failed to re-fingerprint song {song_id}: {err}")
+                failed.append(song_id)
+                continue
+
+            batch_data = [(h, song_id, o) for h, o in zip(hash_array.tolist(), offset_array.tolist())]
+            if not add_hashes_batch(batch_data, table_name="Hash_migration"):
+                # Hash is still untouched, keep it rather than swap in an incomplete table
+                print("Error: hash migration aborted, the Hash table was left unchanged")
+                return None
+            migrated.append(song_id)
+
+        if failed:
+            # these keep their old fingerprint_params, so reindex picks them up once their source works again
+            print(f"{len(failed)} songs could not be re-fingerprinted and have no hashes now: {failed}")
+
+        with get_cursor() as (connection, cursor):
+            # swap tables atomically so lookups never see a half built index
+            cursor.execute("RENAME TABLE Hash TO Hash_old, Hash_migration TO Hash")
+            cursor.execute("DROP TABLE Hash_old")
+            offset_columns.clear()
+            if migrated:
+                placeholders = ", ".join(["%s"] * len(migrated))
+                cursor.execute(
+                    f"UPDATE Song SET fingerprint_params = %s WHERE id IN ({placeholders})",
+                    (json.dumps(fingerprint_params(), sort_keys=True), *migrated)
+                )
+            connection.commit()
+
+        return len(migrated)
+    except mysql.connector.Error as err:
+        print(f"Error: hash migration failed: {err}")
+        return None
 
 def show_db_tables():
-    # retrieve table list
-    mycursor.execute("SHOW TABLES")
-    for x in mycursor:
-        print(x)
+    with get_cursor() as (connection, cursor):
+        # retrieve table list
+        cursor.execute("SHOW TABLES")
+        for x in cursor:
+            print(x)
 
 def get_all_songs():
     try:
         sql = "SELECT name, artist, duration, thumbnail_url FROM Song ORDER BY id DESC"
 
-        mycursor.execute(sql)
+        with get_cursor() as (connection, cursor):
+            cursor.execute(sql)
 
-        return mycursor.fetchall()
+            return cursor.fetchall()
     except mysql.connector.Error as err:
         print(f"Error fetching the library: {err}")
         return []
 
-def add_song(name, artist, duration, thumbnail_url, youtube_url):
+def read_fulltext_settings(cursor):
+    global fulltext_settings
+
+    if fulltext_settings is None:
+        cursor.execute("SELECT @@innodb_ft_min_token_size, @@innodb_ft_enable_stopword, @@innodb_ft_server_stopword_table")
+        min_token_size, stopwords_enabled, stopword_table = cursor.fetchone()
+
+        stopwords = set()
+        if stopwords_enabled:
+            # a server stopword table ("db/table") replaces the built-in list
+            source = stopword_table.replace("/", ".") if stopword_table else "INFORMATION_SCHEMA.INNODB_FT_DEFAULT_STOPWORD"
+            cursor.execute(f"SELECT value FROM {source}")
+            stopwords = {row[0].lower() for row in cursor.fetchall()}
+
+        fulltext_settings = (min_token_size, stopwords)
+
+    return fulltext_settings
+
+def search_conditions(cursor, words):
+    # every word must start a word of the name or artist, the same rule as the memory backend
+    # the full-text index holds no words shorter than its minimum token size and no stopwords,
+    # a search word that could only match those is checked with a word-start pattern instead
+    min_token_size, stopwords = read_fulltext_settings(cursor)
+
+    indexed = []
+    unindexed = []
+    for word in words:
+        if len(word) < min_token_size or any(stopword.startswith(word) for stopword in stopwords):
+            unindexed.append(word)
+        else:
+            indexed.append(word)
+
+    conditions = []
+    values = []
+
+    if indexed:
+        conditions.append("MATCH(name, artist) AGAINST (%s IN BOOLEAN MODE)")
+        values.append(" ".join(f"+{word}*" for word in indexed))
+
+    # search words only hold word characters, nothing to escape; with no indexed word this scans Song
+    for word in unindexed:
+        conditions.append("REGEXP_LIKE(CONCAT_WS(' ', name, artist), %s, 'i')")
+        values.append(f"(^|[^[:alnum:]_]){word}")
+
+    return conditions, values
+
+def get_songs_page(after_id=None, limit=50, search=None):
+    # keyset pagination on the primary key: any page costs the same as the first one
+    conditions = []
+    values = []
+
+    if after_id is not None:
+        conditions.append("id < %s")
+        values.append(after_id)
+
     try:
-        # check for duplicate with limit to prevent unread result errors
-        check_sql = "SELECT id FROM Song WHERE name = %s AND artist = %s LIMIT 1"
-        # values to check
-        check_val = (name, artist)
+        with get_cursor() as (connection, cursor):
+            words = search_words(search)
+            if words:
+                word_conditions, word_values = search_conditions(cursor, words)
+                conditions += word_conditions
+                values += word_values
 
-        # execute check
-        mycursor.execute(check_sql, check_val)
+            where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+            sql = f"SELECT id, name, artist, duration, thumbnail_url FROM Song {where} ORDER BY id DESC LIMIT %s"
 
-        # if we already stored that song, return its id
-        result = mycursor.fetchone()
-        if result:
-            # return existing id
-            return result[0]
+            cursor.execute(sql, (*values, limit))
 
-        # insert command
-        sql = "INSERT INTO Song (name, artist, duration, thumbnail_url, youtube_url) VALUES (%s, %s, %s, %s, %s)"
-        # values to insert
-        val = (name, artist, duration, thumbnail_url, youtube_url)
+            return cursor.fetchall()
+    except mysql.connector.Error as err:
+        print(f"Error fetching the library: {err}")
+        return []
 
-        # execute insert
-        mycursor.execute(sql, val)
+def count_songs(search=None):
+    words = tuple(search_words(search))
 
-        # save changes
-        mydb.commit()
+    # reuse a recent count, songs added by this process clear the cache right away
+    cached = song_counts.get(words)
+    if cached and time.monotonic() - cached[1] < config.LIBRARY_COUNT_TTL:
+        return cached[0]
 
-        # return new song id
-        return mycursor.lastrowid
+    try:
+        with get_cursor() as (connection, cursor):
+            sql = "SELECT COUNT(*) FROM Song"
+            values = ()
+            if words:
+                conditions, values = search_conditions(cursor, words)
+                sql += f" WHERE {' AND '.join(conditions)}"
+
+            cursor.execute(sql, values)
+            count = cursor.fetchone()[0]
+    except mysql.connector.Error as err:
+        print(f"Error counting songs: {err}")
+        return 0
+
+    # one entry per distinct search, dropped all at once when it grows too large
+    if len(song_counts) >= 1000:
+        song_counts.clear()
+    song_counts[words] = (count, time.monotonic())
+
+    return count
+
+def get_song_rows():
+    try:
+        sql = "SELECT id, name, artist, duration, thumbnail_url, youtube_url FROM Song ORDER BY id"
+
+        with get_cursor() as (connection, cursor):
+            cursor.execute(sql)
+
+            return cursor.fetchall()
+    except mysql.connector.Error as err:
+        print(f"Error fetching songs: {err}")
+        return []
+
+def iter_hash_rows(batch_size=100000, table_name="Hash"):
+    # stream the whole hash table without holding every row at once
+    try:
+        with get_cursor() as (connection, cursor):
+            column = offset_column(cursor, table_name)
+
+        with get_cursor(buffered=False) as (connection, cursor):
+            cursor.execute(f"SELECT hash_value, song_id, {column} FROM {table_name}")
+
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+
+                yield decode_rows(rows, column)
+    except mysql.connector.Error as err:
+        print(f"Error streaming hashes: {err}")
+
+def add_song(name, artist, duration, thumbnail_url, youtube_url, dedupe=True):
+    try:
+        with get_cursor() as (connection, cursor):
+            # bulk ingest turns this off, untagged files only differ by their path
+            if dedupe:
+                # check for duplicate
+                check_sql = "SELECT id FROM Song WHERE name = %s AND artist = %s LIMIT 1"
+                # values to check
+                check_val = (name, artist)
+
+                # execute check
+                cursor.execute(check_sql, check_val)
+
+                # if we already stored that song, return its id
+                result = cursor.fetchone()
+                if result:
+                    # return existing id
+                    return result[0]
+
+            # insert command, stamped with the parameters its hashes are computed with
+            sql = "INSERT INTO Song (name, artist, duration, thumbnail_url, youtube_url, fingerprint_params) VALUES (%s, %s, %s, %s, %s, %s)"
+            # values to insert
+            val = (name, artist, duration, thumbnail_url, youtube_url, json.dumps(fingerprint_params(), sort_keys=True))
+
+            # execute insert
+            cursor.execute(sql, val)
+
+            # save changes
+            connection.commit()
+
+            # library counts include the new song
+            song_counts.clear()
+
+            # return new song id
+            return cursor.lastrowid
 
     except mysql.connector.Error as err:
         # print error message
@@ -116,22 +611,151 @@ def add_song(name, artist, duration, thumbnail_url, youtube_url):
         # return none
         return None
     
-def add_hashes_batch(val_list):
+def add_hashes_batch(val_list, table_name="Hash"):
     try:
-        sql = "INSERT INTO Hash (hash_value, song_id, offset_time) VALUES (%s, %s, %s)"
-        
         # define safe batch size to avoid max packet error
         batch_size = 100000 
 
-        # process data in chunks
-        for i in range(0, len(val_list), batch_size):
-            chunk = val_list[i:i + batch_size]
-            mycursor.executemany(sql, chunk)
-            # commit each chunk to keep connection alive
-            mydb.commit()
+        with get_cursor() as (connection, cursor):
+            column = offset_column(cursor, table_name)
+            sql = f"{insert_verb(column)} INTO {table_name} (hash_value, song_id, {column}) VALUES (%s, %s, %s)"
+            val_list = encode_rows(val_list, column)
+
+            # process data in chunks
+            for i in range(0, len(val_list), batch_size):
+                chunk = val_list[i:i + batch_size]
+                cursor.executemany(sql, chunk)
+                # commit each chunk to keep connection alive
+                connection.commit()
 
+        return True
     except mysql.connector.Error as err:
         print(f"Error batch inserting: {err}")
+        return False
+
+def create_staging_table(cursor, column):
+    # same columns as Hash but no keys, so loading it is cheap
+    # recreated every time, the Hash layout may have changed since the last load
+    cursor.execute("DROP TABLE IF EXISTS Hash_staging")
+    cursor.execute(f"""
+        CREATE TABLE Hash_staging (
+            hash_value {hash_column_type(read_hash_format(cursor))},
+            song_id INT,
+            {column} {"MEDIUMINT UNSIGNED" if column == "offset_frame" else "FLOAT"}
+        )
+    """)
+
+def load_staging_infile(cursor, val_list, column):
+    # stream rows through a tab separated file
+    with tempfile.NamedTemporaryFile("w", suffix=".tsv", newline="", delete=False, dir=staging_dir) as tmp:
+        csv.writer(tmp, delimiter="\t", lineterminator="\n").writerows(val_list)
+        tmp_path = tmp.name
+
+    try:
+        cursor.execute(
+            "LOAD DATA LOCAL INFILE %s INTO TABLE Hash_staging "
+            "FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' "
+            f"(hash_value, song_id, {column})",
+            (tmp_path,)
+        )
+    finally:
+        os.remove(tmp_path)
+
+def load_staging_inserts(cursor, val_list, column, rows_per_statement=5000):
+    # multi-row extended inserts, for servers without local_infile
+    for i in range(0, len(val_list), rows_per_statement):
+        chunk = val_list[i:i + rows_per_statement]
+        placeholders = ", ".join(["(%s, %s, %s)"] * len(chunk))
+        values = [value for row in chunk for value in row]
+        cursor.execute(f"INSERT INTO Hash_staging (hash_value, song_id, {column}) VALUES {placeholders}", values)
+
+def add_hashes_bulk(val_list):
+    # load into a keyless staging table, then merge into Hash in one transaction
+    if not val_list:
+        return True
+
+    try:
+        # staging tables are shared, so bulk loads run on one connection at a time
+        with bulk_load_lock, get_cursor() as (connection, cursor):
+            column = offset_column(cursor, "Hash")
+            val_list = encode_rows(val_list, column)
+            create_staging_table(cursor, column)
+
+            try:
+                load_staging_infile(cursor, val_list, column)
+            except mysql.connector.Error as err:
+                print(f"LOAD DATA LOCAL INFILE unavailable ({err}), using extended inserts")
+                cursor.execute("TRUNCATE TABLE Hash_staging")
+                load_staging_inserts(cursor, val_list, column)
+
+            # keep the staged rows, the merge below is its own transaction
+            connection.commit()
+
+            # the compact table is clustered on the hash, merge in key order
+            order = f"ORDER BY hash_value, song_id, {column}" if column == "offset_frame" else ""
+
+            try:
+                cursor.execute(f"""
+                    {insert_verb(column)} INTO Hash (hash_value, song_id, {column})
+                    SELECT hash_value, song_id, {column} FROM Hash_staging {order}
+                """)
+                connection.commit()
+            except mysql.connector.Error:
+                connection.rollback()
+                raise
+
+            cursor.execute("TRUNCATE TABLE Hash_staging")
+
+        return True
+    except mysql.connector.Error as err:
+        print(f"Error bulk loading hashes: {err}")
+        return False
+
+def disable_hash_index():
+    # drop the lookup index during large imports, lookups are slow until it is rebuilt
+    try:
+        with get_cursor() as (connection, cursor):
+            if offset_column(cursor, "Hash") == "offset_frame":
+                print("The compact Hash layout has no secondary index to defer.")
+                return
+
+            cursor.execute("ALTER TABLE Hash DROP INDEX hash_value")
+    except mysql.connector.Error as err:
+        print(f"Error dropping hash index: {err}")
+
+def enable_hash_index():
+    # rebuild the lookup index in one sorted pass
+    try:
+        with get_cursor() as (connection, cursor):
+            if offset_column(cursor, "Hash") == "offset_frame":
+                return
+
+            cursor.execute("ALTER TABLE Hash ADD INDEX hash_value (hash_value)")
+    except mysql.connector.Error as err:
+        print(f"Error rebuilding hash index: {err}")
+
+def create_shard_table(schema):
+    # a shard is its own schema holding only a Hash table, songs stay in pytone
+    try:
+        with get_cursor() as (connection, cursor):
+            cursor.execute(f"CREATE DATABASE IF NOT EXISTS {schema}")
+            cursor.execute(
+                "SELECT COUNT(*) FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'Hash'",
+                (schema,)
+            )
+
+            if cursor.fetchone()[0] == 0:
+                create_hash_table(cursor, f"{schema}.Hash", config.HASH_FORMAT, song_table="pytone.Song")
+                connection.commit()
+    except mysql.connector.Error as err:
+        print(f"Error creating shard {schema}: {err}")
+
+def drop_shard_schema(schema):
+    try:
+        with get_cursor() as (connection, cursor):
+            cursor.execute(f"DROP DATABASE IF EXISTS {schema}")
+    except mysql.connector.Error as err:
+        print(f"Error dropping shard {schema}: {err}")
 
 def get_song_by_id(song_id):
     try:
@@ -139,14 +763,107 @@ def get_song_by_id(song_id):
         sql = "SELECT name, artist, duration, thumbnail_url, youtube_url FROM Song WHERE id = %s"
         val = (song_id,)
         
-        # execute query
-        mycursor.execute(sql, val)
-        
-        # return single result
-        return mycursor.fetchone()
+        with get_cursor() as (connection, cursor):
+            # execute query
+            cursor.execute(sql, val)
+            
+            # return single result
+            return cursor.fetchone()
     except mysql.connector.Error:
         return None
 
+def get_songs_by_ids(song_ids):
+    songs = {}
+
+    if not song_ids:
+        return songs
+
+    try:
+        # fetch every requested song in one query
+        placeholders = ", ".join(["%s"] * len(song_ids))
+        sql = f"SELECT id, name, artist, duration, thumbnail_url, youtube_url FROM Song WHERE id IN ({placeholders})"
+
+        with get_cursor() as (connection, cursor):
+            cursor.execute(sql, tuple(song_ids))
+
+            for song_id, *song in cursor.fetchall():
+                songs[song_id] = tuple(song)
+
+        return songs
+    except mysql.connector.Error as err:
+        print(f"Error: failed to fetch songs: {err}")
+        return {}
+
+def link_song(song_id, original_id):
+    try:
+        with get_cursor() as (connection, cursor):
+            cursor.execute("UPDATE Song SET duplicate_of = %s WHERE id = %s", (original_id, song_id))
+            connection.commit()
+    except mysql.connector.Error as err:
+        print(f"Error: failed to link song {song_id}: {err}")
+
+def get_stale_songs():
+    # (id, youtube_url) of stored songs fingerprinted with other parameters than the current config
+    # songs from before the parameters were recorded count as stale, linked duplicates have no hashes
+    try:
+        with get_cursor() as (connection, cursor):
+            cursor.execute("SELECT id, youtube_url, fingerprint_params FROM Song WHERE duplicate_of IS NULL ORDER BY id")
+            rows = cursor.fetchall()
+    except mysql.connector.Error as err:
+        print(f"Error fetching songs: {err}")
+        return []
+
+    current = fingerprint_params()
+    return [
+        (song_id, youtube_url) for song_id, youtube_url, params in rows
+        if params is None or dict(LEGACY_PARAMS, **json.loads(params)) != current
+    ]
+
+def replace_song_hashes(song_id, val_list, table_name="Hash"):
+    # swap a song's hashes for a new fingerprint in one transaction
+    # returns the hash values it replaced, so caches can drop them, none when it failed
+    # a shard table holds only part of the song, its caller records the parameters once every shard is done
+    try:
+        with get_cursor() as (connection, cursor):
+            column = offset_column(cursor, table_name)
+            sql = f"{insert_verb(column)} INTO {table_name} (hash_value, song_id, {column}) VALUES (%s, %s, %s)"
+            val_list = encode_rows(val_list, column)
+
+            cursor.execute(f"SELECT DISTINCT hash_value FROM {table_name} WHERE song_id = %s", (song_id,))
+            old_hashes = [row[0] for row in cursor.fetchall()]
+
+            cursor.execute(f"DELETE FROM {table_name} WHERE song_id = %s", (song_id,))
+
+            for i in range(0, len(val_list), 100000):
+                cursor.executemany(sql, val_list[i:i + 100000])
+
+            if table_name == "Hash":
+                update_fingerprint_params(cursor, song_id)
+            connection.commit()
+
+            return old_hashes
+    except mysql.connector.Error as err:
+        print(f"Error: failed to re-index song {song_id}: {err}")
+        return None
+
+def update_fingerprint_params(cursor, song_id):
+    cursor.execute(
+        "UPDATE Song SET fingerprint_params = %s WHERE id = %s",
+        (json.dumps(fingerprint_params(), sort_keys=True), song_id)
+    )
+
+def record_fingerprint_params(song_id):
+    # marks song_id as fingerprinted with the current config
+    try:
+        with get_cursor() as (connection, cursor):
+            update_fingerprint_params(cursor, song_id)
+            connection.commit()
+
+        return True
+    except mysql.connector.Error as err:
+        print(f"Error recording the fingerprint parameters of song {song_id}: {err}")
+        return False
+
 def get_hashes_by_song(song_id):
     try:
         # select command
@@ -154,11 +871,12 @@ def get_hashes_by_song(song_id):
         # value to select
         val = (song_id,)
 
-        # execute select
-        mycursor.execute(sql, val)
+        with get_cursor() as (connection, cursor):
+            # execute select
+            cursor.execute(sql, val)
 
-        # return list of hashes
-        return mycursor.fetchall()
+            # return list of hashes
+            return cursor.fetchall()
 
     except mysql.connector.Error:
         # print error message
@@ -170,7 +888,6 @@ def get_hashes_by_song(song_id):
 def get_song_via_hash(hash_val):
     try:
         # join tables to find song details
-        # with limit to prevent unread result errors
         sql = """
             SELECT s.name, s.artist, s.duration, s.thumbnail_url, s.youtube_url 
             FROM Song s 
@@ -181,11 +898,12 @@ def get_song_via_hash(hash_val):
         # value to search for
         val = (hash_val,)
 
-        # execute command
-        mycursor.execute(sql, val)
+        with get_cursor() as (connection, cursor):
+            # execute command
+            cursor.execute(sql, val)
 
-        # return first match or none
-        return mycursor.fetchone()
+            # return first match or none
+            return cursor.fetchone()
 
     except mysql.connector.Error as err:
         # print error message
@@ -196,14 +914,44 @@ def get_song_via_hash(hash_val):
     
 def get_matches_from_hash(hash_val):
     try:
-        # select song id and offset
-        sql = "SELECT song_id, offset_time FROM Hash WHERE hash_value = %s"
-        val = (hash_val,)
-        
-        # execute query
-        mycursor.execute(sql, val)
-        
-        # return all hits
-        return mycursor.fetchall()
+        with get_cursor() as (connection, cursor):
+            # select song id and offset, index-only in the compact layout
+            column = offset_column(cursor, "Hash")
+            sql = f"SELECT hash_value, song_id, {column} FROM Hash WHERE hash_value = %s"
+            val = (hash_val,)
+
+            # execute query
+            cursor.execute(sql, val)
+            
+            # return all hits
+            return [(song_id, offset_time) for _, song_id, offset_time in decode_rows(cursor.fetchall(), column)]
     except mysql.connector.Error:
-        return []
\ No newline at end of file
+        return []
+
+def get_matches_for_hashes(hash_values, chunk_size=1000, table_name="Hash"):
+    # group hits by hash so the matcher can use them directly
+    grouped = {}
+
+    # drop repeated hashes, one lookup per distinct value is enough
+    unique_hashes = list(dict.fromkeys(hash_values))
+
+    try:
+        with get_cursor() as (connection, cursor):
+            column = offset_column(cursor, table_name)
+
+            # resolve the whole fingerprint in a few chunked IN queries
+            for i in range(0, len(unique_hashes), chunk_size):
+                chunk = unique_hashes[i:i + chunk_size]
+                placeholders = ", ".join(["%s"] * len(chunk))
+                sql = f"SELECT hash_value, song_id, {column} FROM {table_name} WHERE hash_value IN ({placeholders})"
+
+                # execute query
+                cursor.execute(sql, tuple(chunk))
+
+                for hash_value, song_id, offset_time in decode_rows(cursor.fetchall(), column):
+                    grouped.setdefault(hash_value, []).append((song_id, offset_time))
+
+        return grouped
+    except mysql.connector.Error as err:
+        print(f"Error: failed to fetch hash matches: {err}")
+        return {}
\ No newline at end of file
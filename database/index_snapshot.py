@@ -0,0 +1,166 @@
+import sys
+import json
+import struct
+import numpy as np
+import config
+from database.memory_index import MemoryIndex
+
+# file layout:
+#   magic (8 bytes) | version (u32) | header length (u32) | json header
+#   then keys, song_ids and offsets arrays, each aligned to 64 bytes
+#   song metadata lives in the json header
+# the header records the fingerprint parameters and where each array starts
+SNAPSHOT_MAGIC = b"PYTONEIX"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_ALIGN = 64
+
+# values of parameters added after the first snapshots were written
+LEGACY_PARAMS = {"fft_padding": 2, "peak_mode": "mean"}
+
+def fingerprint_params():
+    # everything that changes the hash values or offsets for the same audio
+    params = {
+        "sample_rate": config.SAMPLE_RATE,
+        "fft_window_size": config.FFT_WINDOW_SIZE,
+        "fft_padding": config.FFT_PADDING,
+        "overlap_ratio": config.OVERLAP_RATIO,
+        "fan_value": config.FAN_VALUE,
+        "hash_format": config.HASH_FORMAT,
+        "peak_mode": config.PEAK_MODE,
+    }
+
+    if config.PEAK_MODE == "density":
+        params["peak_bands"] = list(config.PEAK_BANDS)
+        params["peaks_per_band_second"] = config.PEAKS_PER_BAND_SECOND
+
+    return params
+
+def key_dtype(hash_format):
+    # sha1 hex digests are plain ascii, so 40 bytes each instead of 160 as unicode
+    if hash_format == "packed":
+        return np.dtype(np.int64)
+
+    return np.dtype("S40")
+
+def align(position):
+    return (position + SNAPSHOT_ALIGN - 1) // SNAPSHOT_ALIGN * SNAPSHOT_ALIGN
+
+def write_snapshot(path, keys, song_ids, offsets, songs):
+    # keys, song_ids and offsets must already be sorted by key
+    arrays = {
+        "keys": np.ascontiguousarray(keys, dtype=key_dtype(config.HASH_FORMAT)),
+        "song_ids": np.ascontiguousarray(song_ids, dtype=np.int32),
+        "offsets": np.ascontiguousarray(offsets, dtype=np.float32),
+    }
+
+    header = {
+        "params": fingerprint_params(),
+        "num_postings": len(arrays["keys"]),
+        # json keys must be strings, song ids are restored on load
+        "songs": {str(song_id): list(song) for song_id, song in songs.items()},
+        "arrays": {},
+    }
+
+    # array starts are relative to the data section that follows the header
+    position = 0
+    for name, arr in arrays.items():
+        header["arrays"][name] = {"dtype": arr.dtype.str, "start": position}
+        position = align(position + arr.nbytes)
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = align(16 + len(header_bytes))
+
+    with open(path, "wb") as out:
+        out.write(SNAPSHOT_MAGIC)
+        out.write(struct.pack("<II", SNAPSHOT_VERSION, len(header_bytes)))
+        out.write(header_bytes)
+
+        for name, arr in arrays.items():
+            out.seek(data_start + header["arrays"][name]["start"])
+            out.write(arr.tobytes())
+
+        # pad the file so the last array is fully mappable
+        out.truncate(data_start + position)
+
+def read_header(path):
+    with open(path, "rb") as src:
+        magic = src.read(8)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a PyTone index snapshot")
+
+        version, header_len = struct.unpack("<II", src.read(8))
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version {version}, expected {SNAPSHOT_VERSION}")
+
+        header = json.loads(src.read(header_len).decode("utf-8"))
+        header["data_start"] = align(16 + header_len)
+
+        return header
+
+def load_snapshot(path):
+    header = read_header(path)
+
+    # refuse snapshots built with other settings, they would silently return wrong matches
+    expected = fingerprint_params()
+    if dict(LEGACY_PARAMS, **header["params"]) != expected:
+        raise ValueError(
+            f"Snapshot {path} was built with {header['params']}, "
+            f"but the current config uses {expected}"
+        )
+
+    # map the arrays read-only, worker processes share the pages through the os cache
+    count = header["num_postings"]
+    mapped = {}
+    for name, info in header["arrays"].items():
+        dtype = np.dtype(info["dtype"])
+
+        # empty arrays cannot be mapped
+        if count == 0:
+            mapped[name] = np.empty(0, dtype=dtype)
+            continue
+
+        offset = header["data_start"] + info["start"]
+        mapped[name] = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(count,))
+
+    songs = {int(song_id): tuple(song) for song_id, song in header["songs"].items()}
+
+    return MemoryIndex(mapped["keys"], mapped["song_ids"], mapped["offsets"], songs)
+
+def export_from_index(path, index):
+    index.merge_pending()
+    keys = index.keys if index.keys is not None else np.empty(0, dtype=key_dtype(config.HASH_FORMAT))
+    write_snapshot(path, keys, index.song_ids, index.offsets, index.songs)
+
+def export_from_mysql(path):
+    from database import db_handler
+
+    # load everything into an in-memory index, then sort once
+    index = MemoryIndex()
+    for song_id, *song in db_handler.get_song_rows():
+        index.songs[song_id] = tuple(song)
+
+    for rows in db_handler.iter_hash_rows():
+        hash_values, song_ids, offsets = zip(*rows)
+        index.add_hash_arrays(
+            np.asarray(hash_values, dtype=key_dtype(config.HASH_FORMAT)),
+            np.asarray(song_ids),
+            np.asarray(offsets)
+        )
+
+    export_from_index(path, index)
+
+    return len(index.keys) if index.keys is not None else 0
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "export":
+        print("Usage: python -m database.index_snapshot export <path>")
+        sys.exit(1)
+
+    from database import db_handler
+
+    # initialize connection to the existing database
+    db_handler.prepare_db_handler()
+    db_handler.use_database()
+
+    postings = export_from_mysql(sys.argv[2])
+    print(f"Wrote {postings} postings to {sys.argv[2]}")
@@ -0,0 +1,236 @@
+import bisect
+import itertools
+import threading
+import numpy as np
+from database.storage import StorageBackend, search_words
+
+class MemoryIndex(StorageBackend):
+    # in-process inverted index: sorted hash keys with parallel posting arrays
+    # lookups are a binary search, no database needed
+    # training and identification run on different threads, self.lock guards every change
+
+    def __init__(self, keys=None, song_ids=None, offsets=None, songs=None):
+        # postings sorted by hash key
+        self.keys = keys
+        self.song_ids = song_ids if song_ids is not None else np.empty(0, dtype=np.int32)
+        self.offsets = offsets if offsets is not None else np.empty(0, dtype=np.float32)
+
+        # song id -> (name, artist, duration, thumbnail_url, youtube_url)
+        self.songs = songs if songs is not None else {}
+        # duplicate song id -> original song id
+        self.links = {}
+        # sorted song ids for paging, rebuilt once songs were added
+        self.song_order = []
+        # sorted (word, song_id) pairs of every title and artist word, rebuilt once songs were added
+        self.word_index = []
+        self.indexed_songs = 0
+        # (search words, number of songs) -> sorted ids of the matching songs
+        self.search_results = {}
+
+        # rows added since the last merge, sorted in lazily on lookup
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def add_song(self, name, artist, duration, thumbnail_url, youtube_url, dedupe=True):
+        with self.lock:
+            # same dedupe rule as the mysql backend
+            if dedupe:
+                for song_id, song in self.songs.items():
+                    if song[0] == name and song[1] == artist:
+                        return song_id
+
+            song_id = max(self.songs, default=0) + 1
+            self.songs[song_id] = (name, artist, duration, thumbnail_url, youtube_url)
+
+        return song_id
+
+    def link_song(self, song_id, original_id):
+        with self.lock:
+            self.links[song_id] = original_id
+
+    def add_hashes_batch(self, val_list):
+        if not val_list:
+            return
+
+        hash_values, song_ids, offsets = zip(*val_list)
+        self.add_hash_arrays(np.asarray(hash_values), np.asarray(song_ids), np.asarray(offsets))
+
+    def add_hash_arrays(self, hash_array, song_id_array, offset_array):
+        # array form of add_hashes_batch, skips building python rows
+        part = (hash_array, song_id_array.astype(np.int32), offset_array.astype(np.float32))
+
+        with self.lock:
+            self.pending.append(part)
+
+    def replace_song_hashes(self, song_id, val_list):
+        with self.lock:
+            self.merge_locked()
+
+            if self.keys is None:
+                old_hashes = []
+            else:
+                # boolean indexing copies, lookups holding the old arrays are not affected
+                own = self.song_ids == song_id
+                old_hashes = np.unique(self.keys[own]).tolist()
+                keep = ~own
+                self.keys, self.song_ids, self.offsets = self.keys[keep], self.song_ids[keep], self.offsets[keep]
+
+            if val_list:
+                hash_values, song_ids, offsets = zip(*val_list)
+                self.pending.append((np.asarray(hash_values), np.asarray(song_ids, dtype=np.int32), np.asarray(offsets, dtype=np.float32)))
+                self.merge_locked()
+
+        return old_hashes
+
+    def merge_pending(self):
+        with self.lock:
+            self.merge_locked()
+
+    def merge_locked(self):
+        # callers hold self.lock, lookups never see half swapped arrays or lose pending rows
+        if not self.pending:
+            return
+
+        parts = self.pending
+        if self.keys is not None:
+            parts = [(self.keys, self.song_ids, self.offsets)] + parts
+
+        # cast to the first part's dtype, e.g. unicode sha1 rows into a bytes snapshot
+        keys = np.concatenate([np.asarray(p[0], dtype=parts[0][0].dtype) for p in parts])
+        song_ids = np.concatenate([p[1] for p in parts])
+        offsets = np.concatenate([p[2] for p in parts])
+
+        # stable sort keeps insertion order within a key
+        order = np.argsort(keys, kind='stable')
+
+        self.keys = keys[order]
+        self.song_ids = song_ids[order]
+        self.offsets = offsets[order]
+        self.pending = []
+
+    def lookup(self, hash_array):
+        # returns (query_index, song_ids, offsets) for every posting hit
+        # the arrays are replaced, never changed in place, so searching outside the lock is safe
+        with self.lock:
+            self.merge_locked()
+            keys, all_song_ids, all_offsets = self.keys, self.song_ids, self.offsets
+
+        if keys is None or len(keys) == 0 or len(hash_array) == 0:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, all_song_ids[:0], all_offsets[:0]
+
+        hash_array = np.asarray(hash_array, dtype=keys.dtype)
+        left = np.searchsorted(keys, hash_array, side='left')
+        right = np.searchsorted(keys, hash_array, side='right')
+        counts = right - left
+
+        # expand every [left, right) range into flat posting positions
+        query_index = np.repeat(np.arange(len(hash_array)), counts)
+        starts = np.repeat(left - np.cumsum(counts) + counts, counts)
+        positions = starts + np.arange(counts.sum())
+
+        return query_index, all_song_ids[positions], all_offsets[positions]
+
+    def get_matches_for_hashes(self, hash_values):
+        unique_hashes = list(dict.fromkeys(hash_values))
+
+        query_index, song_ids, offsets = self.lookup(np.asarray(unique_hashes))
+
+        grouped = {}
+        for q, song_id, offset_time in zip(query_index.tolist(), song_ids.tolist(), offsets.tolist()):
+            grouped.setdefault(unique_hashes[q], []).append((song_id, offset_time))
+
+        return grouped
+
+    def get_song_by_id(self, song_id):
+        return self.songs.get(song_id)
+
+    def get_songs_by_ids(self, song_ids):
+        return {song_id: self.songs[song_id] for song_id in song_ids if song_id in self.songs}
+
+    def get_all_songs(self):
+        with self.lock:
+            songs = sorted(self.songs.items(), reverse=True)
+
+        return [song[:4] for _, song in songs]
+
+    def sorted_song_ids(self):
+        # ids only ever get added, so a length change means the order is stale
+        with self.lock:
+            if len(self.song_order) != len(self.songs):
+                self.song_order = sorted(self.songs)
+
+            return self.song_order
+
+    def search_index(self):
+        # title and artist words split like search_words, a prefix search is a bisect into this list
+        with self.lock:
+            if self.indexed_songs != len(self.songs):
+                # songs are only ever added, the ones not indexed yet are the newest dict entries
+                pairs = []
+                for song_id, song in itertools.islice(self.songs.items(), self.indexed_songs, None):
+                    for word in set(search_words(f"{song[0] or ''} {song[1] or ''}")):
+                        pairs.append((word, song_id))
+
+                # searches read the old list outside the lock, build a new one
+                if len(pairs) > 100:
+                    # two sorted runs, the sort merges them in linear time
+                    pairs.sort()
+                    index = self.word_index + pairs
+                    index.sort()
+                else:
+                    # a trained song or two, inserting beats comparing every pair
+                    index = list(self.word_index)
+                    for pair in pairs:
+                        bisect.insort(index, pair)
+
+                self.word_index = index
+                self.indexed_songs = len(self.songs)
+
+            return self.word_index
+
+    def search_song_ids(self, words):
+        # sorted ids of the songs where every search word starts a title or artist word
+        key = (tuple(words), len(self.songs))
+        cached = self.search_results.get(key)
+        if cached is not None:
+            return cached
+
+        index = self.search_index()
+        matches = None
+
+        for word in set(words):
+            found = set()
+
+            # pairs of all words starting with this prefix are one contiguous run
+            position = bisect.bisect_left(index, (word,))
+            while position < len(index) and index[position][0].startswith(word):
+                found.add(index[position][1])
+                position += 1
+
+            matches = found if matches is None else matches & found
+
+        song_ids = sorted(matches)
+
+        if len(self.search_results) >= 100:
+            self.search_results.clear()
+        self.search_results[key] = song_ids
+
+        return song_ids
+
+    def get_songs_page(self, after_id=None, limit=50, search=None):
+        words = search_words(search)
+        order = self.search_song_ids(words) if words else self.sorted_song_ids()
+
+        # walk down from the cursor, newest first
+        end = len(order) if after_id is None else bisect.bisect_left(order, after_id)
+        page = order[max(end - limit, 0):end]
+
+        return [(song_id, *self.songs[song_id][:4]) for song_id in reversed(page)]
+
+    def count_songs(self, search=None):
+        words = search_words(search)
+        if not words:
+            return len(self.songs)
+
+        return len(self.search_song_ids(words))
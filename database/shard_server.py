@@ -0,0 +1,99 @@
+import os
+import argparse
+import threading
+from multiprocessing.connection import Listener
+from multiprocessing import AuthenticationError
+import numpy as np
+import config
+from database.memory_index import MemoryIndex
+from database.index_snapshot import load_snapshot, export_from_index, key_dtype
+from database.sharding import shard_bind_address, shard_authkey, shard_snapshot_path
+
+# index methods a client may call, plus the admin commands below
+METHODS = {
+    "add_song", "link_song", "add_hashes_batch", "replace_song_hashes", "lookup", "get_matches_for_hashes",
+    "get_song_by_id", "get_songs_by_ids", "get_all_songs", "get_songs_page", "count_songs",
+}
+
+class ShardServer:
+    # one in-memory index behind a socket, requests from all connections are serialized
+
+    def __init__(self, count, index):
+        self.count = count
+        self.index = index
+        self.path = shard_snapshot_path(count, index)
+        self.lock = threading.Lock()
+
+        if os.path.exists(self.path):
+            self.store = load_snapshot(self.path)
+        else:
+            self.store = MemoryIndex()
+
+    def handle(self, method, args):
+        if method in METHODS:
+            return getattr(self.store, method)(*args)
+
+        if method == "save":
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            # write next to the mapped file and swap, the old pages stay valid until then
+            export_from_index(self.path + ".tmp", self.store)
+            os.replace(self.path + ".tmp", self.path)
+            return f"Shard {self.index}/{self.count} saved {self.handle('stats', ())['postings']} postings to {self.path}"
+
+        if method == "dump":
+            self.store.merge_pending()
+            keys = self.store.keys if self.store.keys is not None else np.empty(0, dtype=key_dtype(config.HASH_FORMAT))
+            return np.asarray(keys), np.asarray(self.store.song_ids), np.asarray(self.store.offsets), self.store.songs
+
+        if method == "stats":
+            self.store.merge_pending()
+            return {
+                "shard": self.index,
+                "count": self.count,
+                "postings": 0 if self.store.keys is None else len(self.store.keys),
+                "songs": len(self.store.songs),
+            }
+
+        raise ValueError(f"Unknown shard method: {method}")
+
+    def serve_connection(self, conn):
+        with conn:
+            while True:
+                try:
+                    method, args = conn.recv()
+                except (EOFError, ConnectionResetError):
+                    return
+
+                try:
+                    with self.lock:
+                        reply = ("ok", self.handle(method, args))
+                except Exception as err:
+                    reply = ("error", repr(err))
+
+                conn.send(reply)
+
+    def serve_forever(self):
+        address = shard_bind_address(self.index)
+
+        with Listener(address, authkey=shard_authkey()) as listener:
+            print(f"Shard {self.index}/{self.count} listening on {address[0]}:{address[1]}")
+
+            while True:
+                try:
+                    conn = listener.accept()
+                except (AuthenticationError, OSError) as err:
+                    print(f"Rejected shard connection: {err}")
+                    continue
+
+                threading.Thread(target=self.serve_connection, args=(conn,), daemon=True).start()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve one fingerprint shard.")
+    parser.add_argument("--count", type=int, default=config.SHARD_COUNT)
+    parser.add_argument("--index", type=int, required=True)
+    args = parser.parse_args()
+
+    try:
+        ShardServer(args.count, args.index).serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,367 @@
+import os
+import sys
+import time
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Client
+import numpy as np
+import config
+from database.storage import StorageBackend, MySQLBackend
+
+# fibonacci hashing constant, spreads packed hashes whose low bits are the time delta
+PACKED_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+def shard_authkey():
+    # shared secret for the shard servers, from .env like the database credentials
+    # shard servers unpickle what they receive, so there is no default key
+    from dotenv import load_dotenv
+    load_dotenv()
+    authkey = os.getenv("SHARD_AUTHKEY", "")
+
+    if not authkey or authkey == "change-me":
+        raise RuntimeError("SHARD_AUTHKEY is not set in .env, pick a long random value shared by the app and the shard servers")
+
+    return authkey.encode("utf-8")
+
+def shard_address(index):
+    # where clients reach a shard
+    return (config.SHARD_HOST, config.SHARD_BASE_PORT + index)
+
+def shard_bind_address(index):
+    # where a shard server listens, localhost unless SHARD_BIND_HOST says otherwise
+    return (config.SHARD_BIND_HOST, config.SHARD_BASE_PORT + index)
+
+def shard_snapshot_path(count, index):
+    return os.path.join(config.SHARD_DIR, f"{count}_{index}.idx")
+
+def shard_schema(count, index):
+    return f"pytone_shard_{count}_{index}"
+
+def hash_prefixes(hash_array):
+    # top 32 bits of every hash as uint64
+    hash_array = np.asarray(hash_array)
+
+    if hash_array.dtype.kind in "iu":
+        mixed = hash_array.astype(np.uint64) * PACKED_MIX
+        return mixed >> np.uint64(32)
+
+    # sha1 hex digests: the first 8 hex digits are already uniform
+    if hash_array.dtype.kind == "U":
+        chars = hash_array.astype("<U40").view(np.uint32).reshape(-1, 40)[:, :8]
+    else:
+        chars = hash_array.astype("S40").view(np.uint8).reshape(-1, 40)[:, :8]
+
+    chars = chars.astype(np.uint64)
+    digits = np.where(chars >= ord("a"), chars - (ord("a") - 10), chars - ord("0"))
+
+    prefix = np.zeros(len(hash_array), dtype=np.uint64)
+    for i in range(8):
+        prefix = (prefix << np.uint64(4)) | digits[:, i]
+
+    return prefix
+
+def shard_of(hash_array, count):
+    # range partitioning of the prefix space, so doubling the count splits every shard in two
+    return ((hash_prefixes(hash_array) * np.uint64(count)) >> np.uint64(32)).astype(np.int64)
+
+def partition_rows(val_list, count):
+    # (hash_value, song_id, offset_time) rows grouped by owning shard
+    if not val_list:
+        return [[] for _ in range(count)]
+
+    owners = shard_of([row[0] for row in val_list], count).tolist()
+    parts = [[] for _ in range(count)]
+    for owner, row in zip(owners, val_list):
+        parts[owner].append(row)
+
+    return parts
+
+class ShardedBackend(StorageBackend):
+    # fingerprints split by hash prefix over several shards, songs kept in one catalogue
+    # lookups scatter to the shards in parallel and gather the hits back in query order
+
+    def __init__(self, catalogue, shards):
+        self.catalogue = catalogue
+        self.shards = shards
+        self.pool = ThreadPoolExecutor(max_workers=len(shards))
+
+    def add_song(self, name, artist, duration, thumbnail_url, youtube_url, dedupe=True):
+        return self.catalogue.add_song(name, artist, duration, thumbnail_url, youtube_url, dedupe)
+
+    def link_song(self, song_id, original_id):
+        return self.catalogue.link_song(song_id, original_id)
+
+    def scatter(self, call, parts):
+        # call(shard, part) for every non-empty part, in parallel
+        jobs = [(shard, part) for shard, part in zip(self.shards, parts) if len(part)]
+        return list(self.pool.map(lambda job: call(*job), jobs))
+
+    def add_hashes_batch(self, val_list):
+        # false when a mysql shard reported an error
+        return False not in self.scatter(lambda shard, rows: shard.add_hashes_batch(rows), partition_rows(val_list, len(self.shards)))
+
+    def add_hashes_bulk(self, val_list):
+        return False not in self.scatter(lambda shard, rows: shard.add_hashes_bulk(rows), partition_rows(val_list, len(self.shards)))
+
+    def replace_song_hashes(self, song_id, val_list):
+        # the old postings may sit on any shard, so every shard replaces its part, empty or not
+        parts = partition_rows(val_list, len(self.shards))
+        results = list(self.pool.map(lambda job: job[0].replace_song_hashes(song_id, job[1]), zip(self.shards, parts)))
+
+        # the song counts as re-indexed only once every shard holds its new part
+        if None in results or not self.catalogue.record_fingerprint_params(song_id):
+            return None
+
+        return [hash_value for replaced in results for hash_value in replaced]
+
+    def lookup(self, hash_array):
+        hash_array = np.asarray(hash_array)
+        owners = shard_of(hash_array, len(self.shards))
+        positions = [np.flatnonzero(owners == i) for i in range(len(self.shards))]
+
+        # each shard answers with indices into its own part, map them back to the query
+        def call(shard, part):
+            query_index, song_ids, offsets = shard.lookup(hash_array[part])
+            return part[query_index], song_ids, offsets
+
+        results = self.scatter(call, positions)
+        if not results:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+
+        return (
+            np.concatenate([r[0] for r in results]),
+            np.concatenate([np.asarray(r[1], dtype=np.int32) for r in results]),
+            np.concatenate([np.asarray(r[2], dtype=np.float32) for r in results])
+        )
+
+    def get_matches_for_hashes(self, hash_values):
+        hash_values = list(hash_values)
+        owners = shard_of(hash_values, len(self.shards)).tolist() if hash_values else []
+
+        parts = [[] for _ in self.shards]
+        for owner, hash_value in zip(owners, hash_values):
+            parts[owner].append(hash_value)
+
+        matches = {}
+        for result in self.scatter(lambda shard, part: shard.get_matches_for_hashes(part), parts):
+            matches.update(result or {})
+
+        return matches
+
+    def get_song_by_id(self, song_id):
+        return self.catalogue.get_song_by_id(song_id)
+
+    def get_songs_by_ids(self, song_ids):
+        return self.catalogue.get_songs_by_ids(song_ids)
+
+    def get_all_songs(self):
+        return self.catalogue.get_all_songs()
+
+    def get_songs_page(self, after_id=None, limit=50, search=None):
+        return self.catalogue.get_songs_page(after_id, limit, search)
+
+    def count_songs(self, search=None):
+        return self.catalogue.count_songs(search)
+
+class RemoteShard(StorageBackend):
+    # client side of a shard server process, one connection per calling thread
+
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+        self.local = threading.local()
+
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = Client(self.address, authkey=self.authkey)
+        return conn
+
+    def call(self, method, *args):
+        conn = self.connection()
+        conn.send((method, args))
+        status, result = conn.recv()
+
+        if status != "ok":
+            raise RuntimeError(f"Shard {self.address[0]}:{self.address[1]} failed in {method}: {result}")
+
+        return result
+
+    def add_song(self, name, artist, duration, thumbnail_url, youtube_url, dedupe=True):
+        return self.call("add_song", name, artist, duration, thumbnail_url, youtube_url, dedupe)
+
+    def link_song(self, song_id, original_id):
+        return self.call("link_song", song_id, original_id)
+
+    def add_hashes_batch(self, val_list):
+        return self.call("add_hashes_batch", val_list)
+
+    def replace_song_hashes(self, song_id, val_list):
+        return self.call("replace_song_hashes", song_id, val_list)
+
+    def lookup(self, hash_array):
+        return self.call("lookup", hash_array)
+
+    def get_matches_for_hashes(self, hash_values):
+        return self.call("get_matches_for_hashes", hash_values)
+
+    def get_song_by_id(self, song_id):
+        return self.call("get_song_by_id", song_id)
+
+    def get_songs_by_ids(self, song_ids):
+        return self.call("get_songs_by_ids", song_ids)
+
+    def get_all_songs(self):
+        return self.call("get_all_songs")
+
+    def get_songs_page(self, after_id=None, limit=50, search=None):
+        return self.call("get_songs_page", after_id, limit, search)
+
+    def count_songs(self, search=None):
+        return self.call("count_songs", search)
+
+def connect_shards(count):
+    # raises before connecting when SHARD_AUTHKEY is missing
+    authkey = shard_authkey()
+    return [RemoteShard(shard_address(i), authkey) for i in range(count)]
+
+def create_sharded_backend(count):
+    if config.SHARD_MODE == "process":
+        # shard servers started with "python -m database.sharding serve", songs live on shard 0
+        shards = connect_shards(count)
+        return ShardedBackend(shards[0], shards)
+
+    if config.SHARD_MODE == "mysql":
+        from database import db_handler
+
+        # every shard is its own schema next to pytone, songs stay in pytone.Song
+        for i in range(count):
+            db_handler.create_shard_table(shard_schema(count, i))
+
+        shards = [MySQLBackend(f"{shard_schema(count, i)}.Hash") for i in range(count)]
+        return ShardedBackend(MySQLBackend(), shards)
+
+    raise ValueError(f"Unknown shard mode: {config.SHARD_MODE}")
+
+def serve(count):
+    # one shard server process per shard on this box, until interrupted
+    # refuse to start without a shared key, the servers would fail one by one otherwise
+    shard_authkey()
+
+    processes = [
+        subprocess.Popen([sys.executable, "-m", "database.shard_server", "--count", str(count), "--index", str(i)])
+        for i in range(count)
+    ]
+
+    try:
+        for process in processes:
+            process.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+
+def wait_for_shards(count, timeout=30):
+    # block until every shard server accepts connections
+    deadline = time.perf_counter() + timeout
+    shards = connect_shards(count)
+
+    for shard in shards:
+        while True:
+            try:
+                shard.call("stats")
+                break
+            except (ConnectionRefusedError, OSError):
+                if time.perf_counter() > deadline:
+                    raise
+                time.sleep(0.1)
+
+    return shards
+
+def rebalance_processes(old_count, new_count):
+    # pull every posting from the running shard servers and write snapshots for the new layout
+    from database.memory_index import MemoryIndex
+    from database.index_snapshot import export_from_index
+
+    new_shards = [MemoryIndex() for _ in range(new_count)]
+    moved = 0
+
+    for i, shard in enumerate(connect_shards(old_count)):
+        keys, song_ids, offsets, songs = shard.call("dump")
+
+        if i == 0:
+            new_shards[0].songs = dict(songs)
+
+        owners = shard_of(keys, new_count)
+        for j, new_shard in enumerate(new_shards):
+            part = owners == j
+            if part.any():
+                new_shard.add_hash_arrays(keys[part], song_ids[part], offsets[part])
+
+            if j != i:
+                moved += int(part.sum())
+
+    os.makedirs(config.SHARD_DIR, exist_ok=True)
+    for j, new_shard in enumerate(new_shards):
+        export_from_index(shard_snapshot_path(new_count, j), new_shard)
+
+    return moved
+
+def rebalance_mysql(old_count, new_count):
+    # copy every row from the old shard schemas into the new ones, the old schemas are kept
+    from database import db_handler
+
+    config.SHARD_MODE = "mysql"
+    target = create_sharded_backend(new_count)
+    moved = 0
+
+    for i in range(old_count):
+        for rows in db_handler.iter_hash_rows(table_name=f"{shard_schema(old_count, i)}.Hash"):
+            parts = partition_rows(rows, new_count)
+            moved += sum(len(part) for j, part in enumerate(parts) if j != i)
+            target.scatter(lambda shard, part: shard.add_hashes_batch(part), parts)
+
+    return moved
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the hash-prefix shards.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser("serve", help="run the local shard server processes")
+    serve_parser.add_argument("--count", type=int, default=config.SHARD_COUNT)
+
+    save_parser = commands.add_parser("save", help="write every shard server's snapshot to SHARD_DIR")
+    save_parser.add_argument("--count", type=int, default=config.SHARD_COUNT)
+
+    rebalance_parser = commands.add_parser("rebalance", help="redistribute postings for a new shard count")
+    rebalance_parser.add_argument("--from", dest="old_count", type=int, default=config.SHARD_COUNT)
+    rebalance_parser.add_argument("--to", dest="new_count", type=int, required=True)
+    rebalance_parser.add_argument("--mode", choices=["mysql", "process"], default=config.SHARD_MODE)
+
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args.count)
+
+    elif args.command == "save":
+        for shard in connect_shards(args.count):
+            print(shard.call("save"))
+
+    elif args.command == "rebalance":
+        if args.mode == "process":
+            moved = rebalance_processes(args.old_count, args.new_count)
+            print(f"Wrote {args.new_count} shard snapshots to {config.SHARD_DIR}, {moved} postings changed shard")
+            print(f"Stop the servers, set SHARD_COUNT = {args.new_count} and run: python -m database.sharding serve")
+        else:
+            from database import db_handler
+
+            # initialize connection to the existing database
+            db_handler.prepare_db_handler()
+            db_handler.use_database()
+
+            moved = rebalance_mysql(args.old_count, args.new_count)
+            print(f"Copied shards into pytone_shard_{args.new_count}_*, {moved} rows changed shard")
+            print(f"Set SHARD_COUNT = {args.new_count}, the pytone_shard_{args.old_count}_* schemas can then be dropped")
@@ -0,0 +1,188 @@
+import re
+from abc import ABC, abstractmethod
+import numpy as np
+import config
+
+# active backend, created on first use
+backend = None
+
+def search_words(search):
+    # lowercase words of a library search, punctuation and full-text operators are dropped
+    # a song matches when every search word starts a word of its title or artist,
+    # like a "+word*" boolean full-text query
+    return re.findall(r"\w+", (search or "").lower())
+
+class StorageBackend(ABC):
+    # common interface for everything that stores songs and fingerprints
+
+    @abstractmethod
+    def add_song(self, name, artist, duration, thumbnail_url, youtube_url, dedupe=True):
+        # returns the song id, reusing the existing one with the same name and artist unless dedupe is off
+        pass
+
+    @abstractmethod
+    def add_hashes_batch(self, val_list):
+        # val_list holds (hash_value, song_id, offset_time) rows, false means they were not stored
+        pass
+
+    @abstractmethod
+    def get_matches_for_hashes(self, hash_values):
+        # returns {hash_value: [(song_id, offset_time), ...]}
+        pass
+
+    @abstractmethod
+    def replace_song_hashes(self, song_id, val_list):
+        # swaps a song's postings for val_list, returns the hash values it replaced or none on failure
+        pass
+
+    @abstractmethod
+    def get_song_by_id(self, song_id):
+        # returns (name, artist, duration, thumbnail_url, youtube_url) or none
+        pass
+
+    @abstractmethod
+    def get_all_songs(self):
+        # returns (name, artist, duration, thumbnail_url) rows, newest first
+        pass
+
+    @abstractmethod
+    def get_songs_page(self, after_id=None, limit=50, search=None):
+        # returns up to limit (id, name, artist, duration, thumbnail_url) rows, newest first,
+        # continuing below after_id (the last id of the previous page) and filtered by search
+        pass
+
+    @abstractmethod
+    def count_songs(self, search=None):
+        # number of songs matching search, all songs without one
+        pass
+
+    def add_hashes_bulk(self, val_list):
+        # high-throughput variant for large imports, backends without one reuse the batch insert
+        return self.add_hashes_batch(val_list)
+
+    def lookup(self, hash_array):
+        # array form of the bulk lookup: (query_index, song_ids, offsets) per hit
+        # backends that keep arrays natively override this
+        hash_values = hash_array.tolist()
+        hits_by_hash = self.get_matches_for_hashes(hash_values)
+
+        query_index, song_ids, offsets = [], [], []
+        for i, hash_value in enumerate(hash_values):
+            for song_id, offset_time in hits_by_hash.get(hash_value, ()):
+                query_index.append(i)
+                song_ids.append(song_id)
+                offsets.append(offset_time)
+
+        return (
+            np.array(query_index, dtype=np.int64),
+            np.array(song_ids, dtype=np.int32),
+            np.array(offsets, dtype=np.float32)
+        )
+
+    def link_song(self, song_id, original_id):
+        # records song_id as a duplicate of original_id, backends without links ignore it
+        pass
+
+    def record_fingerprint_params(self, song_id):
+        # marks song_id as fingerprinted with the current config, backends that keep no parameters ignore it
+        return True
+
+
+    def get_songs_by_ids(self, song_ids):
+        # returns {song_id: song row} for every known id
+        songs = {}
+        for song_id in song_ids:
+            song = self.get_song_by_id(song_id)
+            if song:
+                songs[song_id] = song
+
+        return songs
+
+class MySQLBackend(StorageBackend):
+    # thin wrapper over the module level mysql handler
+    # hash_table points a shard at its own schema, e.g. "pytone_shard_4_0.Hash"
+
+    def __init__(self, hash_table="Hash"):
+        from database import db_handler
+        self.db = db_handler
+        self.hash_table = hash_table
+
+    def add_song(self, name, artist, duration, thumbnail_url, youtube_url, dedupe=True):
+        return self.db.add_song(name, artist, duration, thumbnail_url, youtube_url, dedupe)
+
+    def add_hashes_batch(self, val_list):
+        return self.db.add_hashes_batch(val_list, self.hash_table)
+
+    def add_hashes_bulk(self, val_list):
+        # the staging-table loader only targets the main Hash table
+        if self.hash_table != "Hash":
+            return self.db.add_hashes_batch(val_list, self.hash_table)
+
+        return self.db.add_hashes_bulk(val_list)
+
+    def get_matches_for_hashes(self, hash_values):
+        return self.db.get_matches_for_hashes(hash_values, table_name=self.hash_table)
+
+    def replace_song_hashes(self, song_id, val_list):
+        return self.db.replace_song_hashes(song_id, val_list, self.hash_table)
+
+    def link_song(self, song_id, original_id):
+        return self.db.link_song(song_id, original_id)
+
+    def record_fingerprint_params(self, song_id):
+        return self.db.record_fingerprint_params(song_id)
+
+    def get_song_by_id(self, song_id):
+        return self.db.get_song_by_id(song_id)
+
+    def get_all_songs(self):
+        return self.db.get_all_songs()
+
+    def get_songs_page(self, after_id=None, limit=50, search=None):
+        return self.db.get_songs_page(after_id, limit, search)
+
+    def count_songs(self, search=None):
+        return self.db.count_songs(search)
+
+    def get_songs_by_ids(self, song_ids):
+        return self.db.get_songs_by_ids(song_ids)
+
+def create_backend(name):
+    if name == "mysql":
+        return MySQLBackend()
+
+    if name == "memory":
+        from database.memory_index import MemoryIndex
+        return MemoryIndex()
+
+    if name == "snapshot":
+        # read-only file, songs trained at runtime live in memory until the process exits
+        from database.index_snapshot import load_snapshot
+        return load_snapshot(config.INDEX_SNAPSHOT_PATH)
+
+    if name == "sharded":
+        from database.sharding import create_sharded_backend
+        return create_sharded_backend(config.SHARD_COUNT)
+
+    raise ValueError(f"Unknown storage backend: {name}")
+
+def uses_mysql():
+    # the mysql backend and mysql shards both need db_handler's pool before their first query
+    return config.STORAGE_BACKEND == "mysql" or (config.STORAGE_BACKEND == "sharded" and config.SHARD_MODE == "mysql")
+
+def get_backend():
+    global backend
+
+    if backend is None:
+        backend = create_backend(config.STORAGE_BACKEND)
+
+        if config.CACHE_ENABLED:
+            from database.cache import create_cached_backend
+            backend = create_cached_backend(backend)
+
+    return backend
+
+def set_backend(new_backend):
+    # swap the active backend, e.g. for a prebuilt index or in tests
+    global backend
+    backend = new_backend
@@ -0,0 +1,179 @@
+import io
+import os
+import time
+import queue
+import argparse
+import threading
+import soundfile
+from concurrent.futures import Future, ProcessPoolExecutor
+from flask import Flask, request, jsonify
+import config
+from core import fingerprinter
+from core.audio_loader import load_array
+from database import storage
+from engine import matcher
+from utils import metrics
+
+# how long the first query of a batch waits for others to join it
+BATCH_WINDOW = 0.01
+MAX_BATCH_SIZE = 64
+
+def init_worker():
+    # the pool already keeps every core busy, one fft thread per process
+    config.FFT_WORKERS = 1
+
+def warm_up():
+    fingerprinter.warm_up()
+    return os.getpid()
+
+def fingerprint_upload(data):
+    # runs in a worker process: decode the uploaded file in memory and fingerprint it
+    try:
+        audio, rate = soundfile.read(io.BytesIO(data), dtype="float32")
+    except soundfile.SoundFileError as err:
+        # plain ValueError, libsndfile's exception types do not survive the trip back
+        raise ValueError(f"Could not decode audio: {err}") from None
+    return fingerprinter.fingerprint_signal(load_array(rate, audio))
+
+class MatchBatcher:
+    # coalesces queries arriving within batch_window into one lookup and one scoring pass
+
+    def __init__(self, batch_window=BATCH_WINDOW, max_batch_size=MAX_BATCH_SIZE):
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.queue = queue.Queue()
+
+        self.batches = 0
+        self.queries = 0
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, hash_array, offset_array):
+        future = Future()
+        self.queue.put((hash_array, offset_array, future))
+        return future
+
+    def collect(self):
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.batch_window
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+
+            try:
+                results = matcher.identify_batch([(h, o) for h, o, _ in batch])
+            except Exception as err:
+                for _, _, future in batch:
+                    future.set_exception(err)
+                continue
+
+            self.batches += 1
+            self.queries += len(batch)
+            metrics.count("api_batches")
+            metrics.count("api_batched_queries", len(batch))
+
+            for (_, _, future), ranked in zip(batch, results):
+                future.set_result(ranked)
+
+class IdentificationService:
+    # pre-warmed fingerprint processes in front of the shared match batcher
+
+    def __init__(self, workers=None, batch_window=BATCH_WINDOW, max_batch_size=MAX_BATCH_SIZE):
+        self.workers = workers or os.cpu_count()
+
+        # create the pool before any server threads exist, then start every process
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker)
+        for future in [self.pool.submit(warm_up) for _ in range(self.workers)]:
+            future.result()
+
+        self.batcher = MatchBatcher(batch_window, max_batch_size)
+
+    def identify(self, data):
+        hash_array, offset_array = self.pool.submit(fingerprint_upload, data).result()
+
+        if len(hash_array) == 0:
+            return []
+
+        return self.batcher.submit(hash_array, offset_array).result()
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+def create_app(service):
+    app = Flask("pytone_api")
+    app.config["MAX_CONTENT_LENGTH"] = config.API_MAX_UPLOAD_BYTES
+
+    @app.errorhandler(413)
+    def upload_too_large(err):
+        return jsonify(error=f"Upload larger than {config.API_MAX_UPLOAD_BYTES} bytes."), 413
+
+    @app.route("/identify", methods=["POST"])
+    def identify():
+        # multipart upload in the "audio" field, or the raw file as the request body
+        upload = request.files.get("audio")
+        data = upload.read() if upload else request.get_data()
+
+        if not data:
+            return jsonify(error="No audio uploaded."), 400
+
+        with metrics.timer("api_request"):
+            try:
+                matches = service.identify(data)
+            except ValueError as err:
+                return jsonify(error=str(err)), 400
+
+        return jsonify(match=matches[0] if matches else None, matches=matches)
+
+    @app.route("/health")
+    def health():
+        return jsonify(status="ok", workers=service.workers, batches=service.batcher.batches, queries=service.batcher.queries)
+
+    @app.route("/metrics")
+    def metrics_endpoint():
+        return metrics.render_prometheus(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+    return app
+
+def create_server(host, port, workers=None, batch_window=BATCH_WINDOW):
+    # threaded wsgi server, each request thread waits on the pool and the batcher
+    from werkzeug.serving import make_server
+
+    service = IdentificationService(workers, batch_window)
+    return make_server(host, port, create_app(service), threaded=True), service
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HTTP identification API.")
+    parser.add_argument("--host", default=config.API_HOST, help="set 0.0.0.0 to serve other machines")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=None, help="fingerprint processes (default: cpu count)")
+    parser.add_argument("--batch-window-ms", type=float, default=BATCH_WINDOW * 1000, help="how long a lookup waits for other queries")
+    args = parser.parse_args()
+
+    if storage.uses_mysql():
+        from database import db_handler
+
+        # initialize connection to the existing database
+        db_handler.prepare_db_handler()
+        db_handler.use_database()
+
+    server, service = create_server(args.host, args.port, args.workers, args.batch_window_ms / 1000)
+    print(f"Serving on http://{args.host}:{args.port}/identify with {service.workers} fingerprint workers")
+
+    try:
+        server.serve_forever()
+    finally:
+        service.shutdown()
@@ -1,77 +1,222 @@
-from database import db_handler
-from collections import Counter
-
-def find_potential_matches(sample_hashes):
-    matches_found = {}
-
-    for hash_value, t_sample in sample_hashes:
-        # fetch all occurrences of this hash from db
-        database_hits = db_handler.get_matches_from_hash(hash_value)
-        
-        if not database_hits:
-            continue
-            
-        for song_id, t_db in database_hits:
-            # calculate the relative offset
-            # if the song matches, (t_db - t_sample) should be constant
-            offset = t_db - t_sample
-            
-            # quantize offset to 0.1s to handle float inaccuracies
-            offset_bin = round(offset, 1)
-            
-            if song_id not in matches_found:
-                matches_found[song_id] = []
-            
-            matches_found[song_id].append(offset_bin)
-
-    return matches_found
-
-def rank_matches(matches_found):
+import numpy as np
+import config
+from database import storage
+from utils import metrics
+
+# minimum number of aligned hashes for a song to count as a match
+MIN_MATCH_SCORE = 10
+# number of ranked candidates returned by rank_matches
+MATCH_TOP_K = 10
+
+def find_potential_matches(hash_array, offset_array):
+    _, song_ids, offset_bins = lookup_offsets(hash_array, offset_array)
+    return song_ids, offset_bins
+
+def lookup_offsets(hash_array, offset_array):
+    # fetch all occurrences of every sample hash from db in bulk
+    with metrics.timer("lookup"):
+        query_index, song_ids, t_db = storage.get_backend().lookup(hash_array)
+
+    metrics.count("hashes_queried", len(hash_array))
+    metrics.count("db_hits", len(song_ids))
+
+    # calculate the relative offset
+    # if the song matches, (t_db - t_sample) should be constant
+    offsets = t_db - offset_array[query_index]
+
+    # quantize offset to 0.1s bins to handle float inaccuracies
+    offset_bins = np.rint(offsets * 10).astype(np.int64)
+
+    return query_index, song_ids, offset_bins
+
+def find_potential_matches_batch(fingerprints):
+    # one bulk lookup for the (hash_array, offset_array) of many queries
+    # returns the query each hit belongs to next to its song and offset bin
+    if not fingerprints:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int64)
+
+    hash_array = np.concatenate([fp[0] for fp in fingerprints])
+    offset_array = np.concatenate([fp[1] for fp in fingerprints])
+    query_of_hash = np.repeat(np.arange(len(fingerprints)), [len(fp[0]) for fp in fingerprints])
+
+    query_index, song_ids, offset_bins = lookup_offsets(hash_array, offset_array)
+
+    return query_of_hash[query_index], song_ids, offset_bins
+
+def best_offsets(keys, counts, span, min_bin):
+    # keys are sorted (song_id, offset_bin) histogram keys with their counts
+    key_songs = keys // span
+
+    # the most common offset per song is the 'score' of the match
+    # keys are sorted by song, so order each song's bins by count
+    order = np.lexsort((-counts, key_songs))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = key_songs[order][1:] != key_songs[order][:-1]
+    best = order[first]
+
+    return key_songs[best], counts[best], keys[best] % span + min_bin
+
+def build_results(song_ids, scores, offset_bins, top_k=MATCH_TOP_K):
+    # increased threshold: with ~3000 hashes, a real match should have >10 hits
+    passing = scores >= MIN_MATCH_SCORE
+
+    # take the top k, highest score first
+    top = np.flatnonzero(passing)
+    top = top[np.argsort(-scores[top], kind='stable')][:top_k]
+
+    # fetch metadata for the final candidates in one query
+    top_songs = song_ids[top].tolist()
+    songs = storage.get_backend().get_songs_by_ids(top_songs)
+
     final_results = []
+    for song_id, score, offset_bin in zip(top_songs, scores[top].tolist(), offset_bins[top].tolist()):
+        song_info = songs.get(song_id)
 
-    for song_id, offsets in matches_found.items():
-        # count the occurences of the most common offset
-        # this is the 'score' of the match
-        offset_counts = Counter(offsets)
-        best_offset, peak_score = offset_counts.most_common(1)[0]
-        
-        # increased threshold: with ~3000 hashes, a real match should have >10 hits
-        if peak_score < 10:
-            continue
-        
-        song_info = db_handler.get_song_by_id(song_id)
-        
         if song_info:
-            final_results.append({
-                "title": song_info[0],
-                "artist": song_info[1],
-                "dur": song_info[2],
-                "img": song_info[3],
-                "url": song_info[4],
-                "score": peak_score,
-                "offset": best_offset
-            })
-
-    # sort by highest score first
-    final_results.sort(key=lambda x: x['score'], reverse=True)
-    
+            final_results.append(format_result(song_info, score, offset_bin))
+
     return final_results
 
+def format_result(song_info, score, offset_bin):
+    return {
+        "title": song_info[0],
+        "artist": song_info[1],
+        "dur": song_info[2],
+        "img": song_info[3],
+        "url": song_info[4],
+        "score": score,
+        "offset": round(offset_bin / 10, 1)
+    }
+
+def rank_matches(song_ids, offset_bins, top_k=MATCH_TOP_K):
+    if len(song_ids) == 0:
+        return []
+
+    with metrics.timer("rank"):
+        return score_matches(song_ids, offset_bins, top_k)
+
+def score_matches(song_ids, offset_bins, top_k):
+    # combine (song_id, offset_bin) into one integer key and count each key
+    min_bin = offset_bins.min()
+    span = int(offset_bins.max() - min_bin) + 1
+    keys = song_ids.astype(np.int64) * span + (offset_bins - min_bin)
+
+    unique_keys, counts = np.unique(keys, return_counts=True)
+
+    best_songs, scores, best_bins = best_offsets(unique_keys, counts, span, min_bin)
+    metrics.count("candidates_scored", len(best_songs))
+
+    return build_results(best_songs, scores, best_bins, top_k)
+
+def rank_matches_batch(query_ids, song_ids, offset_bins, num_queries, top_k=MATCH_TOP_K):
+    # one scoring pass for many queries, the query id becomes part of the song key
+    results = [[] for _ in range(num_queries)]
+    if len(song_ids) == 0:
+        return results
+
+    with metrics.timer("rank"):
+        song_span = int(song_ids.max()) + 1
+        query_songs = query_ids.astype(np.int64) * song_span + song_ids
+
+        min_bin = offset_bins.min()
+        span = int(offset_bins.max() - min_bin) + 1
+        keys = query_songs * span + (offset_bins - min_bin)
+
+        unique_keys, counts = np.unique(keys, return_counts=True)
+
+        best, scores, best_bins = best_offsets(unique_keys, counts, span, min_bin)
+        metrics.count("candidates_scored", len(best))
+
+        # passing candidates grouped by query, highest score first within each
+        top = np.flatnonzero(scores >= MIN_MATCH_SCORE)
+        top = top[np.lexsort((-scores[top], best[top] // song_span))]
+
+        # keep the first top_k of every query
+        queries = best[top] // song_span
+        starts = np.flatnonzero(np.r_[True, queries[1:] != queries[:-1]])
+        rank = np.arange(len(top)) - np.repeat(starts, np.diff(np.r_[starts, len(top)]))
+        top = top[rank < top_k]
+
+    # metadata for every query's candidates in one fetch
+    top_songs = (best[top] % song_span).tolist()
+    songs = storage.get_backend().get_songs_by_ids(list(dict.fromkeys(top_songs)))
+
+    for query, song_id, score, offset_bin in zip((best[top] // song_span).tolist(), top_songs, scores[top].tolist(), best_bins[top].tolist()):
+        song_info = songs.get(song_id)
+
+        if song_info:
+            results[query].append(format_result(song_info, score, offset_bin))
+
+    return results
+
+def identify_batch(fingerprints, top_k=MATCH_TOP_K):
+    # ranked matches for every (hash_array, offset_array), sharing one lookup and one scoring pass
+    query_ids, song_ids, offset_bins = find_potential_matches_batch(fingerprints)
+
+    return rank_matches_batch(query_ids, song_ids, offset_bins, len(fingerprints), top_k)
+
+def find_duplicate(hash_array, offset_array, backend=None):
+    # self-match a new song's fingerprint against the index before it is stored
+    # returns (song_id, score) of the best aligned existing song, or None below DUPLICATE_MIN_SCORE
+    if len(hash_array) == 0:
+        return None
+
+    # an even spread of hashes is enough, a copy aligns the same share of any subset
+    step = max(len(hash_array) // config.DUPLICATE_PROBE_HASHES, 1)
+    probe_hashes = hash_array[::step]
+    probe_offsets = offset_array[::step]
+
+    backend = backend or storage.get_backend()
+    with metrics.timer("duplicate_check"):
+        query_index, song_ids, t_db = backend.lookup(probe_hashes)
+
+    if len(song_ids) == 0:
+        return None
+
+    offset_bins = np.rint((t_db - probe_offsets[query_index]) * 10).astype(np.int64)
+
+    min_bin = offset_bins.min()
+    span = int(offset_bins.max() - min_bin) + 1
+    keys = song_ids.astype(np.int64) * span + (offset_bins - min_bin)
+    unique_keys, counts = np.unique(keys, return_counts=True)
+
+    best_songs, scores, _ = best_offsets(unique_keys, counts, span, min_bin)
+    best = int(np.argmax(scores))
+    score = float(scores[best]) / len(probe_hashes)
+
+    if scores[best] < MIN_MATCH_SCORE or score < config.DUPLICATE_MIN_SCORE:
+        return None
+
+    return int(best_songs[best]), score
+
 def identify_song(file_path):
     # local import
     from core.fingerprinter import process_audio
-    
-    sample_hashes = process_audio(file_path)
-    
-    if not sample_hashes:
+
+    metrics.count("identifications")
+
+    with metrics.timer("identify"):
+        return match_fingerprint(*process_audio(file_path))
+
+def identify_array(rate, data):
+    # same as identify_song for an in-memory (rate, ndarray) recording
+    from core.fingerprinter import process_array
+
+    metrics.count("identifications")
+
+    with metrics.timer("identify"):
+        return match_fingerprint(*process_array(rate, data))
+
+def match_fingerprint(hash_array, offset_array):
+    if len(hash_array) == 0:
         return None
 
-    matches = find_potential_matches(sample_hashes)
+    song_ids, offset_bins = find_potential_matches(hash_array, offset_array)
     
-    if not matches:
+    if len(song_ids) == 0:
         return None
 
-    ranked_list = rank_matches(matches)
+    ranked_list = rank_matches(song_ids, offset_bins)
 
     if ranked_list:
         return ranked_list[0]
@@ -0,0 +1,196 @@
+import numpy as np
+import soxr
+import config
+from core import fingerprinter
+from core.audio_loader import pcm_to_mono
+from engine import matcher
+
+# histogram keys are song_id * OFFSET_SPAN + offset_bin + OFFSET_SPAN // 2
+# 2^24 bins of 0.1s covers offsets of +-9 days
+OFFSET_SPAN = 1 << 24
+
+class StreamingIdentifier:
+    # identifies a song from audio chunks as they arrive
+    # spectrogram frames, peaks and the offset histogram carry over between chunks
+
+    def __init__(self, rate, confidence_margin=None, min_score=None):
+        self.rate = rate
+        self.confidence_margin = confidence_margin or config.STREAM_CONFIDENCE_MARGIN
+        self.min_score = min_score or matcher.MIN_MATCH_SCORE
+
+        self.window = config.FFT_WINDOW_SIZE
+        self.hop = fingerprinter.frame_hop()
+
+        # one resampler for the whole recording, its filter state carries over chunk edges
+        self.resampler = None
+        if rate != config.SAMPLE_RATE:
+            self.resampler = soxr.ResampleStream(rate, config.SAMPLE_RATE, 1, dtype="float32")
+
+        # samples not yet covered by a complete frame, and their absolute position
+        self.samples = np.empty(0)
+        self.sample_start = 0
+
+        # recent log-magnitude frames with their times, frame_offset is the index of the first
+        self.frames = []
+        self.frame_times = []
+        self.frame_offset = 0
+        self.freqs = None
+        self.frame_sum = 0.0
+        self.frame_values = 0
+
+        # frames whose peaks are final, and the peaks themselves
+        self.peaks_done = 0
+        self.peak_times = np.empty(0)
+        self.peak_freqs = np.empty(0)
+
+        # anchors whose hashes were already matched
+        self.anchors_done = 0
+
+        # offset histogram as sorted keys with counts
+        self.hist_keys = np.empty(0, dtype=np.int64)
+        self.hist_counts = np.empty(0, dtype=np.int64)
+
+        self.result = None
+
+    def add_chunk(self, data):
+        # returns the match once it is confident, otherwise none
+        if self.result is not None:
+            return self.result
+
+        signal = pcm_to_mono(data)
+        if self.resampler:
+            signal = self.resampler.resample_chunk(signal)
+
+        self.samples = np.concatenate([self.samples, signal])
+
+        self.update_frames()
+        self.update_peaks(final=False)
+        self.update_matches(final=False)
+
+        return self.check_confidence()
+
+    def finish(self):
+        # flush the tail and return the best candidate, confident or not
+        if self.result is not None:
+            return self.result
+
+        # samples the resampler still holds back
+        if self.resampler:
+            self.samples = np.concatenate([self.samples, self.resampler.resample_chunk(np.empty(0, dtype=np.float32), last=True)])
+            self.update_frames()
+
+        self.update_peaks(final=True)
+        self.update_matches(final=True)
+
+        results = self.ranked()
+        return results[0] if results else None
+
+    def update_frames(self):
+        if len(self.samples) < self.window:
+            return
+
+        # only transform complete frames, keep the remainder for the next chunk
+        num_frames = 1 + (len(self.samples) - self.window) // self.hop
+        used = self.window + (num_frames - 1) * self.hop
+
+        S, f, _ = fingerprinter.spectogram(self.samples[:used])
+
+        self.freqs = f
+        self.frames.append(S)
+        self.frame_times.append(fingerprinter.frame_times(self.sample_start // self.hop, num_frames))
+        self.frame_sum += S.sum()
+        self.frame_values += S.size
+
+        consumed = num_frames * self.hop
+        self.samples = self.samples[consumed:]
+        self.sample_start += consumed
+
+    def update_peaks(self, final):
+        if not self.frames:
+            return
+
+        S = np.concatenate(self.frames, axis=1)
+        t = np.concatenate(self.frame_times)
+
+        # a frame is final once the filter window no longer reaches unseen frames
+        total = self.frame_offset + S.shape[1]
+        end = total
+        if not final:
+            start = self.peaks_done - self.frame_offset
+            end = self.frame_offset + fingerprinter.hold_open_second(t, start, S.shape[1] - fingerprinter.PEAK_CONTEXT)
+
+        if end > self.peaks_done:
+            # running mean stands in for the whole-clip mean threshold
+            peak_times, peak_freqs = fingerprinter.block_peaks(
+                S, self.freqs, t, self.frame_sum / self.frame_values,
+                self.peaks_done - self.frame_offset, end - self.frame_offset
+            )
+            self.peak_times = np.concatenate([self.peak_times, peak_times])
+            self.peak_freqs = np.concatenate([self.peak_freqs, peak_freqs])
+            self.peaks_done = end
+
+            # keep only the history the next pass needs
+            keep = max(self.frame_offset, end - fingerprinter.PEAK_CONTEXT)
+            S = S[:, keep - self.frame_offset:]
+            t = t[keep - self.frame_offset:]
+            self.frame_offset = keep
+
+        self.frames = [S]
+        self.frame_times = [t]
+
+    def update_matches(self, final):
+        # an anchor is complete once all of its fan-out targets exist
+        num_peaks = len(self.peak_times)
+        end = num_peaks if final else max(0, num_peaks - (config.FAN_VALUE - 1))
+        if end <= self.anchors_done:
+            return
+
+        hash_array, offset_array = fingerprinter.generate_hashes(
+            (self.peak_times, self.peak_freqs), self.anchors_done, end
+        )
+        self.anchors_done = end
+
+        if len(hash_array) == 0:
+            return
+
+        song_ids, offset_bins = matcher.find_potential_matches(hash_array, offset_array)
+        if len(song_ids) == 0:
+            return
+
+        # merge this chunk's hits into the running histogram
+        keys = song_ids.astype(np.int64) * OFFSET_SPAN + offset_bins + OFFSET_SPAN // 2
+        new_keys, new_counts = np.unique(keys, return_counts=True)
+
+        merged_keys = np.concatenate([self.hist_keys, new_keys])
+        merged_counts = np.concatenate([self.hist_counts, new_counts])
+        self.hist_keys, inverse = np.unique(merged_keys, return_inverse=True)
+        self.hist_counts = np.bincount(inverse, weights=merged_counts).astype(np.int64)
+
+    def best_scores(self):
+        return matcher.best_offsets(self.hist_keys, self.hist_counts, OFFSET_SPAN, -(OFFSET_SPAN // 2))
+
+    def ranked(self):
+        if len(self.hist_keys) == 0:
+            return []
+
+        return matcher.build_results(*self.best_scores())
+
+    def check_confidence(self):
+        if len(self.hist_keys) == 0:
+            return None
+
+        song_ids, scores, offset_bins = self.best_scores()
+
+        order = np.argsort(-scores, kind='stable')
+        best = scores[order[0]]
+        runner_up = scores[order[1]] if len(order) > 1 else 0
+
+        # answer early only when the leader clearly beats the runner-up
+        if best < self.min_score or best < self.confidence_margin * max(runner_up, 1):
+            return None
+
+        results = matcher.build_results(song_ids[order[:1]], scores[order[:1]], offset_bins[order[:1]])
+        if results:
+            self.result = results[0]
+
+        return self.result
@@ -3,13 +3,13 @@ import utils.youtube_fetcher as yt
 import time
 import random
 import traceback
-import os
-import yt_dlp
-import scipy.io.wavfile
+import json
+import config
 from engine import matcher
-from core import fingerprinter
+from engine.stream_matcher import StreamingIdentifier
 
-from database import db_handler
+from database import storage
+from utils import metrics, fingerprint_cache
 
 def identify_from_youtube(url):
     if not url:
@@ -25,57 +25,117 @@ def identify_from_youtube(url):
         # unpack metadata
         title, artist, duration, thumbnail, yt_url = song_data
 
-        # options to download audio for training
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'outtmpl': 'temp_train.%(ext)s',
-            'postprocessors': [{'key': 'FFmpegExtractAudio','preferredcodec': 'wav',}],
-            'quiet': True,
-        }
+        # download and fingerprint, or reuse the cached result of an earlier request for this video
+        hash_array, offset_array = fingerprint_cache.fingerprint_url(url)
 
-        # download audio to temp file
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
+        backend = storage.get_backend()
+        duplicate_note = ""
+
+        # re-uploads and differently titled copies are caught by their fingerprint
+        if config.DUPLICATE_ACTION != "insert":
+            duplicate = matcher.find_duplicate(hash_array, offset_array)
+            if duplicate:
+                original_id, score = duplicate
+                original = backend.get_song_by_id(original_id)
+
+                # the original's metadata can be missing (lookup error, deleted song), store the song normally then
+                if original is not None:
+                    return store_duplicate(duplicate, original, title, artist, duration, thumbnail, yt_url)
+
+                duplicate_note = f"\nPossible duplicate of song ID {original_id} ({score:.0%})"
 
         # save song to db
-        song_id = db_handler.add_song(title, artist, duration, thumbnail, yt_url)
-        
+        song_id = backend.add_song(title, artist, duration, thumbnail, yt_url)
+
         if song_id:
-            # process audio to generate hashes
-            hashes = fingerprinter.process_audio("temp_train.wav")
-            
             # prepare data for batch insert
-            batch_data = [(h, song_id, o) for h, o in hashes]
+            batch_data = [(h, song_id, o) for h, o in zip(hash_array.tolist(), offset_array.tolist())]
             
             # fast insert
-            db_handler.add_hashes_batch(batch_data)
-
-            # cleanup temp file
-            if os.path.exists("temp_train.wav"):
-                os.remove("temp_train.wav")
+            backend.add_hashes_batch(batch_data)
 
-            return f"SUCCESS! Saved to DB:\nTitle: {title}\nArtist: {artist}\nID: {song_id}\nHashes: {len(hashes)}"
+            return f"SUCCESS! Saved to DB:\nTitle: {title}\nArtist: {artist}\nID: {song_id}\nHashes: {len(hash_array)}{duplicate_note}"
         else:
             return "Error: Database save failed."
 
     except Exception as e:
         return f"Error: {traceback.format_exc()}"
     
-def load_library_view():
+def store_duplicate(duplicate, original, title, artist, duration, thumbnail, yt_url):
+    original_id, score = duplicate
+    backend = storage.get_backend()
+
+    message = f"DUPLICATE of a saved song:\nTitle: {original[0]}\nArtist: {original[1]}\nID: {original_id}\nMatch: {score:.0%}"
+
+    if config.DUPLICATE_ACTION == "link":
+        # keep the new metadata, pointing at the original instead of storing its hashes again
+        song_id = backend.add_song(title, artist, duration, thumbnail, yt_url)
+
+        if song_id and song_id != original_id:
+            backend.link_song(song_id, original_id)
+            message += f"\nLinked as ID: {song_id}"
+
+    return message
+
+def render_library_page(search, pages):
+    # pages holds the keyset cursor of every visited page (none for the first), the last one is shown
+    page_size = config.LIBRARY_PAGE_SIZE
+
     try:
-        songs = db_handler.get_all_songs()
-        
-        if not songs:
-            return "<h3 style='color: white; text-align: center;'>Library is empty. Train some songs first!</h3>"
-        
-        html_output = ""
-        for s in songs:
-            # s is tuple (name, artist, duration, thumbnail_url)
-            html_output += create_list_style_card(s[3], s[0], s[1], s[2])
-            
-        return html_output
+        backend = storage.get_backend()
+
+        # one extra row tells whether there is a next page
+        songs = backend.get_songs_page(pages[-1], page_size + 1, search)
+        total = backend.count_songs(search)
     except Exception as e:
-        return f"<p style='color: red;'>Error loading library: {str(e)}</p>"
+        error = f"<p style='color: red;'>Error loading library: {str(e)}</p>"
+        return error, "", gr.update(interactive=False), gr.update(interactive=False), {"pages": [None], "next": None, "search": search}
+
+    has_next = len(songs) > page_size
+    songs = songs[:page_size]
+
+    if not songs and search:
+        html_output = "<h3 style='color: white; text-align: center;'>No songs match your search.</h3>"
+    elif not songs:
+        html_output = "<h3 style='color: white; text-align: center;'>Library is empty. Train some songs first!</h3>"
+    else:
+        # s is tuple (id, name, artist, duration, thumbnail_url)
+        html_output = "".join(create_list_style_card(s[4], s[1], s[2], s[3]) for s in songs)
+
+    first = (len(pages) - 1) * page_size + 1
+    page_info = f"Songs {first}–{first + len(songs) - 1} of {total}" if songs else f"0 of {total} songs"
+
+    state = {"pages": pages, "next": songs[-1][0] if has_next else None, "search": search}
+
+    return html_output, page_info, gr.update(interactive=len(pages) > 1), gr.update(interactive=has_next), state
+
+def load_library_first_page(search):
+    return render_library_page(search, [None])
+
+def search_changed(search, library):
+    # the cursors belong to the search they were made for, edited text starts at the first page
+    return (search or "") != (library.get("search") or "")
+
+def load_library_current_page(search, library):
+    if search_changed(search, library):
+        return load_library_first_page(search)
+
+    return render_library_page(search, library["pages"])
+
+def load_library_next_page(search, library):
+    if search_changed(search, library):
+        return load_library_first_page(search)
+
+    if library["next"] is None:
+        return render_library_page(search, library["pages"])
+
+    return render_library_page(search, library["pages"] + [library["next"]])
+
+def load_library_previous_page(search, library):
+    if search_changed(search, library):
+        return load_library_first_page(search)
+
+    return render_library_page(search, library["pages"][:-1] or [None])
 
 def process_identification(audio, history_list):
     if audio is None:
@@ -85,31 +145,48 @@ def process_identification(audio, history_list):
     # unpack gradio audio (rate, data)
     rate, data = audio
     
-    # save temp wav file for processing
-    scipy.io.wavfile.write("temp_rec.wav", rate, data)
-    
-    # identify song using matcher
-    data = matcher.identify_song("temp_rec.wav")
-    
-    # cleanup recording
-    if os.path.exists("temp_rec.wav"):
-        os.remove("temp_rec.wav")
+    # identify the recording straight from memory, traced for the debug panel
+    with metrics.trace():
+        data = matcher.identify_array(rate, data)
 
     # check if match found
     if not data:
         gr.Warning("No match found in library.")
         return gr.update(), gr.update(visible=True), gr.update(visible=False), gr.update(), history_list, gr.update()
 
+    return show_match(data, history_list)
+
+def process_live_chunk(chunk, identifier, history_list):
+    # streaming microphone: feed each chunk until the identifier is confident
+    if chunk is None or (identifier is not None and identifier.result is not None):
+        return gr.update(), gr.update(), gr.update(), gr.update(), history_list, gr.update(), identifier
+
+    # unpack gradio audio (rate, data)
+    rate, data = chunk
+
+    # new recording, start with fresh state
+    if identifier is None:
+        identifier = StreamingIdentifier(rate)
+
+    data = identifier.add_chunk(data)
+
+    if not data:
+        return gr.update(), gr.update(), gr.update(), gr.update(), history_list, gr.update(), identifier
+
+    return show_match(data, history_list) + (identifier,)
+
+def reset_live_identifier():
+    return None
+
+def show_match(data, history_list):
     # create apple style card
     apple_card_html = create_music_card(data["img"], data["title"], data["artist"], data["dur"])
 
-    # update history
-    history_list.insert(0, data)
-    
-    # regenerate history html
-    history_html_content = ""
-    for song in history_list:
-        history_html_content += create_list_style_card(song["img"], song["title"], song["artist"], song["dur"])
+    # history keeps rendered cards, only the new match is rendered
+    history_list.insert(0, create_list_style_card(data["img"], data["title"], data["artist"], data["dur"]))
+    del history_list[config.HISTORY_MAX_ITEMS:]
+
+    history_html_content = "".join(history_list)
 
     # return updated ui elements
     return (
@@ -121,6 +198,19 @@ def process_identification(audio, history_list):
         gr.update(link=data["url"], visible=True)
     )
 
+def load_debug_view():
+    # stage timings of the last identification plus the global counters
+    trace = metrics.last_trace or {}
+    summary = {key: value for key, value in trace.items() if key not in ("profile", "memory_top")}
+
+    report = json.dumps(summary, indent=2)
+    if "profile" in trace:
+        report += "\n\n" + trace["profile"]
+    if "memory_top" in trace:
+        report += "\n\n" + "\n".join(trace["memory_top"])
+
+    return report, metrics.render_prometheus()
+
 def close_overlay():
     # back button action
     return gr.update(visible=True), gr.update(visible=False)
@@ -231,6 +321,15 @@ with gr.Blocks(
                     variant="primary",
                     size="lg"
                 )
+
+                # answers as soon as the match is confident, usually after 2-3 seconds
+                live_mic = gr.Audio(
+                    sources=["microphone"],
+                    type="numpy",
+                    streaming=True,
+                    label="Listen live"
+                )
+                live_state = gr.State(None)
             
             with gr.Column(visible=False) as result_container:
                 gr.HTML("<br>")
@@ -265,16 +364,57 @@ with gr.Blocks(
 
         with gr.Tab("Library"):
             gr.Markdown("### Song Library")
-            refresh_lib_btn = gr.Button("Refresh", size="sm")
+            library_state = gr.State({"pages": [None], "next": None, "search": ""})
+
+            with gr.Row():
+                library_search = gr.Textbox(placeholder="Search by title or artist", show_label=False, scale=4)
+                refresh_lib_btn = gr.Button("Refresh", size="sm", scale=1)
+
+            library_output = gr.HTML()
 
-            library_output = gr.HTML(value=load_library_view)
+            with gr.Row():
+                prev_page_btn = gr.Button("Previous", size="sm", interactive=False)
+                library_page_info = gr.Markdown()
+                next_page_btn = gr.Button("Next", size="sm", interactive=False)
+
+            library_outputs = [library_output, library_page_info, prev_page_btn, next_page_btn, library_state]
+
+            library_search.submit(
+                fn=load_library_first_page,
+                inputs=[library_search],
+                outputs=library_outputs
+            )
 
             refresh_lib_btn.click(
-                fn=load_library_view,
-                inputs=[],
-                outputs=library_output
+                fn=load_library_current_page,
+                inputs=[library_search, library_state],
+                outputs=library_outputs
+            )
+
+            next_page_btn.click(
+                fn=load_library_next_page,
+                inputs=[library_search, library_state],
+                outputs=library_outputs
+            )
+
+            prev_page_btn.click(
+                fn=load_library_previous_page,
+                inputs=[library_search, library_state],
+                outputs=library_outputs
             )
 
+        if config.METRICS_DEBUG_PANEL:
+            with gr.Tab("Debug"):
+                refresh_debug_btn = gr.Button("Refresh", size="sm")
+                debug_trace = gr.Code(label="Last identification", language="json")
+                debug_metrics = gr.Code(label="Metrics")
+
+                refresh_debug_btn.click(
+                    fn=load_debug_view,
+                    inputs=[],
+                    outputs=[debug_trace, debug_metrics]
+                )
+
     listen_btn.click(
         fn = process_identification,
         inputs=[mic_input, history_state],
@@ -288,6 +428,34 @@ with gr.Blocks(
         ]
     )
 
+    live_mic.start_recording(
+        fn=reset_live_identifier,
+        inputs=[],
+        outputs=live_state
+    )
+
+    live_mic.stream(
+        fn=process_live_chunk,
+        inputs=[live_mic, live_state, history_state],
+        outputs=[
+            result_card,
+            input_container,
+            result_container,
+            history_output,
+            history_state,
+            redirect_btn,
+            live_state
+        ],
+        stream_every=0.5
+    )
+
+    # first library page when the ui opens
+    ui_layout.load(
+        fn=load_library_first_page,
+        inputs=[library_search],
+        outputs=library_outputs
+    )
+
     back_btn.click(
         fn=close_overlay,
         inputs=[],
@@ -0,0 +1,34 @@
+import io
+import config
+from engine.api import create_app
+
+class StandInService:
+    # answers every upload with one match, counting the bytes it was handed
+    def __init__(self):
+        self.received = []
+
+    def identify(self, data):
+        self.received.append(len(data))
+        return [{"song_id": 1}]
+
+def test_upload_within_limit_is_identified(monkeypatch):
+    monkeypatch.setattr(config, "API_MAX_UPLOAD_BYTES", 1024)
+    service = StandInService()
+
+    response = create_app(service).test_client().post("/identify", data=b"x" * 1024)
+
+    assert response.status_code == 200
+    assert response.get_json()["match"] == {"song_id": 1}
+    assert service.received == [1024]
+
+def test_oversized_upload_is_refused(monkeypatch):
+    monkeypatch.setattr(config, "API_MAX_UPLOAD_BYTES", 1024)
+    service = StandInService()
+    client = create_app(service).test_client()
+
+    raw = client.post("/identify", data=b"x" * 1025)
+    multipart = client.post("/identify", data={"audio": (io.BytesIO(b"x" * 2048), "clip.wav")})
+
+    assert raw.status_code == multipart.status_code == 413
+    assert "larger than 1024 bytes" in raw.get_json()["error"]
+    assert service.received == []
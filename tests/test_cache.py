@@ -0,0 +1,116 @@
+import fakeredis
+import pytest
+from database.cache import CachedBackend
+from database.storage import StorageBackend
+
+class StandInBackend(StorageBackend):
+    # postings in a dict, counting the hashes every lookup had to fetch from storage
+
+    def __init__(self):
+        self.postings = {}
+        self.fetched = []
+
+    def add_hashes_batch(self, val_list):
+        for hash_value, song_id, offset_time in val_list:
+            self.postings.setdefault(hash_value, []).append((song_id, offset_time))
+        return True
+
+    def replace_song_hashes(self, song_id, val_list):
+        replaced = []
+        for hash_value, hits in list(self.postings.items()):
+            if any(hit[0] == song_id for hit in hits):
+                replaced.append(hash_value)
+                self.postings[hash_value] = [hit for hit in hits if hit[0] != song_id]
+
+        self.add_hashes_batch(val_list)
+        return replaced
+
+    def get_matches_for_hashes(self, hash_values):
+        self.fetched.extend(hash_values)
+        return {h: list(self.postings[h]) for h in hash_values if self.postings.get(h)}
+
+    def add_song(self, name, artist, duration, thumbnail_url, youtube_url, dedupe=True):
+        return None
+
+    def get_song_by_id(self, song_id):
+        return None
+
+    def get_all_songs(self):
+        return []
+
+    def get_songs_page(self, after_id=None, limit=50, search=None):
+        return []
+
+    def count_songs(self, search=None):
+        return 0
+
+@pytest.fixture
+def backend():
+    backend = StandInBackend()
+    backend.add_hashes_batch([(1, 7, 0.5), (2, 7, 1.0)])
+    return backend
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+def test_hit_after_miss(backend):
+    cached = CachedBackend(backend, max_bytes=1 << 20)
+
+    first = cached.get_matches_for_hashes([1, 2, 3])
+    second = cached.get_matches_for_hashes([1, 2, 3])
+
+    assert first == second == {1: [(7, 0.5)], 2: [(7, 1.0)]}
+    # the empty result for 3 is cached too
+    assert backend.fetched == [1, 2, 3]
+    assert cached.stats()["local"]["hits"] == 3
+
+def test_add_hashes_batch_invalidates_in_process(backend):
+    cached = CachedBackend(backend, max_bytes=1 << 20)
+    cached.get_matches_for_hashes([1, 3])
+
+    cached.add_hashes_batch([(3, 8, 2.0)])
+
+    assert cached.get_matches_for_hashes([1, 3]) == {1: [(7, 0.5)], 3: [(8, 2.0)]}
+    assert backend.fetched == [1, 3, 3]
+
+def test_replace_song_hashes_invalidates_removed_and_added_hashes(backend):
+    cached = CachedBackend(backend, max_bytes=1 << 20)
+    cached.get_matches_for_hashes([1, 2, 4])
+
+    cached.replace_song_hashes(7, [(4, 7, 0.25)])
+
+    assert cached.get_matches_for_hashes([1, 2, 4]) == {4: [(7, 0.25)]}
+
+def test_other_process_write_invalidates_through_generation_log(backend, server):
+    # two workers with their own local tier, sharing one redis
+    reader = CachedBackend(backend, max_bytes=1 << 20, redis_client=fakeredis.FakeRedis(server=server))
+    writer = CachedBackend(backend, max_bytes=1 << 20, redis_client=fakeredis.FakeRedis(server=server))
+
+    assert reader.get_matches_for_hashes([1, 2]) == {1: [(7, 0.5)], 2: [(7, 1.0)]}
+    assert reader.get_matches_for_hashes([1, 2]) == {1: [(7, 0.5)], 2: [(7, 1.0)]}
+    assert backend.fetched == [1, 2]
+
+    writer.add_hashes_batch([(1, 9, 3.0)])
+
+    # only the written hash is dropped from the reader's local tier, the other one is still a local hit
+    hits = reader.local.hits
+    assert reader.get_matches_for_hashes([1, 2]) == {1: [(7, 0.5), (9, 3.0)], 2: [(7, 1.0)]}
+    assert reader.local.hits == hits + 1
+    assert backend.fetched == [1, 2, 1]
+
+def test_expired_invalidation_entry_drops_the_whole_local_tier(backend, server):
+    client = fakeredis.FakeRedis(server=server)
+    reader = CachedBackend(backend, max_bytes=1 << 20, redis_client=client)
+    writer = CachedBackend(backend, max_bytes=1 << 20, redis_client=fakeredis.FakeRedis(server=server))
+    reader.get_matches_for_hashes([1, 2])
+
+    writer.add_hashes_batch([(1, 9, 3.0)])
+    # the reader cannot tell which keys that write touched
+    client.delete(writer.invalidation_key(1))
+
+    hits = reader.local.hits
+    assert reader.get_matches_for_hashes([1, 2]) == {1: [(7, 0.5), (9, 3.0)], 2: [(7, 1.0)]}
+    assert reader.local.hits == hits
+    # 2 is still in redis, only the written hash goes back to storage
+    assert backend.fetched == [1, 2, 1]
@@ -0,0 +1,190 @@
+import re
+import pytest
+import numpy as np
+from contextlib import contextmanager
+import mysql.connector
+from mysql.connector import pooling
+from mysql.connector.connection import MySQLConnection
+from mysql.connector.constants import ClientFlag
+from database import db_handler
+from database.memory_index import MemoryIndex
+from database.storage import search_words
+
+@pytest.fixture
+def handler(monkeypatch):
+    # a real pool object without a server: it opens no connections and the schema steps are skipped
+    monkeypatch.setattr(pooling.MySQLConnectionPool, "add_connection", lambda self, cnx=None: None)
+    monkeypatch.setattr(db_handler, "migrate_database", lambda: None)
+    monkeypatch.setenv("DB_HOST", "localhost")
+    monkeypatch.setenv("DB_USER", "pytone")
+    monkeypatch.setenv("DB_PASSWORD", "secret")
+
+    db_handler.prepare_db_handler()
+    db_handler.use_database()
+    return db_handler
+
+def pooled_connection():
+    # configured the way the pool configures every connection it hands out
+    connection = MySQLConnection()
+    connection.config(**db_handler.pool._cnx_config)
+    return connection
+
+class LocalInfileCursor:
+    # plays the server's part of LOAD DATA LOCAL INFILE: asks the client for the file the statement names
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.sent = []
+
+        # capture the bytes instead of writing them to a socket
+        connection._send_data = lambda data_file, *args: self.sent.append(data_file.read())
+        connection._handle_ok = lambda packet: packet
+
+    def execute(self, sql, values=()):
+        self.connection._query = (sql % tuple(f"'{value}'" for value in values)).encode()
+        self.connection._local_infile_filenames = None
+        self.connection._handle_load_data_infile(values[0])
+
+def test_pool_keeps_local_infile_path_after_use_database(handler):
+    connection = pooled_connection()
+
+    assert connection._database == "pytone"
+    assert connection._allow_local_infile_in_path == handler.staging_dir
+    assert connection._client_flags & ClientFlag.LOCAL_FILES
+
+def test_load_staging_infile_sends_the_staged_rows(handler):
+    cursor = LocalInfileCursor(pooled_connection())
+    rows = [("a" * 40, 1, 0.5), ("b" * 40, 2, 1.25)]
+
+    handler.load_staging_infile(cursor, rows, "offset_time")
+
+    assert cursor.sent == [f"{'a' * 40}\t1\t0.5\n{'b' * 40}\t2\t1.25\n".encode()]
+
+def test_local_infile_outside_staging_dir_is_refused(handler, tmp_path):
+    cursor = LocalInfileCursor(pooled_connection())
+    secret = tmp_path / "secret.txt"
+    secret.write_text("not for the server")
+
+    with pytest.raises(mysql.connector.Error):
+        cursor.execute("LOAD DATA LOCAL INFILE %s INTO TABLE Hash_staging", (str(secret),))
+
+    assert cursor.sent == []
+
+class RecordingCursor:
+    # stands in for the pooled cursor: records every statement, answers the Song select
+    def __init__(self, songs):
+        self.songs = songs
+        self.statements = []
+
+    def execute(self, sql, values=()):
+        self.statements.append((" ".join(sql.split()), values))
+
+    def fetchall(self):
+        return self.songs
+
+class RecordingConnection:
+    def commit(self):
+        pass
+
+@pytest.fixture
+def migration(monkeypatch):
+    cursor = RecordingCursor([(1, "https://example.com/1"), (2, "https://example.com/2"), (3, "https://example.com/3")])
+
+    @contextmanager
+    def get_cursor(buffered=True):
+        yield RecordingConnection(), cursor
+
+    monkeypatch.setattr(db_handler, "get_cursor", get_cursor)
+    return cursor
+
+def rehash(youtube_url):
+    if youtube_url.endswith("2"):
+        raise RuntimeError("video unavailable")
+    return np.array([11, 12]), np.array([0.5, 1.0])
+
+def test_migrate_hash_format_skips_songs_that_fail_to_rehash(migration, monkeypatch):
+    inserted = []
+    monkeypatch.setattr(db_handler, "add_hashes_batch", lambda rows, table_name: inserted.append(rows) or True)
+
+    assert db_handler.migrate_hash_format(rehash, "packed") == 2
+
+    assert [rows[0][1] for rows in inserted] == [1, 3]
+    update = [values for sql, values in migration.statements if sql.startswith("UPDATE Song")]
+    # the failed song keeps its old parameters, reindex picks it up later
+    assert update[0][1:] == (1, 3)
+
+def test_migrate_hash_format_keeps_hash_table_when_insert_fails(migration, monkeypatch):
+    monkeypatch.setattr(db_handler, "add_hashes_batch", lambda rows, table_name: False)
+
+    assert db_handler.migrate_hash_format(rehash, "packed") is None
+
+    statements = [sql for sql, values in migration.statements]
+    assert not any(sql.startswith(("RENAME", "DROP TABLE Hash_old", "UPDATE")) for sql in statements)
+
+def test_migrate_hash_format_skips_songs_without_source(migration, monkeypatch, capsys):
+    migration.songs = migration.songs + [(4, ""), (5, None)]
+    urls = []
+    monkeypatch.setattr(db_handler, "add_hashes_batch", lambda rows, table_name: True)
+
+    assert db_handler.migrate_hash_format(lambda url: urls.append(url) or rehash(url), "packed") == 2
+
+    assert "" not in urls and None not in urls
+    assert "no source url and are skipped: [4, 5]" in capsys.readouterr().out
+    select = [sql for sql, values in migration.statements if sql.startswith("SELECT")]
+    assert "WHERE duplicate_of IS NULL" in select[0]
+
+class SettingsCursor:
+    # answers the full-text settings queries with innodb's defaults
+    def __init__(self):
+        self.result = None
+
+    def execute(self, sql, values=()):
+        if sql.startswith("SELECT @@"):
+            self.result = [(3, 1, "")]
+        else:
+            self.result = [("a",), ("about",), ("the",), ("to",)]
+
+    def fetchone(self):
+        return self.result[0]
+
+    def fetchall(self):
+        return self.result
+
+def fulltext_matches(text, conditions, values, min_token_size=3, stopwords=("a", "about", "the", "to")):
+    # what the server does with the conditions: boolean full-text on indexed tokens, icu patterns case-insensitively
+    tokens = [token for token in search_words(text) if len(token) >= min_token_size and token not in stopwords]
+
+    for condition, value in zip(conditions, values):
+        if condition.startswith("MATCH"):
+            prefixes = [term.strip("+*") for term in value.split()]
+            if not all(any(token.startswith(prefix) for token in tokens) for prefix in prefixes):
+                return False
+        elif not re.search(value.replace("[:alnum:]_", r"\w"), text, re.IGNORECASE):
+            return False
+
+    return True
+
+def test_search_conditions_match_like_the_memory_index(monkeypatch):
+    monkeypatch.setattr(db_handler, "fulltext_settings", None)
+    songs = {
+        1: ("The Sound of Silence", "Simon & Garfunkel", 180, "", ""),
+        2: ("About a Girl", "Nirvana", 170, "", ""),
+        3: ("Go to Sleep", "Radiohead", 200, "", ""),
+        4: ("Thermal", "ab", 100, "", ""),
+        5: ("Sabotage", "Beastie Boys", 180, "", ""),
+    }
+    index = MemoryIndex(songs=dict(songs))
+
+    for search in ["the", "th", "abou", "a", "go to", "ab", "sound silence", "to sleep", "the sim", "bo", "x"]:
+        conditions, values = db_handler.search_conditions(SettingsCursor(), search_words(search))
+        found = [song_id for song_id, song in songs.items() if fulltext_matches(f"{song[0]} {song[1]}", conditions, values)]
+
+        assert found == sorted(index.search_song_ids(search_words(search))), search
+
+def test_search_conditions_keep_indexed_words_in_one_fulltext_match(monkeypatch):
+    monkeypatch.setattr(db_handler, "fulltext_settings", None)
+
+    conditions, values = db_handler.search_conditions(SettingsCursor(), ["sound", "of", "the", "silence"])
+
+    assert values == ["+sound* +silence*", "(^|[^[:alnum:]_])of", "(^|[^[:alnum:]_])the"]
+    assert conditions[0].startswith("MATCH") and all("REGEXP_LIKE" in c for c in conditions[1:])
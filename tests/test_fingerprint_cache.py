@@ -0,0 +1,81 @@
+import shutil
+import threading
+import time
+import numpy as np
+import pytest
+import soundfile
+import config
+from core import fingerprinter
+from utils.fingerprint_cache import FingerprintCache
+
+URL = "https://www.youtube.com/watch?v=dQw4w9WgXcQ"
+
+@pytest.fixture
+def song(tmp_path):
+    # a few seconds of noise bursts, enough peaks for a real fingerprint
+    rng = np.random.default_rng(0)
+    seconds = 8
+    envelope = np.repeat(rng.random(seconds * 4), config.SAMPLE_RATE // 4)
+    signal = rng.standard_normal(len(envelope)) * envelope * 0.3
+
+    path = tmp_path / "song.wav"
+    soundfile.write(path, signal.astype(np.float32), config.SAMPLE_RATE)
+    return str(path)
+
+class StandInDownloader:
+    # copies the local song to a fresh temp file like yt-dlp would, counting the downloads
+
+    def __init__(self, source, directory):
+        self.source = source
+        self.directory = directory
+        self.downloads = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, url, name):
+        with self.lock:
+            self.downloads += 1
+            path = self.directory / f"{name}_{self.downloads}.wav"
+
+        # slow enough for every other request to arrive while it runs
+        time.sleep(0.5)
+        shutil.copyfile(self.source, path)
+        return str(path)
+
+@pytest.mark.parametrize("decoder", ["librosa", "stream"])
+def test_concurrent_requests_share_one_download(song, tmp_path, monkeypatch, decoder):
+    monkeypatch.setattr(config, "AUDIO_DECODER", decoder)
+
+    downloads = tmp_path / "downloads"
+    downloads.mkdir()
+    downloader = StandInDownloader(song, downloads)
+    cache = FingerprintCache(directory=str(tmp_path / "cache"), downloader=downloader)
+
+    start = threading.Barrier(8)
+    results = [None] * 8
+
+    def request(i):
+        start.wait()
+        results[i] = cache.fingerprint(URL)
+
+    threads = [threading.Thread(target=request, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert downloader.downloads == 1
+    assert cache.stats()["coalesced"] + cache.stats()["hits"] == 7
+
+    # the temp download is removed once decoded
+    assert list(downloads.iterdir()) == []
+
+    expected_hashes, expected_offsets = fingerprinter.process_audio(song)
+    assert len(expected_hashes) > 0
+    for hash_array, offset_array in results:
+        np.testing.assert_array_equal(hash_array, expected_hashes)
+        np.testing.assert_array_equal(offset_array, expected_offsets)
+
+    # later requests are served from disk
+    hash_array, _ = cache.fingerprint("https://youtu.be/dQw4w9WgXcQ")
+    np.testing.assert_array_equal(hash_array, expected_hashes)
+    assert downloader.downloads == 1
@@ -0,0 +1,25 @@
+import numpy as np
+from database.memory_index import MemoryIndex
+from database.sharding import ShardedBackend, shard_of
+
+def test_memory_index_replace_song_hashes():
+    index = MemoryIndex()
+    index.add_hashes_batch([(1, 7, 0.5), (2, 7, 1.0), (2, 8, 3.0)])
+
+    assert index.replace_song_hashes(7, [(3, 7, 0.25), (2, 7, 2.0)]) == [1, 2]
+
+    assert index.get_matches_for_hashes([1, 2, 3]) == {2: [(8, 3.0), (7, 2.0)], 3: [(7, 0.25)]}
+
+def test_sharded_replace_song_hashes_clears_every_shard():
+    shards = [MemoryIndex() for _ in range(4)]
+    backend = ShardedBackend(shards[0], shards)
+
+    # enough hashes that the song has postings on every shard
+    old = np.arange(1, 65, dtype=np.uint64)
+    assert set(shard_of(old, 4).tolist()) == {0, 1, 2, 3}
+    backend.add_hashes_batch([(h, 7, 0.5) for h in old.tolist()] + [(1, 8, 1.0)])
+
+    replaced = backend.replace_song_hashes(7, [(100, 7, 2.0)])
+
+    assert sorted(replaced) == old.tolist()
+    assert backend.get_matches_for_hashes(old.tolist() + [100]) == {1: [(8, 1.0)], 100: [(7, 2.0)]}
@@ -0,0 +1,26 @@
+import numpy as np
+import config
+from database import storage
+from database.memory_index import MemoryIndex
+from engine.stream_matcher import StreamingIdentifier
+
+def test_density_cap_holds_across_chunks(monkeypatch):
+    monkeypatch.setattr(config, "PEAK_MODE", "density")
+    monkeypatch.setattr(config, "PEAKS_PER_BAND_SECOND", 3)
+    # nothing to match against, only the peaks are of interest
+    monkeypatch.setattr(storage, "backend", MemoryIndex())
+
+    rng = np.random.default_rng(0)
+    signal = (rng.standard_normal(config.SAMPLE_RATE * 4) * 0.3).astype(np.float32)
+
+    # chunks much shorter than a second, so every second is split over several passes
+    identifier = StreamingIdentifier(config.SAMPLE_RATE)
+    for chunk in np.array_split(signal, 80):
+        identifier.add_chunk(chunk)
+    identifier.finish()
+
+    bands = np.clip(np.searchsorted(config.PEAK_BANDS, identifier.peak_freqs, side='right') - 1, 0, len(config.PEAK_BANDS) - 2)
+    _, counts = np.unique(np.stack([np.floor(identifier.peak_times), bands]), axis=1, return_counts=True)
+
+    assert len(identifier.peak_times) > 0
+    assert counts.max() <= config.PEAKS_PER_BAND_SECOND
@@ -0,0 +1,384 @@
+import os
+import csv
+import time
+import queue
+import argparse
+import threading
+import multiprocessing
+import librosa
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import numpy as np
+import config
+from core import fingerprinter
+from core.audio_loader import load_audio
+from database import storage
+from database.memory_index import MemoryIndex
+from engine import matcher
+
+AUDIO_EXTENSIONS = {".wav", ".mp3", ".flac", ".ogg", ".m4a", ".aac", ".opus"}
+
+def find_audio_files(source):
+    # manifest: csv rows of path[,title[,artist]]
+    if os.path.isfile(source):
+        with open(source, newline="") as manifest:
+            entries = []
+            for row in csv.reader(manifest):
+                if not row:
+                    continue
+                title = row[1] if len(row) > 1 else None
+                artist = row[2] if len(row) > 2 else None
+                entries.append((row[0], title, artist))
+            return entries
+
+    # directory: every audio file below it, in a stable order
+    entries = []
+    for root, _, files in os.walk(source):
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() in AUDIO_EXTENSIONS:
+                entries.append((os.path.join(root, name), None, None))
+
+    entries.sort()
+    return entries
+
+def load_progress(progress_path):
+    # paths whose hashes are already stored
+    if not os.path.exists(progress_path):
+        return set()
+
+    with open(progress_path) as progress:
+        return {line.rstrip("\n") for line in progress if line.strip()}
+
+# stream mode: the writer's queue and its failure flag, set in every worker process
+blocks_queue = None
+writer_failed = None
+
+def init_worker(results=None, stopped=None):
+    global blocks_queue, writer_failed
+
+    # the pool already keeps every core busy, one fft thread per process
+    config.FFT_WORKERS = 1
+
+    blocks_queue = results
+    writer_failed = stopped
+
+def send_to_writer(item):
+    # runs in a worker process, blocks while the writer falls behind and gives up once it died
+    while not writer_failed.is_set():
+        try:
+            blocks_queue.put(item, timeout=0.5)
+            return
+        except queue.Full:
+            continue
+
+    raise RuntimeError("the database writer stopped")
+
+def fingerprint_file(path, title, artist):
+    # runs in a worker process
+    if config.AUDIO_DECODER == "stream":
+        return stream_file(path, title, artist)
+
+    signal = load_audio(path)
+    hash_array, offset_array = fingerprinter.fingerprint_signal(signal)
+
+    return hash_array, offset_array, int(len(signal) / config.SAMPLE_RATE)
+
+def stream_file(path, title, artist):
+    # block pipeline: hash blocks go to the writer as they are made, so memory stays flat
+    # even for hours-long recordings. the fingerprint's first pass reads the whole file,
+    # a file that fails to decode fails before any block was sent
+    try:
+        duration = int(librosa.get_duration(path=path))
+
+        sent = False
+        for hash_array, offset_array in fingerprinter.iter_audio_fingerprint(path):
+            send_to_writer(("block", path, title, artist, hash_array, offset_array, duration))
+            sent = True
+
+        # a silent file is still a song, like in the whole-file path
+        if not sent:
+            hash_array, offset_array = fingerprinter.join_fingerprint([])
+            send_to_writer(("block", path, title, artist, hash_array, offset_array, duration))
+
+        send_to_writer(("done", path))
+    except Exception:
+        # same queue as the blocks, the writer sees it after them
+        if not writer_failed.is_set():
+            send_to_writer(("failed", path))
+        raise
+
+def write_results(results, progress_path, batch_rows, stats, bulk_load):
+    # single writer: batches rows from many songs into one insert
+    # items are ("block", path, title, artist, hash_array, offset_array, duration), one per file
+    # or many in stream mode, followed by ("done", path) or ("failed", path)
+    backend = storage.get_backend()
+    pending_rows = []
+    pending_paths = []
+
+    # path -> song id of files whose blocks are still arriving, none while their blocks are dropped
+    open_songs = {}
+    # paths of open_songs that are done once they end: stored songs and skipped duplicates
+    completes = set()
+    # rows added per open song, tells a failed file with stored hashes from one without
+    song_rows = {}
+
+    # songs of the unflushed batch, so copies within one batch are caught too
+    pending_index = MemoryIndex()
+    check_duplicates = config.DUPLICATE_ACTION != "insert"
+
+    def flush():
+        nonlocal pending_index
+
+        if pending_rows:
+            if bulk_load:
+                stored = backend.add_hashes_bulk(pending_rows)
+            else:
+                stored = backend.add_hashes_batch(pending_rows)
+
+            # the songs stay out of the progress file, a resumed run fingerprints them again
+            if stored is False:
+                raise RuntimeError(f"failed to store {len(pending_rows)} hashes of {len(pending_paths)} songs")
+
+        # only mark songs done once their hashes are stored
+        with open(progress_path, "a") as progress:
+            progress.writelines(path + "\n" for path in pending_paths)
+
+        stats["songs"] += len(pending_paths)
+        stats["hashes"] += len(pending_rows)
+        pending_rows.clear()
+        pending_paths.clear()
+        pending_index = MemoryIndex()
+
+    def start_song(path, title, artist, hash_array, offset_array, duration):
+        # the first block decides: in stream mode it holds DECODE_BLOCK_SECONDS of audio,
+        # enough to recognise a copy the way a recorded clip is recognised
+        duplicate = None
+        if check_duplicates:
+            duplicate = matcher.find_duplicate(hash_array, offset_array) or matcher.find_duplicate(hash_array, offset_array, pending_index)
+
+        if duplicate:
+            original_id, score = duplicate
+            print(f"Duplicate: {path} matches song {original_id} ({score:.0%}), {config.DUPLICATE_ACTION}")
+            stats["duplicates"] += 1
+
+            if config.DUPLICATE_ACTION == "link":
+                song_id = backend.add_song(title, artist, duration, "", "", dedupe=False)
+                if song_id and song_id != original_id:
+                    backend.link_song(song_id, original_id)
+
+            # nothing to store, the file is done once its last block arrived
+            completes.add(path)
+            return None
+
+        # every file is its own song: untagged files in different folders share a title,
+        # real copies are caught by the fingerprint check above
+        song_id = backend.add_song(title, artist, duration, "", "", dedupe=False)
+        if song_id is not None:
+            completes.add(path)
+
+        return song_id
+
+    def end_song(path):
+        song_id = open_songs.pop(path, None)
+        song_rows.pop(path, None)
+
+        if path not in completes:
+            return
+        completes.discard(path)
+
+        if song_id is None:
+            # skipped duplicate, mark it done right away so a resumed run skips it
+            with open(progress_path, "a") as progress:
+                progress.write(path + "\n")
+        else:
+            pending_paths.append(path)
+
+    def abandon(path):
+        # the worker failed halfway, drop the rows not stored yet and leave the file undone
+        song_id = open_songs.pop(path, None)
+        added = song_rows.pop(path, 0)
+        completes.discard(path)
+
+        if song_id is None:
+            return
+
+        kept = [row for row in pending_rows if row[1] != song_id]
+        if added > len(pending_rows) - len(kept):
+            print(f"Error: {path} failed after part of its hashes were stored as song {song_id}")
+        pending_rows[:] = kept
+
+    while True:
+        item = results.get()
+        if item is None:
+            break
+
+        kind, path = item[0], item[1]
+
+        if kind == "done":
+            end_song(path)
+        elif kind == "failed":
+            abandon(path)
+        else:
+            _, path, title, artist, hash_array, offset_array, duration = item
+
+            if path not in open_songs:
+                open_songs[path] = start_song(path, title, artist, hash_array, offset_array, duration)
+                song_rows[path] = 0
+
+            song_id = open_songs[path]
+            if song_id is None:
+                continue
+
+            pending_rows.extend(zip(hash_array.tolist(), [song_id] * len(hash_array), offset_array.tolist()))
+            song_rows[path] += len(hash_array)
+
+            if check_duplicates:
+                pending_index.add_hash_arrays(hash_array, np.full(len(hash_array), song_id), offset_array)
+
+        if len(pending_rows) >= batch_rows:
+            flush()
+
+    # a worker that died without a word leaves its file open
+    for path in list(open_songs):
+        abandon(path)
+
+    flush()
+
+def run_writer(writer_errors, stopped, *args):
+    # a dead writer never drains the queue, the producers stop once they find an error here
+    try:
+        write_results(*args)
+    except Exception as err:
+        writer_errors.append(err)
+        stopped.set()
+
+def put_result(results, item, writer_errors):
+    # blocks while the writer falls behind, raises the writer's error once it died
+    while True:
+        if writer_errors:
+            raise writer_errors[0]
+
+        try:
+            results.put(item, timeout=0.5)
+            return
+        except queue.Full:
+            continue
+
+def report(stats, start_time):
+    elapsed = max(time.perf_counter() - start_time, 1e-9)
+    print(
+        f"{stats['songs']} songs, {stats['hashes']} hashes in {elapsed:.1f}s "
+        f"({stats['songs'] / elapsed:.2f} songs/s, {stats['hashes'] / elapsed:.0f} hashes/s, "
+        f"{stats['duplicates']} duplicates, {stats['failed']} failed)"
+    )
+
+def ingest(source, workers=None, progress_path="ingest_progress.txt", batch_rows=200000, queue_size=32, bulk_load=False):
+    done = load_progress(progress_path)
+    entries = [e for e in find_audio_files(source) if e[0] not in done]
+
+    print(f"Ingesting {len(entries)} files ({len(done)} already done)")
+
+    stats = {"songs": 0, "hashes": 0, "duplicates": 0, "failed": 0}
+    start_time = time.perf_counter()
+
+    # bounded queue between the fingerprint workers and the db writer,
+    # in stream mode the workers put their hash blocks on it themselves
+    stream = config.AUDIO_DECODER == "stream"
+    results = multiprocessing.Queue(maxsize=queue_size) if stream else queue.Queue(maxsize=queue_size)
+
+    writer_errors = []
+    stopped = multiprocessing.Event()
+    writer = threading.Thread(target=run_writer, args=(writer_errors, stopped, results, progress_path, batch_rows, stats, bulk_load))
+    writer.start()
+
+    workers = workers or os.cpu_count()
+    fingerprinted = 0
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(results, stopped) if stream else ()) as pool:
+            max_in_flight = 2 * workers
+            pending = {}
+            next_entry = 0
+
+            while next_entry < len(entries) or pending:
+                # keep a bounded number of files in flight
+                while next_entry < len(entries) and len(pending) < max_in_flight:
+                    path, title, artist = entries[next_entry]
+
+                    # fall back to the file name for songs without metadata
+                    title = title or os.path.splitext(os.path.basename(path))[0]
+                    artist = artist or "Unknown Artist"
+
+                    pending[pool.submit(fingerprint_file, path, title, artist)] = (path, title, artist)
+                    next_entry += 1
+
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in finished:
+                    path, title, artist = pending.pop(future)
+
+                    # stop submitting once the writer died, its error is raised below
+                    if writer_errors:
+                        raise writer_errors[0]
+
+                    try:
+                        result = future.result()
+                    except Exception as err:
+                        print(f"Error: failed to fingerprint {path}: {err}")
+                        stats["failed"] += 1
+                        continue
+
+                    if not stream:
+                        hash_array, offset_array, duration = result
+
+                        # blocks when the writer falls behind
+                        put_result(results, ("block", path, title, artist, hash_array, offset_array, duration), writer_errors)
+                        put_result(results, ("done", path), writer_errors)
+
+                    fingerprinted += 1
+                    if fingerprinted % 50 == 0:
+                        report(stats, start_time)
+    finally:
+        # stop the writer, a failed one has already stopped
+        if not writer_errors:
+            try:
+                put_result(results, None, writer_errors)
+            except Exception:
+                pass
+        writer.join()
+
+    # the last flush runs after every file was queued
+    if writer_errors:
+        raise writer_errors[0]
+
+    report(stats, start_time)
+
+    return stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fingerprint a directory or manifest of audio files in parallel.")
+    parser.add_argument("source", help="directory of audio files or csv manifest (path,title,artist)")
+    parser.add_argument("--workers", type=int, default=None, help="fingerprint processes (default: cpu count)")
+    parser.add_argument("--progress", default="ingest_progress.txt", help="file recording finished paths, used to resume")
+    parser.add_argument("--batch-rows", type=int, default=200000, help="hash rows per database insert")
+    parser.add_argument("--bulk-load", action="store_true", help="load through a staging table instead of plain inserts")
+    parser.add_argument("--defer-indexes", action="store_true", help="drop the hash index during the import and rebuild it at the end")
+    args = parser.parse_args()
+
+    # the deferred index is the main Hash table's, shard tables keep theirs
+    defer_indexes = args.defer_indexes and config.STORAGE_BACKEND == "mysql"
+
+    if storage.uses_mysql():
+        from database import db_handler
+
+        # initialize connection to the existing database
+        db_handler.prepare_db_handler()
+        db_handler.use_database()
+
+        if defer_indexes:
+            db_handler.disable_hash_index()
+
+    try:
+        ingest(args.source, args.workers, args.progress, args.batch_rows, bulk_load=args.bulk_load)
+    finally:
+        if defer_indexes:
+            db_handler.enable_hash_index()
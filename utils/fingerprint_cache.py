@@ -0,0 +1,276 @@
+import os
+import re
+import json
+import uuid
+import hashlib
+import threading
+import zipfile
+from concurrent.futures import Future
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import config
+from core import fingerprinter
+from core.audio_loader import load_audio
+from database.index_snapshot import fingerprint_params
+from utils import metrics
+
+# layout under FINGERPRINT_CACHE_DIR:
+#   videos.json                          video id @ sample rate -> content hash
+#   audio/<content>.npz                  decoded mono float32 pcm at SAMPLE_RATE
+#   fingerprints/<content>_<params>.npz  hash and offset arrays for one set of fingerprint parameters
+# content is the sha256 of the decoded pcm, so the same audio behind two urls is stored once
+VIDEO_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{11}$")
+
+# active cache, created on first use
+cache = None
+
+def video_id(url):
+    # youtube.com/watch?v=ID, youtu.be/ID, /shorts/ID, /embed/ID and /live/ID share one key
+    parsed = urlparse(url.strip())
+    host = (parsed.hostname or "").lower()
+    parts = [part for part in parsed.path.split("/") if part]
+
+    candidate = None
+    if host.endswith("youtu.be") and parts:
+        candidate = parts[0]
+    elif "v" in parse_qs(parsed.query):
+        candidate = parse_qs(parsed.query)["v"][0]
+    elif len(parts) >= 2 and parts[0] in ("shorts", "embed", "live", "v"):
+        candidate = parts[1]
+
+    if candidate and VIDEO_ID_PATTERN.match(candidate):
+        return candidate
+
+    # anything else is keyed on the url itself
+    return "url-" + hashlib.sha1(url.strip().encode("utf-8")).hexdigest()
+
+def params_digest():
+    return hashlib.sha1(json.dumps(fingerprint_params(), sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+def default_downloader(url, name):
+    import utils.youtube_fetcher as yt
+    return yt.download_audio(url, name)
+
+class FingerprintCache:
+    # on-disk cache of training downloads: decoded audio and fingerprints, evicted least recently used first
+    # concurrent requests for the same video wait for one download instead of starting their own
+
+    def __init__(self, directory=None, max_bytes=None, downloader=None):
+        self.directory = directory or config.FINGERPRINT_CACHE_DIR
+        self.max_bytes = max_bytes or config.FINGERPRINT_CACHE_MAX_BYTES
+        # downloader(url, name) returns the path of an audio file it created, deleted after decoding
+        self.downloader = downloader or default_downloader
+
+        os.makedirs(os.path.join(self.directory, "audio"), exist_ok=True)
+        os.makedirs(os.path.join(self.directory, "fingerprints"), exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.videos = self.read_index()
+
+        self.hits = 0
+        self.audio_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def index_path(self):
+        return os.path.join(self.directory, "videos.json")
+
+    def audio_path(self, content):
+        return os.path.join(self.directory, "audio", f"{content}.npz")
+
+    def fingerprint_path(self, content):
+        return os.path.join(self.directory, "fingerprints", f"{content}_{params_digest()}.npz")
+
+    def read_index(self):
+        try:
+            with open(self.index_path()) as index:
+                return json.load(index)
+        except (OSError, ValueError):
+            return {}
+
+    def write_index(self):
+        # callers hold self.lock
+        tmp_path = f"{self.index_path()}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as index:
+            json.dump(self.videos, index)
+        os.replace(tmp_path, self.index_path())
+
+    def fingerprint(self, url):
+        # (hash_array, offset_array) of the song behind url
+        key = f"{video_id(url)}@{config.SAMPLE_RATE}"
+
+        with self.lock:
+            future = self.in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self.in_flight[key] = Future()
+            else:
+                self.coalesced += 1
+
+        if not owner:
+            metrics.count("fingerprint_cache_coalesced")
+            return future.result()
+
+        try:
+            result = self.resolve(url, key)
+        except BaseException as err:
+            future.set_exception(err)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+    def resolve(self, url, key):
+        content = self.videos.get(key)
+
+        if content is not None:
+            cached = self.load(self.fingerprint_path(content))
+            if cached is not None:
+                self.hits += 1
+                metrics.count("fingerprint_cache_hits")
+                return cached["hashes"], cached["offsets"]
+
+            # fingerprint parameters changed since, the decoded audio is still good
+            cached = self.load(self.audio_path(content))
+            if cached is not None:
+                self.audio_hits += 1
+                metrics.count("fingerprint_cache_audio_hits")
+                return self.store_fingerprint(content, cached["pcm"])
+
+        self.misses += 1
+        metrics.count("fingerprint_cache_misses")
+
+        with metrics.timer("download"):
+            path = self.downloader(url, "temp_train")
+
+        # load_audio follows AUDIO_DECODER, the whole pcm is kept for the cache either way,
+        # so it is fingerprinted in one shot, with the same hashes as the block pipeline
+        try:
+            signal = load_audio(path).astype(np.float32, copy=False)
+        finally:
+            # cleanup temp file, also when decoding fails
+            if os.path.exists(path):
+                os.remove(path)
+
+        content = hashlib.sha256(signal.tobytes()).hexdigest()
+
+        with self.lock:
+            self.videos[key] = content
+            self.write_index()
+
+        # the same audio may already be cached under another url
+        cached = self.load(self.fingerprint_path(content))
+        if cached is not None:
+            return cached["hashes"], cached["offsets"]
+
+        self.save(self.audio_path(content), pcm=signal)
+        result = self.store_fingerprint(content, signal)
+        self.evict()
+
+        return result
+
+    def store_fingerprint(self, content, signal):
+        hash_array, offset_array = fingerprinter.fingerprint_signal(signal)
+        self.save(self.fingerprint_path(content), hashes=hash_array, offsets=offset_array)
+        return hash_array, offset_array
+
+    def load(self, path):
+        # arrays of a cache file, or None when it is missing, evicted meanwhile or damaged
+        try:
+            with np.load(path) as data:
+                arrays = {name: data[name] for name in data.files}
+        except (OSError, ValueError, zipfile.BadZipFile):
+            return None
+
+        # the modification time orders the lru eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return arrays
+
+    def save(self, path, **arrays):
+        # write next to the target and rename, readers never see a partial file
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as out:
+            np.savez_compressed(out, **arrays)
+        os.replace(tmp_path, path)
+
+    def entries(self):
+        files = []
+        for folder in ("audio", "fingerprints"):
+            with os.scandir(os.path.join(self.directory, folder)) as scan:
+                for entry in scan:
+                    if entry.name.endswith(".npz"):
+                        stat = entry.stat()
+                        files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        return files
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        # drop least recently used files until the cache fits in max_bytes
+        files = sorted(self.entries())
+        total = sum(size for _, size, _ in files)
+
+        for _, size, path in files:
+            if total <= self.max_bytes:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+
+            total -= size
+            self.evictions += 1
+            metrics.count("fingerprint_cache_evictions")
+
+        # forget videos whose audio and fingerprints are all gone
+        remaining = {os.path.basename(path).split(".")[0].split("_")[0] for _, _, path in self.entries()}
+        with self.lock:
+            stale = [key for key, content in self.videos.items() if content not in remaining]
+            for key in stale:
+                del self.videos[key]
+            if stale:
+                self.write_index()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "audio_hits": self.audio_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "videos": len(self.videos),
+            "bytes": self.size(),
+        }
+
+def get_cache():
+    global cache
+
+    if cache is None:
+        cache = FingerprintCache()
+
+    return cache
+
+def fingerprint_url(url):
+    # cached fingerprint when enabled, otherwise download and fingerprint every time
+    if config.FINGERPRINT_CACHE_ENABLED:
+        return get_cache().fingerprint(url)
+
+    path = default_downloader(url, "temp_train")
+    try:
+        return fingerprinter.process_audio(path)
+    finally:
+        # cleanup temp file, also when fingerprinting fails
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,177 @@
+import io
+import time
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from contextlib import contextmanager
+import config
+
+# latency histogram buckets in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+lock = threading.Lock()
+# stage -> [bucket counts..., count, sum]
+stage_stats = {}
+counters = {}
+
+# per-thread trace of the request being handled, if one is active
+local = threading.local()
+# most recent finished trace, shown in the debug panel
+last_trace = None
+# tracemalloc and the profiler hooks are process wide, only one request at a time captures them
+capture_lock = threading.Lock()
+
+class NullTimer:
+    # shared no-op used while metrics are disabled
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_TIMER = NullTimer()
+
+class StageTimer:
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.stage, time.perf_counter() - self.start)
+        return False
+
+def timer(stage):
+    # with metrics.timer("spectrogram"): ...
+    if not config.METRICS_ENABLED:
+        return NULL_TIMER
+
+    return StageTimer(stage)
+
+def observe(stage, seconds):
+    with lock:
+        stats = stage_stats.get(stage)
+        if stats is None:
+            stats = stage_stats[stage] = [0] * (len(BUCKETS) + 2)
+
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                stats[i] += 1
+        stats[-2] += 1
+        stats[-1] += seconds
+
+    current = getattr(local, "trace", None)
+    if current is not None:
+        current["stages"][stage] = current["stages"].get(stage, 0.0) + seconds
+
+def count(name, value=1):
+    if not config.METRICS_ENABLED:
+        return
+
+    with lock:
+        counters[name] = counters.get(name, 0) + value
+
+    current = getattr(local, "trace", None)
+    if current is not None:
+        current["counters"][name] = current["counters"].get(name, 0) + value
+
+def reset():
+    with lock:
+        stage_stats.clear()
+        counters.clear()
+
+@contextmanager
+def trace(profile=None, memory=None):
+    # collects this thread's stage timings and counters for one request
+    # optionally with a cProfile and tracemalloc capture for chasing outliers
+    global last_trace
+
+    profile = config.METRICS_PROFILE if profile is None else profile
+    memory = config.METRICS_TRACEMALLOC if memory is None else memory
+
+    result = {"stages": {}, "counters": {}}
+    local.trace = result
+
+    # a concurrent request would stop our tracemalloc session, skip the capture instead of waiting
+    capture = (profile or memory) and capture_lock.acquire(blocking=False)
+    if (profile or memory) and not capture:
+        result["capture_skipped"] = "another request is being profiled"
+
+    profiler = cProfile.Profile() if profile and capture else None
+    memory = memory and capture
+    if memory:
+        tracemalloc.start()
+    if profiler:
+        profiler.enable()
+
+    start = time.perf_counter()
+    try:
+        yield result
+    finally:
+        result["total"] = time.perf_counter() - start
+
+        try:
+            if profiler:
+                profiler.disable()
+                out = io.StringIO()
+                pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(20)
+                result["profile"] = out.getvalue()
+
+            if memory:
+                snapshot = tracemalloc.take_snapshot()
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                result["memory_peak_bytes"] = peak
+                result["memory_top"] = [str(stat) for stat in snapshot.statistics("lineno")[:10]]
+        finally:
+            if capture:
+                capture_lock.release()
+
+        local.trace = None
+        last_trace = result
+
+def render_prometheus():
+    # prometheus text exposition format
+    lines = []
+
+    with lock:
+        lines.append("# HELP pytone_stage_seconds Time spent in each pipeline stage.")
+        lines.append("# TYPE pytone_stage_seconds histogram")
+        for stage, stats in sorted(stage_stats.items()):
+            for i, bound in enumerate(BUCKETS):
+                lines.append(f'pytone_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {stats[i]}')
+            lines.append(f'pytone_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {stats[-2]}')
+            lines.append(f'pytone_stage_seconds_count{{stage="{stage}"}} {stats[-2]}')
+            lines.append(f'pytone_stage_seconds_sum{{stage="{stage}"}} {stats[-1]}')
+
+        for name, value in sorted(counters.items()):
+            lines.append(f"# TYPE pytone_{name}_total counter")
+            lines.append(f"pytone_{name}_total {value}")
+
+    return "\n".join(lines) + "\n"
+
+def create_app():
+    from flask import Flask, Response
+
+    app = Flask("pytone_metrics")
+
+    @app.route("/metrics")
+    def metrics_endpoint():
+        return Response(render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+    return app
+
+def start_metrics_server(port, host=None):
+    # serve /metrics from a background thread next to the gradio app
+    app = create_app()
+    server = threading.Thread(
+        target=app.run,
+        kwargs={"host": host or config.METRICS_HOST, "port": port, "use_reloader": False},
+        daemon=True
+    )
+    server.start()
+
+    return server
@@ -0,0 +1,38 @@
+import sys
+import config
+from database import db_handler, storage
+from utils import fingerprint_cache
+
+def rehash_song(youtube_url):
+    # fingerprint the original audio again in the new format, cached audio saves the download
+    return fingerprint_cache.fingerprint_url(youtube_url)
+
+if __name__ == "__main__":
+    if not storage.uses_mysql():
+        print(f"Hash migration works on the MySQL database, STORAGE_BACKEND is '{config.STORAGE_BACKEND}'.")
+        sys.exit(1)
+
+    # initialize connection
+    db_handler.prepare_db_handler()
+    db_handler.use_database()
+
+    current_format = db_handler.get_hash_format()
+
+    if current_format == config.HASH_FORMAT:
+        print(f"Hash table already uses the '{config.HASH_FORMAT}' format.")
+    else:
+        print(f"Migrating hashes from '{current_format}' to '{config.HASH_FORMAT}'...")
+        migrated = db_handler.migrate_hash_format(rehash_song, config.HASH_FORMAT)
+        if migrated is None:
+            sys.exit(1)
+        print(f"Re-fingerprinted {migrated} songs.")
+
+    # the new table above is already built in the configured layout
+    current_layout = db_handler.get_hash_layout()
+
+    if current_layout == config.HASH_LAYOUT:
+        print(f"Hash table already uses the '{config.HASH_LAYOUT}' layout.")
+    else:
+        print(f"Converting the Hash table from the '{current_layout}' to the '{config.HASH_LAYOUT}' layout...")
+        rows = db_handler.migrate_hash_layout(config.HASH_LAYOUT)
+        print(f"Converted {rows} rows.")
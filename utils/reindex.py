@@ -0,0 +1,55 @@
+import sys
+import config
+from database import db_handler, storage
+from utils.migrate_hashes import rehash_song
+
+def reindex(dry_run=False):
+    # re-fingerprint only the songs whose stored parameters differ from config.py
+    stale = db_handler.get_stale_songs()
+    missing_source = [song_id for song_id, youtube_url in stale if not youtube_url]
+    stale = [(song_id, youtube_url) for song_id, youtube_url in stale if youtube_url]
+
+    print(f"{len(stale)} songs to re-index")
+    if missing_source:
+        # bulk-ingested files keep no source url, run the bulk ingest again for those
+        print(f"{len(missing_source)} stale songs have no source url and are skipped: {missing_source}")
+
+    if dry_run:
+        return 0
+
+    # through the backend, so a lookup cache in front of mysql drops the replaced hashes
+    backend = storage.get_backend()
+
+    done = 0
+    for song_id, youtube_url in stale:
+        try:
+            hash_array, offset_array = rehash_song(youtube_url)
+        except Exception as err:
+            print(f"Error: failed to re-fingerprint song {song_id}: {err}")
+            continue
+
+        batch_data = [(h, song_id, o) for h, o in zip(hash_array.tolist(), offset_array.tolist())]
+        if backend.replace_song_hashes(song_id, batch_data) is not None:
+            done += 1
+            print(f"Re-indexed song {song_id} ({len(batch_data)} hashes)")
+
+    return done
+
+if __name__ == "__main__":
+    if not storage.uses_mysql():
+        print(f"Re-indexing works on the MySQL database, STORAGE_BACKEND is '{config.STORAGE_BACKEND}'.")
+        sys.exit(1)
+
+    # initialize connection
+    db_handler.prepare_db_handler()
+    db_handler.use_database()
+
+    current_format = db_handler.get_hash_format()
+
+    # a different hash format changes the column type, that is a full migration
+    if current_format != config.HASH_FORMAT:
+        print(f"Hash table uses the '{current_format}' format, run python -m utils.migrate_hashes first.")
+        sys.exit(1)
+
+    reindexed = reindex(dry_run="--dry-run" in sys.argv[1:])
+    print(f"Re-indexed {reindexed} songs.")
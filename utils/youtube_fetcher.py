@@ -1,6 +1,12 @@
-import yt_dlp
+import os
+import uuid
+import tempfile
+import config
 
 def get_song_info_from_youtube(url):
+    # local import, yt_dlp is only needed for training
+    import yt_dlp
+
     # suppress output and skip download
     ydl_options = {
         'quiet': True, 
@@ -22,4 +28,26 @@ def get_song_info_from_youtube(url):
             # fetch audio url
             #info['audio_url']
             url
-        )
\ No newline at end of file
+        )
+
+def download_audio(url, name="temp_download"):
+    import yt_dlp
+
+    # unique file per request, concurrent downloads never share a path
+    name = os.path.join(tempfile.gettempdir(), f"{name}_{uuid.uuid4().hex}")
+
+    # options to download audio as wav
+    ydl_options = {
+        'format': 'bestaudio/best',
+        'outtmpl': f'{name}.%(ext)s',
+        'postprocessors': [{'key': 'FFmpegExtractAudio','preferredcodec': 'wav',}],
+        # let ffmpeg convert to the fingerprint rate while decoding, so loading skips the resample
+        'postprocessor_args': {'extractaudio': ['-ar', str(config.SAMPLE_RATE)]},
+        'quiet': True,
+    }
+
+    # download audio to file
+    with yt_dlp.YoutubeDL(ydl_options) as ydl:
+        ydl.download([url])
+
+    return f"{name}.wav"